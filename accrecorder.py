@@ -8,6 +8,24 @@ from os import curdir, sep
 from collections import namedtuple
 from aiohttp import web
 from wsclient import WebSocketClient
+from jobs import ProcessingQueue
+from scheduler import SCHEDULER
+from recorder import PIPELINE_CUTS, PIPELINES
+from janus import PORT_POOL
+from store import StateStore
+from rtp import ENGINE_FFMPEG, ENGINES
+from upload import S3Uploader
+import profiles
+from pathlib import Path
+import janus
+import events
+import log
+import metrics
+
+logger = log.get_logger("server")
+
+# 进度流没有更新时发送注释行的间隔 (秒), 避免代理断开连接
+SSE_HEARTBEAT = 15
 
 ROOT = os.path.dirname(__file__)
 
@@ -27,7 +45,7 @@ async def index(request):
 # check start command
 async def start(request):
     form = await request.post()
-    print(u"[START]:Incoming Request: {r}, form: {f}".format(r=request, f=form))
+    logger.info("Incoming Request: %s, form: %s", request, form)
 
     resp = json_response(False, 0, "default response")
 
@@ -45,14 +63,13 @@ async def start(request):
     else:
         resp = json_response(False, -3, "Current room {r} is recording".format(r=room))
 
-    print("[END]")
     return web.json_response(resp)
 
 
 # check stop command
 async def stop(request):
     form = await request.post()
-    print(u"[START]:Incoming Request: {r}, form: {f}".format(r=request, f=form))
+    logger.info("Incoming Request: %s, form: %s", request, form)
 
     resp = json_response(False, 0, "default response")
 
@@ -64,18 +81,174 @@ async def stop(request):
     # if room.isdigit() == False:
     #     resp = json_response(False, -2, "Please input correct publisher identifier!")
 
-    success = await ws.stop_recording(int(room))
+    success, job = await ws.stop_recording(int(room))
     if success:
         resp = json_response(True, 0, "Stop recording")
+        resp["job"] = job
     else:
-        resp = json_response(False, -3, "Current publisher is not recording")
+        resp = _not_recording(int(room))
 
-    print("[END]")
     return web.json_response(resp)
 
 
+# 没有停止的房间: 还在加入房间, 或者没有在录制
+def _not_recording(room):
+    if (ws.room_status(room) or {}).get("status") == "Starting":
+        return json_response(False, -3, "Room {r} is still joining, try again later".format(r=room))
+    return json_response(False, -3, "Room {r} is not recording".format(r=room))
+
+
+# 批量请求中的房间号, 不合法时返回 None
+def _room(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+async def _json_body(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict) or not isinstance(body.get("rooms"), list):
+        return None
+    return body
+
+
+# batch start: {"rooms": [{"room": 1234, "pin": "abcd"}, ...]}
+async def start_batch(request):
+    body = await _json_body(request)
+    if body is None:
+        return web.json_response(json_response(False, -1, "Expected JSON body with a rooms list"), status=400)
+    logger.info("Incoming Request: %s, %d rooms", request, len(body["rooms"]))
+
+    results = [None] * len(body["rooms"])
+    rooms = []
+    for index, item in enumerate(body["rooms"]):
+        room = _room(item.get("room")) if isinstance(item, dict) else None
+        if room is None:
+            results[index] = dict(json_response(False, -1, "Please input correct Room number!"), room=None)
+            continue
+        rooms.append((index, room, str(item.get("pin", ""))))
+
+    started = await ws.start_many([(room, pin) for _, room, pin in rooms])
+    for (index, room, _), success in zip(rooms, started):
+        if isinstance(success, Exception):
+            logger.error("Start recording of room %s failed: %s", room, success)
+            resp = json_response(False, -4, "Start recording failed: {e}".format(e=success))
+        elif success:
+            resp = json_response(True, 0, "Start recording...")
+        elif (ws.room_status(room) or {}).get("status") == "Failed":
+            resp = json_response(False, -4, "Join room {r} failed".format(r=room))
+        else:
+            resp = json_response(False, -3, "Current room {r} is recording".format(r=room))
+        resp["room"] = room
+        results[index] = resp
+
+    return web.json_response(json_response(all(r["success"] for r in results), 0, results))
+
+
+# batch stop: {"rooms": [1234, 1235, ...]}, 不等待后期处理
+async def stop_batch(request):
+    body = await _json_body(request)
+    if body is None:
+        return web.json_response(json_response(False, -1, "Expected JSON body with a rooms list"), status=400)
+    logger.info("Incoming Request: %s, %d rooms", request, len(body["rooms"]))
+
+    results = [None] * len(body["rooms"])
+    rooms = []
+    for index, item in enumerate(body["rooms"]):
+        room = _room(item)
+        if room is None:
+            results[index] = dict(json_response(False, -1, "Please input correct Room number!"), room=None)
+            continue
+        rooms.append((index, room))
+
+    stopped = await ws.stop_many([room for _, room in rooms])
+    for (index, room), result in zip(rooms, stopped):
+        if isinstance(result, Exception):
+            logger.error("Stop recording of room %s failed: %s", room, result)
+            resp = json_response(False, -4, "Stop recording failed: {e}".format(e=result))
+        elif result[0]:
+            resp = json_response(True, 0, "Stop recording")
+            resp["job"] = result[1]
+        else:
+            resp = _not_recording(room)
+        resp["room"] = room
+        results[index] = resp
+
+    resp = json_response(all(r["success"] for r in results), 0, results)
+    # 实际停止了录制的房间
+    resp["stopped"] = [r["room"] for r in results if r["success"]]
+    return web.json_response(resp)
+
+
+# 房间的录制状态, 分段和后期处理任务
+async def room_status(request):
+    room = _room(request.match_info["room"])
+    if room is None:
+        return web.json_response(json_response(False, -1, "Please input correct Room number!"), status=400)
+    status = ws.room_status(room)
+    if status is None:
+        return web.json_response(json_response(False, -2, "Room {r} is not recorded".format(r=room)), status=404)
+    return web.json_response(json_response(True, 0, status))
+
+
+async def job_status(request):
+    status = ws.job_status(request.match_info["id"])
+    if status is None:
+        return web.json_response(json_response(False, -2, "No such job"), status=404)
+    return web.json_response(json_response(True, 0, status))
+
+
+async def _send_event(resp, event, data):
+    await resp.write("event: {e}\ndata: {d}\n\n".format(e=event, d=json.dumps(data)).encode())
+
+
+# 后期处理进度, server-sent events: 每次进度变化发送 progress, 任务结束时发送 done 并关闭
+async def job_progress(request):
+    job = ws.job(request.match_info["id"])
+    if job is None:
+        return web.json_response(json_response(False, -2, "No such job"), status=404)
+
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await resp.prepare(request)
+    updates = job.file.progress.subscribe()
+    done = asyncio.ensure_future(job.wait())
+    update = None
+    try:
+        await _send_event(resp, "progress", job.info())
+        while not done.done():
+            if update is None:
+                update = asyncio.ensure_future(updates.get())
+            finished, _ = await asyncio.wait({update, done}, timeout=SSE_HEARTBEAT,
+                                             return_when=asyncio.FIRST_COMPLETED)
+            if update in finished:
+                update = None
+                await _send_event(resp, "progress", job.info())
+            elif len(finished) == 0:
+                await resp.write(b": keepalive\n\n")
+        await _send_event(resp, "done", job.info())
+    except ConnectionResetError:
+        pass
+    finally:
+        job.file.progress.unsubscribe(updates)
+        for task in (update, done):
+            if task is not None and not task.done():
+                task.cancel()
+    return resp
+
+
+# Prometheus metrics
+async def metrics_handler(request):
+    return web.Response(body=metrics.render(ws).encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
 async def on_shutdown(app):
-    print("Web server is shutting down...")
+    logger.info("Web server is shutting down...")
     # close ws
     loop.run_until_complete(ws.close())
 
@@ -86,21 +259,142 @@ async def on_shutdown(app):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="accrecorder")
     parser.add_argument(
-        "--janus", default="ws://192.168.5.12:8188", help="Janus gateway address (default: 127.0.0.1:8188)"
+        "--janus", nargs="+", default=["ws://192.168.5.12:8188"],
+        help="Janus gateway addresses, rooms are sharded across them (default: 127.0.0.1:8188)"
+    )
+    parser.add_argument(
+        "--janus-sockets", type=int, default=1, help="Websocket connections per Janus gateway (default: 1)"
     )
     parser.add_argument(
         "--port", type=int, default=9002, help="Port for HTTP server (default: 9002)"
     )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="Number of post-processing workers (default: 2)"
+    )
+    parser.add_argument(
+        "--ffmpeg-threads", type=int, default=None,
+        help="Total encoder threads shared by all rooms (default: cpu count)"
+    )
+    parser.add_argument(
+        "--threads-per-job", type=int, default=4, help="Encoder threads per ffmpeg job (default: 4)"
+    )
+    parser.add_argument(
+        "--pipeline", default=PIPELINE_CUTS, choices=PIPELINES,
+        help="Post-processing pipeline: cut files then merge, or one single pass filter graph (default: cuts)"
+    )
+    parser.add_argument(
+        "--profile", default=profiles.AUTO, choices=[profiles.AUTO] + list(profiles.PROFILES),
+        help="x264 profile of post-processing, auto picks one from the queue depth and deadline (default: auto)"
+    )
+    parser.add_argument(
+        "--deadline", type=int, default=profiles.DEADLINE,
+        help="Seconds a room may take from stop to processed, used by the auto profile (default: 3600)"
+    )
+    parser.add_argument(
+        "--live-pip", action="store_true",
+        help="Composite camera and screen into PiP while recording, so stop only needs a concat"
+    )
+    parser.add_argument(
+        "--engine", default=ENGINE_FFMPEG, choices=ENGINES,
+        help="Recording engine: one ffmpeg process per publisher, or receive RTP in this process (default: ffmpeg)"
+    )
+    parser.add_argument(
+        "--segment-time", type=int, default=0,
+        help="Record in chunks of N seconds that are joined in the background (default: 0, disabled)"
+    )
+    parser.add_argument(
+        "--rtp-ports", default="20002-50000", help="Local port range for RTP forwarding (default: 20002-50000)"
+    )
+    parser.add_argument(
+        "--no-validate", action="store_true", help="Skip field validation of Janus events"
+    )
+    parser.add_argument(
+        "--log-level", default="INFO", help="Log level: DEBUG, INFO, WARNING, ERROR (default: INFO)"
+    )
+    parser.add_argument(
+        "--log-file", default=None, help="Write logs to this file instead of stderr"
+    )
+    parser.add_argument(
+        "--log-rate", type=int, default=log.RATE,
+        help="Max media/slowlink log lines per publisher per second, 0 for unlimited (default: 5)"
+    )
+    parser.add_argument(
+        "--recordings", default=janus.FILE_ROOT_PATH, help="Root folder of the recordings"
+    )
+    parser.add_argument(
+        "--forward-host", default=janus.FORWARD_HOST, help="Local address Janus forwards RTP to"
+    )
+    parser.add_argument(
+        "--state-db", default=None,
+        help="SQLite file of the recording state, used to recover after a restart (default: <recordings>/accrecorder.db)"
+    )
+    parser.add_argument(
+        "--s3-endpoint", default=None,
+        help="S3 compatible endpoint finished recordings are uploaded to, credentials are read from "
+             "AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY (default: no upload)"
+    )
+    parser.add_argument(
+        "--s3-bucket", default="recordings", help="Bucket of the uploaded recordings (default: recordings)"
+    )
+    parser.add_argument(
+        "--s3-prefix", default="", help="Prefix of the object keys, keys are <prefix><room>/<begin>_<file>"
+    )
+    parser.add_argument(
+        "--s3-region", default="us-east-1", help="Region used to sign the requests (default: us-east-1)"
+    )
+    parser.add_argument(
+        "--upload-part-size", type=int, default=16, help="Multipart upload part size in MiB (default: 16, min 5)"
+    )
+    parser.add_argument(
+        "--upload-concurrency", type=int, default=4, help="Parts uploaded at the same time per file (default: 4)"
+    )
+    parser.add_argument(
+        "--upload-bandwidth", type=float, default=0,
+        help="Total upload bandwidth cap in MiB/s, 0 for unlimited (default: 0)"
+    )
     args = parser.parse_args()
 
+    janus.FILE_ROOT_PATH = os.path.join(args.recordings, "")
+    janus.FORWARD_HOST = args.forward_host
+
+    log.setup(level=args.log_level, rate=args.log_rate, path=args.log_file)
+
+    events.set_validation(not args.no_validate)
+
+    first, _, last = args.rtp_ports.partition("-")
+    PORT_POOL.configure(int(first), int(last))
+
+    SCHEDULER.configure(budget=args.ffmpeg_threads or os.cpu_count(), threads_per_job=args.threads_per_job)
+
     app = web.Application()
     app.on_shutdown.append(on_shutdown)
     app.router.add_get("/", index)
 
     app.router.add_post("/record/start", start)
     app.router.add_post("/record/stop", stop)
+    app.router.add_post("/record/start/batch", start_batch)
+    app.router.add_post("/record/stop/batch", stop_batch)
+    app.router.add_get("/record/{room}", room_status)
+    app.router.add_get("/jobs/{id}", job_status)
+    app.router.add_get("/jobs/{id}/progress", job_progress)
+    app.router.add_get("/metrics", metrics_handler)
+
+    Path(args.recordings).mkdir(parents=True, exist_ok=True)
+    store = StateStore(args.state_db or os.path.join(args.recordings, "accrecorder.db"))
+
+    uploader = None
+    if args.s3_endpoint is not None:
+        uploader = S3Uploader(args.s3_endpoint, args.s3_bucket, os.environ.get("AWS_ACCESS_KEY_ID", ""),
+                              os.environ.get("AWS_SECRET_ACCESS_KEY", ""), region=args.s3_region,
+                              prefix=args.s3_prefix, part_size=args.upload_part_size * 1024 * 1024,
+                              concurrency=args.upload_concurrency,
+                              bandwidth=int(args.upload_bandwidth * 1024 * 1024))
 
-    ws = WebSocketClient(args.janus)
+    jobs = ProcessingQueue(workers=args.workers, store=store, uploader=uploader, profile=args.profile,
+                           deadline=args.deadline)
+    ws = WebSocketClient(args.janus, jobs=jobs, pipeline=args.pipeline,
+                         live_pip=args.live_pip, segment_time=args.segment_time,
+                         sockets=args.janus_sockets, engine=args.engine, store=store)
     loop = asyncio.get_event_loop()
 
     try:
@@ -108,11 +402,13 @@ if __name__ == "__main__":
         loop.run_until_complete(runner.setup())
         site = web.TCPSite(runner, host="127.0.0.1", port=args.port)
         loop.run_until_complete(site.start())
-        print("Start HTTP server at port ", args.port)
+        logger.info("Start HTTP server at port %d", args.port)
+        if uploader is not None:
+            loop.create_task(uploader.resume(janus.FILE_ROOT_PATH))
         loop.run_until_complete(ws.loop())
 
     except KeyboardInterrupt:
         pass
     finally:
-        print("Stopping now!")
+        logger.info("Stopping now!")
         loop.run_until_complete(ws.close())
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# Janus 事件解码的微基准: 旧的 json + attrs 路径 vs events 模块
+import os
+import sys
+import json
+import time
+import argparse
+
+import attr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import events
+
+
+# 旧的解码路径, 仅用于对比
+@attr.s
+class _JanusEvent:
+    sender = attr.ib(validator=attr.validators.instance_of(int))
+
+
+@attr.s
+class _PluginData(_JanusEvent):
+    plugin = attr.ib(validator=attr.validators.instance_of(str))
+    data = attr.ib()
+    jsep = attr.ib()
+
+
+@attr.s
+class _Media(_JanusEvent):
+    receiving = attr.ib(validator=attr.validators.instance_of(bool))
+    kind = attr.ib(validator=attr.validators.in_(["audio", "video"]))
+
+
+@attr.s
+class _SlowLink(_JanusEvent):
+    uplink = attr.ib(validator=attr.validators.instance_of(bool))
+    lost = attr.ib(validator=attr.validators.instance_of(int))
+
+
+def legacy_decode(text):
+    raw = json.loads(text)
+    janus = raw["janus"]
+    if janus == "event" or janus == "success":
+        if "plugindata" in raw:
+            return _PluginData(sender=raw["sender"], plugin=raw["plugindata"]["plugin"],
+                               data=raw["plugindata"]["data"], jsep=raw["jsep"] if "jsep" in raw else None)
+    elif janus == "media":
+        return _Media(sender=raw["sender"], receiving=raw["receiving"], kind=raw["type"])
+    elif janus == "slowlink":
+        return _SlowLink(sender=raw["sender"], uplink=raw["uplink"], lost=raw["lost"])
+    return raw
+
+
+def decode(text):
+    return events.decode(events.loads(text))
+
+
+# 模拟繁忙房间的消息: 大部分是 media/slowlink
+def messages():
+    session = 4839201934
+    return [json.dumps(m) for m in [
+        {"janus": "media", "session_id": session, "sender": 1234567, "type": "video", "receiving": True},
+        {"janus": "media", "session_id": session, "sender": 1234567, "type": "audio", "receiving": False},
+        {"janus": "slowlink", "session_id": session, "sender": 1234567, "uplink": True, "lost": 12},
+        {"janus": "slowlink", "session_id": session, "sender": 7654321, "uplink": False, "lost": 3},
+        {"janus": "event", "session_id": session, "sender": 1234567, "plugindata": {
+            "plugin": "janus.plugin.videoroom",
+            "data": {"videoroom": "event", "room": 1234, "publishers": [
+                {"id": 1, "display": "cam", "audio_codec": "opus", "video_codec": "h264", "talking": False}]}}},
+    ]]
+
+
+def run(fn, msgs, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn(msgs[i % len(msgs)])
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Janus event decoding benchmark")
+    parser.add_argument("--count", type=int, default=200000, help="Events per run (default: 200000)")
+    args = parser.parse_args()
+
+    msgs = messages()
+    legacy = run(legacy_decode, msgs, args.count)
+    events.set_validation(True)
+    validated = run(decode, msgs, args.count)
+    events.set_validation(False)
+    fast = run(decode, msgs, args.count)
+
+    print("json backend: ", events.JSON_BACKEND)
+    print("legacy json + attrs:      {r:>12,.0f} events/sec".format(r=legacy))
+    print("events, validation on:    {r:>12,.0f} events/sec ({x:.2f}x)".format(r=validated, x=validated / legacy))
+    print("events, validation off:   {r:>12,.0f} events/sec ({x:.2f}x)".format(r=fast, x=fast / legacy))
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+# 后期处理基准: 按线上常见的 RecordSegment 时间分布生成合成录像, 对比各个处理模式的
+# 耗时、CPU 时间、磁盘峰值和输出大小
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import janus
+from recorder import RecordFile, RecordSegment, RecordStatus, PIPELINES
+import profiles
+from scheduler import SCHEDULER
+
+CAM = 1
+SCREEN = janus.SCREEN
+# 合成录像的起始时间, 与线上一样使用整数秒
+EPOCH = 1600000000
+
+
+# 场景: 会议时长 d 内摄像头和屏幕的 (开始, 结束) 偏移
+def _full_share(d):
+    return [(0, d)], [(1, d - 1)]
+
+
+def _short_shares(d):
+    return [(0, d)], [(d // 10, d // 4), (d * 9 // 20, d * 11 // 20), (d * 3 // 4, d * 17 // 20)]
+
+
+def _late_screen(d):
+    return [(0, d)], [(d * 2 // 5, d)]
+
+
+def _camera_rejoin(d):
+    return [(0, d * 3 // 10), (d * 7 // 20, d * 7 // 10), (d * 3 // 4, d)], [(d // 5, d * 4 // 5)]
+
+
+SCENARIOS = {
+    "full_share": _full_share,
+    "short_shares": _short_shares,
+    "late_screen": _late_screen,
+    "camera_rejoin": _camera_rejoin,
+}
+
+
+# 用 lavfi 生成一段录像, 相同参数的源文件只生成一次
+def _generate(cache, screen, duration):
+    kind = "screen" if screen else "camera"
+    path = os.path.join(cache, "{k}_{d}.ts".format(k=kind, d=duration))
+    if os.path.isfile(path):
+        return path
+
+    if screen:
+        inputs = ['-f', 'lavfi', '-i', 'testsrc2=size=1920x1080:rate=15']
+        codecs = ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', '30']
+    else:
+        inputs = ['-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=25',
+                  '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000']
+        codecs = ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', '50', '-c:a', 'libopus', '-b:a', '48k']
+    subprocess.run(['ffmpeg', '-nostdin', '-y', '-loglevel', 'error'] + inputs + ['-t', str(duration)] + codecs +
+                   ['-f', 'mpegts', path + '.tmp'], check=True)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def _segments(room, publisher, spans):
+    return [RecordSegment(name="{p}_{t}.ts".format(p=publisher, t=EPOCH + b), room=room, publisher=publisher,
+                          begin_time=EPOCH + b, end_time=EPOCH + e) for b, e in spans]
+
+
+def _folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _cpu_seconds():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+# 处理过程中定时采样房间目录大小
+async def _watch_disk(folder, peak, interval):
+    while True:
+        peak[0] = max(peak[0], _folder_size(folder))
+        await asyncio.sleep(interval)
+
+
+async def run_case(root, cache, room, scenario, mode, duration, interval, profile=profiles.BALANCED):
+    cam_spans, screen_spans = SCENARIOS[scenario](duration)
+    cameras = _segments(room, CAM, cam_spans)
+    screens = _segments(room, SCREEN, screen_spans)
+
+    folder = os.path.join(root, str(room))
+    os.makedirs(folder)
+    for segment, (b, e) in zip(cameras + screens, cam_spans + screen_spans):
+        shutil.copyfile(_generate(cache, segment.is_screen, e - b), os.path.join(folder, segment.name))
+
+    file = RecordFile(room=room, cam=cameras[0], mode=mode, profile=profile)
+    file.cameras = cameras
+    file.screens = screens
+
+    inputs = _folder_size(folder)
+    peak = [inputs]
+    watcher = asyncio.get_event_loop().create_task(_watch_disk(folder, peak, interval))
+    cpu = _cpu_seconds()
+    begin = time.monotonic()
+    error = None
+    try:
+        await file.process()
+    except Exception as e:
+        error = e
+    finally:
+        wall = time.monotonic() - begin
+        cpu = _cpu_seconds() - cpu
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+    peak[0] = max(peak[0], _folder_size(folder))
+
+    output = os.path.join(folder, "join_merged.ts")
+    return {
+        "scenario": scenario,
+        "mode": mode,
+        "ok": error is None and file.status == RecordStatus.Finished,
+        "error": error,
+        "wall": wall,
+        "cpu": cpu,
+        "disk": peak[0] - inputs,
+        "output": os.path.getsize(output) if os.path.isfile(output) else 0,
+    }
+
+
+def _print(result):
+    status = "ok" if result["ok"] else "FAILED {e}".format(e=result["error"])
+    print("{s:<14} {m:<12} {w:8.2f} {c:8.2f} {d:10.1f} {o:10.1f}  {st}".format(
+        s=result["scenario"], m=result["mode"], w=result["wall"], c=result["cpu"],
+        d=result["disk"] / 2 ** 20, o=result["output"] / 2 ** 20, st=status))
+
+
+async def main(args):
+    root = args.workdir or tempfile.mkdtemp(prefix="accrecorder-bench-")
+    cache = os.path.join(root, "sources")
+    os.makedirs(cache, exist_ok=True)
+    janus.FILE_ROOT_PATH = os.path.join(root, "")
+    SCHEDULER.configure(budget=args.ffmpeg_threads or os.cpu_count(), threads_per_job=args.threads_per_job)
+
+    print("recordings in {r}, meeting length {d}s".format(r=root, d=args.duration))
+    print("{s:<14} {m:<12} {w:>8} {c:>8} {d:>10} {o:>10}".format(
+        s="scenario", m="mode", w="wall s", c="cpu s", d="disk MiB", o="out MiB"))
+
+    room = 1
+    results = []
+    for scenario in args.scenarios:
+        for mode in args.modes:
+            for _ in range(args.repeat):
+                result = await run_case(root, cache, room, scenario, mode, args.duration, args.sample,
+                                        profiles.PROFILES[args.profile])
+                results.append(result)
+                _print(result)
+                if not args.keep:
+                    shutil.rmtree(os.path.join(root, str(room)), ignore_errors=True)
+                room += 1
+
+    if not args.workdir and not args.keep:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark post-processing pipelines on synthetic recordings")
+    parser.add_argument("--duration", type=int, default=120, help="Meeting length in seconds (default: 120)")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--modes", nargs="+", default=PIPELINES, choices=PIPELINES)
+    parser.add_argument("--profile", default=profiles.BALANCED.name, choices=list(profiles.PROFILES))
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--sample", type=float, default=0.2, help="Disk usage sampling interval (default: 0.2)")
+    parser.add_argument("--ffmpeg-threads", type=int, default=None)
+    parser.add_argument("--threads-per-job", type=int, default=4)
+    parser.add_argument("--workdir", default=None, help="Keep sources here so later runs reuse them")
+    parser.add_argument("--keep", action="store_true", help="Keep the processed room folders")
+    asyncio.run(main(parser.parse_args()))
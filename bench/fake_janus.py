@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# 压测用的本地 Janus: 只实现 WebSocketClient 用到的 janus-protocol 子集,
+# rtp_forward 时用 ffmpeg lavfi 生成 H.264/Opus 的 RTP 流发送到转发端口
+import json
+import random
+import asyncio
+import argparse
+import subprocess
+
+import websockets
+
+# 每个房间里的 publisher: 摄像头 1 和屏幕 9
+CAM = 1
+SCREEN = 9
+VIDEOROOM = "janus.plugin.videoroom"
+
+
+def _id():
+    return random.randint(1, 2 ** 52)
+
+
+# 一路合成的 RTP 流
+class SyntheticPublisher:
+    def __init__(self, publisher, host, video_port, video_pt, audio_port=None, audio_pt=None,
+                 size="1280x720", rate=25):
+        self.publisher = publisher
+        self.host = host
+        self.video_port = video_port
+        self.video_pt = video_pt
+        self.audio_port = audio_port
+        self.audio_pt = audio_pt
+        self.size = size
+        self.rate = rate
+        self.proc = None
+
+    def command(self):
+        # 屏幕分享: 分辨率更高, 帧率更低
+        source = "testsrc2=size={s}:rate={r}".format(s=self.size, r=self.rate)
+        cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-re', '-f', 'lavfi', '-i', source]
+        if self.audio_port is not None:
+            cmd += ['-re', '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000']
+        cmd += ['-map', '0:v', '-c:v', 'libx264', '-profile:v', 'baseline', '-preset', 'ultrafast',
+                '-tune', 'zerolatency', '-g', str(self.rate * 2), '-bsf:v', 'dump_extra',
+                '-payload_type', str(self.video_pt), '-f', 'rtp',
+                'rtp://{h}:{p}'.format(h=self.host, p=self.video_port)]
+        if self.audio_port is not None:
+            cmd += ['-map', '1:a', '-c:a', 'libopus', '-b:a', '48k', '-payload_type', str(self.audio_pt),
+                    '-f', 'rtp', 'rtp://{h}:{p}'.format(h=self.host, p=self.audio_port)]
+        return cmd
+
+    def start(self):
+        self.proc = subprocess.Popen(self.command(), stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+
+class FakeJanus:
+    def __init__(self, host="127.0.0.1", port=8188, publishers=(CAM, SCREEN), media=True,
+                 camera_size="1280x720", screen_size="1920x1080"):
+        self.host = host
+        self.port = port
+        self.publishers = list(publishers)
+        self.media = media
+        self.camera_size = camera_size
+        self.screen_size = screen_size
+        # {session_id: set(handle_id)}
+        self.sessions = {}
+        # {stream_id: SyntheticPublisher}
+        self.streams = {}
+        self.received = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await websockets.serve(self._handler, self.host, self.port, subprotocols=['janus-protocol'])
+
+    async def close(self):
+        for stream in list(self.streams.values()):
+            stream.stop()
+        self.streams.clear()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def url(self):
+        return "ws://{h}:{p}".format(h=self.host, p=self.port)
+
+    async def _handler(self, ws, *args):
+        async for text in ws:
+            msg = json.loads(text)
+            janus = msg.get("janus")
+            self.received[janus] = self.received.get(janus, 0) + 1
+            for reply in self._handle(msg):
+                await ws.send(json.dumps(reply))
+
+    def _handle(self, msg):
+        janus = msg["janus"]
+        transaction = msg.get("transaction")
+        if janus == "create":
+            session = _id()
+            self.sessions[session] = set()
+            return [{"janus": "success", "transaction": transaction, "data": {"id": session}}]
+        if janus == "attach":
+            handle = _id()
+            self.sessions.setdefault(msg["session_id"], set()).add(handle)
+            return [{"janus": "success", "transaction": transaction, "session_id": msg["session_id"],
+                     "data": {"id": handle}}]
+        if janus == "keepalive":
+            return [{"janus": "ack", "transaction": transaction, "session_id": msg.get("session_id")}]
+        if janus == "destroy":
+            self.sessions.pop(msg.get("session_id"), None)
+            return [{"janus": "success", "transaction": transaction, "session_id": msg.get("session_id")}]
+        if janus == "message":
+            return self._message(msg)
+        return [{"janus": "error", "transaction": transaction, "error": {"code": 453, "reason": "unsupported"}}]
+
+    def _plugin(self, msg, data, janus="success"):
+        return {"janus": janus, "transaction": msg["transaction"], "session_id": msg.get("session_id"),
+                "sender": msg.get("handle_id"), "plugindata": {"plugin": VIDEOROOM, "data": data}}
+
+    def _message(self, msg):
+        body = msg["body"]
+        request = body["request"]
+        if request == "join":
+            publishers = [{"id": p, "display": "publisher_{p}".format(p=p)} for p in self.publishers]
+            return [
+                {"janus": "ack", "transaction": msg["transaction"], "session_id": msg.get("session_id")},
+                self._plugin(msg, {"videoroom": "joined", "room": body["room"], "id": body.get("id"),
+                                   "publishers": publishers}, janus="event"),
+            ]
+        if request == "rtp_forward":
+            return [self._plugin(msg, self._rtp_forward(body))]
+        if request == "stop_rtp_forward":
+            stream = self.streams.pop(body.get("stream_id"), None)
+            if stream is not None:
+                stream.stop()
+            return [self._plugin(msg, {"videoroom": "stop_rtp_forward", "room": body["room"],
+                                       "publisher_id": body["publisher_id"], "stream_id": body.get("stream_id")})]
+        return [self._plugin(msg, {"videoroom": "event", "error_code": 499, "error": "unsupported request"})]
+
+    def _rtp_forward(self, body):
+        publisher = int(body["publisher_id"])
+        screen = publisher == SCREEN
+        audio_port = body.get("audio_port")
+        stream = SyntheticPublisher(
+            publisher=publisher, host=body["host"],
+            video_port=body["video_port"], video_pt=body.get("video_pt", 102),
+            audio_port=audio_port, audio_pt=body.get("audio_pt", 96),
+            size=self.screen_size if screen else self.camera_size, rate=15 if screen else 25)
+
+        rtp_stream = {"host": body["host"], "video": body["video_port"], "video_stream_id": _id()}
+        self.streams[rtp_stream["video_stream_id"]] = stream
+        if audio_port is not None:
+            rtp_stream["audio"] = audio_port
+            # 同一个进程发送音视频, 停止任意一个都结束
+            rtp_stream["audio_stream_id"] = rtp_stream["video_stream_id"]
+        if self.media:
+            stream.start()
+        return {"videoroom": "rtp_forward", "room": body["room"], "publisher_id": publisher,
+                "rtp_stream": rtp_stream}
+
+
+async def main(args):
+    janus = FakeJanus(host=args.host, port=args.port, media=not args.no_media)
+    await janus.start()
+    print("Fake Janus listening on", janus.url)
+    try:
+        await asyncio.Future()
+    finally:
+        await janus.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in Janus gateway for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--no-media", action="store_true", help="Answer signaling only, do not stream RTP")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
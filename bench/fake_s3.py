@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# 本地 S3 兼容存储: 只实现 S3Uploader 用到的分片上传接口, 对象写到本地目录,
+# 可以按比例让分片请求失败, 用来测试重试和断点续传
+import os
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+
+from aiohttp import web
+
+NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+
+def _error(status, code, message):
+    body = "<Error><Code>{c}</Code><Message>{m}</Message></Error>".format(c=code, m=message)
+    return web.Response(status=status, body=body.encode(), content_type="application/xml")
+
+
+class FakeS3:
+    def __init__(self, root, host="127.0.0.1", port=9000, fail_rate=0.0):
+        self.root = root
+        self.host = host
+        self.port = port
+        self.fail_rate = fail_rate
+        # {upload_id: (bucket, key, {part: path})}
+        self.uploads = {}
+        self.requests = 0
+        self.failures = 0
+        self._runner = None
+
+    @property
+    def url(self):
+        return "http://{h}:{p}".format(h=self.host, p=self.port)
+
+    async def start(self):
+        app = web.Application(client_max_size=0)
+        app.router.add_route("*", "/{bucket}/{key:.+}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    async def _handle(self, request: web.Request):
+        self.requests += 1
+        if not request.headers.get("Authorization", "").startswith("AWS4-HMAC-SHA256 "):
+            return _error(403, "AccessDenied", "Missing SigV4 authorization")
+        bucket = request.match_info["bucket"]
+        key = request.match_info["key"]
+        query = request.query
+
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = (bucket, key, {})
+            body = ('<InitiateMultipartUploadResult xmlns="{ns}"><Bucket>{b}</Bucket><Key>{k}</Key>'
+                    '<UploadId>{u}</UploadId></InitiateMultipartUploadResult>').format(ns=NS, b=bucket, k=key,
+                                                                                       u=upload_id)
+            return web.Response(body=body.encode(), content_type="application/xml")
+
+        upload_id = query.get("uploadId")
+        if upload_id is not None and upload_id not in self.uploads:
+            return _error(404, "NoSuchUpload", "The specified upload does not exist")
+
+        if request.method == "PUT" and upload_id is not None:
+            if random.random() < self.fail_rate:
+                self.failures += 1
+                # 读完请求体再返回错误, 与真实服务一样
+                await request.read()
+                return _error(503, "SlowDown", "Injected failure")
+            part = int(query["partNumber"])
+            path = os.path.join(self.root, ".parts", "{u}.{n}".format(u=upload_id, n=part))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            md5 = hashlib.md5()
+            with open(path, "wb") as f:
+                async for data in request.content.iter_chunked(256 * 1024):
+                    md5.update(data)
+                    f.write(data)
+            self.uploads[upload_id][2][part] = path
+            return web.Response(headers={"ETag": '"{e}"'.format(e=md5.hexdigest())})
+
+        if request.method == "POST" and upload_id is not None:
+            await request.read()
+            _, _, parts = self.uploads.pop(upload_id)
+            target = self._object_path(bucket, key)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as out:
+                for n in sorted(parts):
+                    with open(parts[n], "rb") as src:
+                        out.write(src.read())
+                    os.remove(parts[n])
+            body = ('<CompleteMultipartUploadResult xmlns="{ns}"><Bucket>{b}</Bucket><Key>{k}</Key>'
+                    '<ETag>"{e}-{n}"</ETag></CompleteMultipartUploadResult>').format(ns=NS, b=bucket, k=key,
+                                                                                     e=uuid.uuid4().hex, n=len(parts))
+            return web.Response(body=body.encode(), content_type="application/xml")
+
+        if request.method == "DELETE" and upload_id is not None:
+            _, _, parts = self.uploads.pop(upload_id)
+            for path in parts.values():
+                os.remove(path)
+            return web.Response(status=204)
+
+        if request.method == "GET":
+            target = self._object_path(bucket, key)
+            if not os.path.isfile(target):
+                return _error(404, "NoSuchKey", "The specified key does not exist")
+            return web.FileResponse(target)
+
+        return _error(501, "NotImplemented", "Not implemented by the fake")
+
+
+async def main(args):
+    root = args.root or tempfile.mkdtemp(prefix="fake-s3-")
+    s3 = FakeS3(root, host=args.host, port=args.port, fail_rate=args.fail_rate)
+    await s3.start()
+    print("Fake S3 listening on", s3.url, "storing objects in", root)
+    try:
+        await asyncio.Future()
+    finally:
+        await s3.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in S3 object store for upload tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--root", default=None, help="Folder of the stored objects (default: a temp folder)")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of part uploads that fail with 503")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
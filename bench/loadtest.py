@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# 压测: 本地假 Janus + 合成 RTP, 按梯度增加房间数, 统计开始录制耗时、最大稳定并发房间数、每个房间的 CPU 和内存
+import os
+import sys
+import glob
+import time
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+from fake_janus import FakeJanus
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# 进程及其所有子进程 (ffmpeg 录制进程) 的 pid
+def _process_tree(pid):
+    children = {}
+    for stat in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.split("/")[2]))
+
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree += children.get(tree[i], [])
+        i += 1
+    return tree
+
+
+# 返回 (CPU 秒, RSS 字节), 已经退出的进程忽略
+def _usage(pids):
+    cpu = 0
+    rss = 0
+    for pid in pids:
+        try:
+            with open("/proc/{p}/stat".format(p=pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/{p}/statm".format(p=pid)) as f:
+                pages = int(f.read().split()[1])
+        except (OSError, IndexError):
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        rss += pages * PAGE_SIZE
+    return cpu, rss
+
+
+# 房间里正在写入的录像大小, 不含 PiP 合成文件
+def _room_bytes(recordings, room):
+    total = 0
+    for path in glob.glob(os.path.join(recordings, str(room), "*.ts")):
+        if os.path.basename(path).startswith("pip_"):
+            continue
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.recordings = args.recordings or tempfile.mkdtemp(prefix="accrecorder-load-")
+        self.janus = FakeJanus(port=args.janus_port or _free_port(), media=not args.no_media)
+        self.http_port = args.http_port or _free_port()
+        self.server = None
+        self.session = None
+        self.rooms = []
+        # {room: 开始录制耗时}
+        self.ttr = {}
+        self.levels = []
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{p}".format(p=self.http_port)
+
+    def _start_server(self):
+        cmd = [sys.executable, os.path.join(ROOT, "accrecorder.py"),
+               "--janus", self.janus.url, "--port", str(self.http_port),
+               "--forward-host", "127.0.0.1", "--recordings", self.recordings,
+               "--log-level", self.args.log_level] + self.args.server_args
+        log = open(os.path.join(self.recordings, "accrecorder.log"), "ab")
+        self.server = subprocess.Popen(cmd, cwd=ROOT, stdin=subprocess.DEVNULL, stdout=log, stderr=log)
+        log.close()
+
+    async def _wait_server(self, timeout=15):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.server.poll() is not None:
+                raise RuntimeError("accrecorder exited with code {c}".format(c=self.server.returncode))
+            try:
+                async with self.session.get(self.url + "/") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("accrecorder did not start in {t}s".format(t=timeout))
+
+    async def _post(self, path, room):
+        async with self.session.post(self.url + path, data={"room": str(room), "pin": ""}) as resp:
+            return await resp.json()
+
+    # 开始录制, 返回从请求到录像文件出现数据的耗时, 超时返回 None
+    async def _start_room(self, room):
+        begin = time.monotonic()
+        resp = await self._post("/record/start", room)
+        if not resp.get("success"):
+            print("  room {r}: start failed: {d}".format(r=room, d=resp.get("data")))
+            return None
+        deadline = begin + self.args.ttr_limit
+        while time.monotonic() < deadline:
+            if self.args.no_media or _room_bytes(self.recordings, room) > 0:
+                return time.monotonic() - begin
+            await asyncio.sleep(0.05)
+        return None
+
+    async def _stop_room(self, room):
+        try:
+            return await self._post("/record/stop", room)
+        except aiohttp.ClientError as e:
+            return {"success": False, "data": str(e)}
+
+    # 保持当前房间数一段时间, 采样 CPU 和内存, 检查所有房间的录像仍在增长
+    async def _hold(self):
+        sizes = {room: _room_bytes(self.recordings, room) for room in self.rooms}
+        cpu_begin, _ = _usage(_process_tree(self.server.pid))
+        begin = time.monotonic()
+        peak_rss = 0
+        while time.monotonic() - begin < self.args.hold:
+            await asyncio.sleep(self.args.sample)
+            _, rss = _usage(_process_tree(self.server.pid))
+            peak_rss = max(peak_rss, rss)
+        cpu_end, _ = _usage(_process_tree(self.server.pid))
+        elapsed = time.monotonic() - begin
+
+        stalled = [room for room in self.rooms
+                   if not self.args.no_media and _room_bytes(self.recordings, room) <= sizes[room]]
+        return (cpu_end - cpu_begin) / elapsed, peak_rss, stalled
+
+    async def run(self):
+        await self.janus.start()
+        self._start_server()
+        self.session = aiohttp.ClientSession()
+        try:
+            await self._wait_server()
+            _, base_rss = _usage(_process_tree(self.server.pid))
+            print("accrecorder pid {p}, recordings in {d}, idle RSS {m:.1f} MiB".format(
+                p=self.server.pid, d=self.recordings, m=base_rss / 2 ** 20))
+
+            stable = 0
+            room = self.args.first_room
+            while len(self.rooms) < self.args.rooms:
+                count = min(self.args.step, self.args.rooms - len(self.rooms))
+                batch = list(range(room, room + count))
+                room += count
+                self.rooms += batch
+
+                results = await asyncio.gather(*[self._start_room(r) for r in batch])
+                for r, ttr in zip(batch, results):
+                    self.ttr[r] = ttr
+                failed = [r for r, ttr in zip(batch, results) if ttr is None]
+
+                cpu, rss, stalled = await self._hold()
+                level = {
+                    "rooms": len(self.rooms),
+                    "ttr": [t for t in results if t is not None],
+                    "failed": failed,
+                    "stalled": stalled,
+                    "cpu": cpu,
+                    "rss": rss,
+                }
+                self.levels.append(level)
+                self._print_level(level, base_rss)
+
+                if failed or stalled or self.server.poll() is not None:
+                    break
+                stable = len(self.rooms)
+
+            await self._stop_all()
+            self._report(stable, base_rss)
+        finally:
+            await self.session.close()
+            self._stop_server()
+            await self.janus.close()
+
+    async def _stop_all(self):
+        begin = time.monotonic()
+        results = await asyncio.gather(*[self._stop_room(r) for r in self.rooms])
+        failed = len([r for r in results if not r.get("success")])
+        print("stopped {n} rooms in {t:.2f}s, {f} failed".format(
+            n=len(self.rooms), t=time.monotonic() - begin, f=failed))
+
+    def _stop_server(self):
+        if self.server is not None and self.server.poll() is None:
+            self.server.send_signal(signal.SIGINT)
+            try:
+                self.server.wait(10)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+
+    @staticmethod
+    def _percentile(values, p):
+        if not values:
+            return float("nan")
+        values = sorted(values)
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    def _print_level(self, level, base_rss):
+        n = level["rooms"]
+        print("{n:4d} rooms  ttr p50 {p50:6.2f}s p95 {p95:6.2f}s  cpu {c:6.2f} cores ({cr:.3f}/room)  "
+              "rss {m:8.1f} MiB ({mr:.1f} MiB/room)  failed {f} stalled {s}".format(
+                  n=n, p50=self._percentile(level["ttr"], 50), p95=self._percentile(level["ttr"], 95),
+                  c=level["cpu"], cr=level["cpu"] / n, m=level["rss"] / 2 ** 20,
+                  mr=(level["rss"] - base_rss) / n / 2 ** 20, f=len(level["failed"]), s=len(level["stalled"])))
+
+    def _report(self, stable, base_rss):
+        ttr = [t for t in self.ttr.values() if t is not None]
+        print("")
+        print("max stable concurrent rooms: {n}".format(n=stable))
+        print("time to recording: p50 {p50:.2f}s p95 {p95:.2f}s max {m:.2f}s over {c} rooms".format(
+            p50=self._percentile(ttr, 50), p95=self._percentile(ttr, 95), m=max(ttr) if ttr else float("nan"),
+            c=len(ttr)))
+        levels = [level for level in self.levels if level["rooms"] <= stable]
+        if levels:
+            last = levels[-1]
+            print("at {n} rooms: {c:.3f} cores/room, {m:.1f} MiB/room".format(
+                n=last["rooms"], c=last["cpu"] / last["rooms"],
+                m=(last["rss"] - base_rss) / last["rooms"] / 2 ** 20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test accrecorder against a local fake Janus")
+    parser.add_argument("--rooms", type=int, default=16, help="Max number of rooms (default: 16)")
+    parser.add_argument("--step", type=int, default=2, help="Rooms added per level (default: 2)")
+    parser.add_argument("--hold", type=float, default=10, help="Seconds to hold each level (default: 10)")
+    parser.add_argument("--sample", type=float, default=1, help="Sampling interval in seconds (default: 1)")
+    parser.add_argument("--ttr-limit", type=float, default=15,
+                        help="A room that does not record within this many seconds counts as failed (default: 15)")
+    parser.add_argument("--first-room", type=int, default=1000)
+    parser.add_argument("--recordings", default=None, help="Recordings folder (default: a temp folder)")
+    parser.add_argument("--janus-port", type=int, default=None)
+    parser.add_argument("--http-port", type=int, default=None)
+    parser.add_argument("--no-media", action="store_true", help="Signaling only, no RTP and no recorders checked")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="Extra accrecorder arguments after --, e.g. -- --segment-time 10")
+    args = parser.parse_args()
+    if args.server_args[:1] == ["--"]:
+        args.server_args = args.server_args[1:]
+
+    try:
+        asyncio.run(LoadTest(args).run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,174 @@
+import json
+
+# 优先使用更快的 JSON 库
+try:
+    import orjson
+
+    JSON_BACKEND = "orjson"
+
+    def loads(s):
+        return orjson.loads(s)
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    try:
+        import ujson
+
+        JSON_BACKEND = "ujson"
+        loads = ujson.loads
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+    except ImportError:
+        JSON_BACKEND = "json"
+        loads = json.loads
+        dumps = json.dumps
+
+# 是否校验事件字段, 生产环境可以关闭
+VALIDATE = True
+
+
+def set_validation(enabled):
+    global VALIDATE
+    VALIDATE = bool(enabled)
+
+
+def _check(value, kind, name):
+    # bool 是 int 的子类, 需要单独排除
+    if not isinstance(value, kind) or (kind is int and isinstance(value, bool)):
+        raise TypeError("'{n}' must be {k}, got {v!r}".format(n=name, k=kind.__name__, v=value))
+
+
+class _Slotted:
+    __slots__ = ()
+
+    def _fields(self):
+        for cls in reversed(type(self).__mro__):
+            for name in getattr(cls, "__slots__", ()):
+                yield name
+
+    def __repr__(self):
+        return "{c}({f})".format(c=type(self).__name__,
+                                 f=", ".join("{n}={v!r}".format(n=n, v=getattr(self, n)) for n in self._fields()))
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, n) == getattr(other, n) for n in self._fields())
+
+
+class JanusEvent(_Slotted):
+    __slots__ = ("sender",)
+
+    def __init__(self, sender):
+        if VALIDATE:
+            _check(sender, int, "sender")
+        self.sender = sender
+
+
+class PluginData(JanusEvent):
+    __slots__ = ("plugin", "data", "jsep")
+
+    def __init__(self, sender, plugin, data, jsep):
+        JanusEvent.__init__(self, sender)
+        if VALIDATE:
+            _check(plugin, str, "plugin")
+        self.plugin = plugin
+        self.data = data
+        self.jsep = jsep
+
+
+class WebrtcUp(JanusEvent):
+    __slots__ = ()
+
+
+class Media(JanusEvent):
+    __slots__ = ("receiving", "kind")
+
+    def __init__(self, sender, receiving, kind):
+        JanusEvent.__init__(self, sender)
+        if VALIDATE:
+            _check(receiving, bool, "receiving")
+            if kind not in ("video", "audio"):
+                raise ValueError("kind must equal video or audio")
+        self.receiving = receiving
+        self.kind = kind
+
+
+class SlowLink(JanusEvent):
+    __slots__ = ("uplink", "lost")
+
+    def __init__(self, sender, uplink, lost):
+        JanusEvent.__init__(self, sender)
+        if VALIDATE:
+            _check(uplink, bool, "uplink")
+            _check(lost, int, "lost")
+        self.uplink = uplink
+        self.lost = lost
+
+
+class HangUp(JanusEvent):
+    __slots__ = ("reason",)
+
+    def __init__(self, sender, reason):
+        JanusEvent.__init__(self, sender)
+        if VALIDATE:
+            _check(reason, str, "reason")
+        self.reason = reason
+
+
+class Ack(_Slotted):
+    __slots__ = ("transaction",)
+
+    def __init__(self, transaction):
+        if VALIDATE:
+            _check(transaction, str, "transaction")
+        self.transaction = transaction
+
+
+def _plugin_data(raw):
+    plugindata = raw.get("plugindata")
+    if plugindata is None:
+        return raw
+    return PluginData(raw["sender"], plugindata["plugin"], plugindata["data"], raw.get("jsep"))
+
+
+def _webrtcup(raw):
+    return WebrtcUp(raw["sender"])
+
+
+def _media(raw):
+    return Media(raw["sender"], raw["receiving"], raw["type"])
+
+
+def _slowlink(raw):
+    return SlowLink(raw["sender"], raw["uplink"], raw["lost"])
+
+
+def _hangup(raw):
+    return HangUp(raw["sender"], raw["reason"])
+
+
+def _ack(raw):
+    return Ack(raw["transaction"])
+
+
+# 根据 janus 字段分发
+DECODERS = {
+    "event": _plugin_data,
+    "success": _plugin_data,
+    "webrtcup": _webrtcup,
+    "media": _media,
+    "slowlink": _slowlink,
+    "hangup": _hangup,
+    "ack": _ack,
+}
+
+
+# 把 Janus 消息转换为事件对象, 未知的消息原样返回
+def decode(raw):
+    decoder = DECODERS.get(raw.get("janus"))
+    if decoder is None:
+        return raw
+    return decoder(raw)
@@ -1,54 +1,25 @@
 import asyncio
 from logging import raiseExceptions
 import attr
-import random
 import os
 from pathlib import Path
 from enum import Enum
+from ports import PortPool
+import log
 
-
-@attr.s
-class JanusEvent:
-    sender = attr.ib(validator=attr.validators.instance_of(int))
-
-
-@attr.s
-class PluginData(JanusEvent):
-    plugin = attr.ib(validator=attr.validators.instance_of(str))
-    data = attr.ib()
-    jsep = attr.ib()
+logger = log.get_logger("janus")
 
 
-@attr.s
-class WebrtcUp(JanusEvent):
-    pass
-
+class JanusError(Exception):
+    def __init__(self, code, reason):
+        super().__init__("[{c}] {r}".format(c=code, r=reason))
+        self.code = code
+        self.reason = reason
 
-@attr.s
-class Media(JanusEvent):
-    receiving = attr.ib(validator=attr.validators.instance_of(bool))
-    kind = attr.ib(validator=attr.validators.in_(["audio", "video"]))
 
-    @kind.validator
-    def validate_kind(self, attribute, kind):
-        if kind not in ["video", "audio"]:
-            raise ValueError("kind must equal video or audio")
-
-
-@attr.s
-class SlowLink(JanusEvent):
-    uplink = attr.ib(validator=attr.validators.instance_of(bool))
-    lost = attr.ib(validator=attr.validators.instance_of(int))
-
-
-@attr.s
-class HangUp(JanusEvent):
-    reason = attr.ib(validator=attr.validators.instance_of(str))
-
-
-@attr.s(cmp=False)
-class Ack:
-    transaction = attr.ib(validator=attr.validators.instance_of(str))
+class JanusTimeout(JanusError):
+    def __init__(self, reason):
+        super().__init__(None, reason)
 
 
 @attr.s
@@ -82,18 +53,11 @@ class RecordSessionStatus(Enum):
 # 屏幕的ID
 SCREEN = 9
 # 端口管理
-PORTS = []
+PORT_POOL = PortPool()
 # 测试
 FILE_ROOT_PATH = "/Users/amdox/File/Combine/.recordings/"
-
-
-def random_port():
-    p = random.randint(20001, 50000)
-    if p not in PORTS:
-        PORTS.append(p)
-        return p
-    else:
-        return random_port()
+# Janus 把 RTP 转发到本机的地址
+FORWARD_HOST = "192.168.5.66"
 
 
 class JanusSession:
@@ -118,7 +82,7 @@ class JanusRTPForwarder:
         self.videofmpt = "packetization-mode=1;profile-level-id=42e01f"
         self.audiocodec = "opus/48000/2"
         self.avformat_v = "58.76.100"
-        self.forward_host = "192.168.5.66"
+        self.forward_host = FORWARD_HOST
         self.name = None
         self.video_stream_id = None
         self.audio_stream_id = None
@@ -171,6 +135,8 @@ class RecordSession:
         self.forwarder: JanusRTPForwarder = None
         self.folder = None
         self.recorder_pid = None
+        # 当前正在写入的 RecordSegment
+        self.segment = None
 
     # 创建录像房间的文件夹, 当前房间会话的所有文件都在此文件夹中
     def create_file_folder(self):
@@ -178,16 +144,17 @@ class RecordSession:
         Path(dir).mkdir(parents=True, exist_ok=True)
         self.folder = dir + "/"
 
-        print("\nroom folder created at: ", self.folder, "\n")
+        log.with_room(logger, self.room).debug("Room folder created at: %s", self.folder)
 
     # 创建 sdp file 给 rtp forwarding -> FFMpeg    
     def create_sdp(self):
         assert self.folder
 
+        owner = "{r}-{p}".format(r=self.room, p=self.publisher)
         if self.publisher == SCREEN:
-            self.forwarder = JanusRTPForwarder(vp=random_port(), ap=-1)
+            self.forwarder = JanusRTPForwarder(vp=PORT_POOL.acquire(owner), ap=-1)
         else:
-            self.forwarder = JanusRTPForwarder(vp=random_port(), ap=random_port())
+            self.forwarder = JanusRTPForwarder(vp=PORT_POOL.acquire(owner), ap=PORT_POOL.acquire(owner))
 
         # t = time.time()
         name = "{p}_janus.sdp".format(p=self.publisher)
@@ -195,12 +162,12 @@ class RecordSession:
 
         # 删除原来有的 sdp 文件
         if os.path.isfile(file_path):
-            print("File exits: ", file_path, " removing now...")
+            log.with_room(logger, self.room).debug("File exits: %s removing now...", file_path)
             os.remove(file_path)
 
         self.forwarder.create_sdp(path=file_path, name=name)
 
-        print("\nsdp file created at: ", file_path, "\n")
+        log.with_room(logger, self.room).debug("SDP file created at: %s", file_path)
 
     def update_forwarder(self, v_stream=None, a_stream=None):
         if v_stream is not None:
@@ -247,10 +214,12 @@ class RecordSession:
             "room": self.room,
         }
 
+    # 录制进程绑定到端口租约上, 进程异常退出后端口可以被回收
+    def bind_ports(self, pid):
+        PORT_POOL.bind(self.forwarder.videoport, pid)
+        PORT_POOL.bind(self.forwarder.audioport, pid)
+
     # 回收本机的 RTP forwarding listen port
     def clean_ports(self):
-        if self.forwarder.audioport is not None:
-            if self.forwarder.audioport in PORTS:
-                PORTS.remove(self.forwarder.audioport)
-        if self.forwarder.videoport in PORTS:
-            PORTS.remove(self.forwarder.videoport)
+        PORT_POOL.release(self.forwarder.audioport)
+        PORT_POOL.release(self.forwarder.videoport)
@@ -0,0 +1,160 @@
+import asyncio
+import time
+import uuid
+
+from enum import Enum
+from recorder import RecordFile, RecordStatus
+import profiles
+import log
+import metrics
+
+logger = log.get_logger("jobs")
+
+
+class JobStatus(Enum):
+    Pending = 1
+    Running = 2
+    Finished = 3
+
+    Failed = -1
+
+
+# 后期处理任务
+class ProcessingJob:
+    def __init__(self, room, file: RecordFile):
+        self.id = uuid.uuid4().hex
+        self.room = room
+        self.file = file
+        self.status = JobStatus.Pending
+        self.error = None
+        self.created_time = time.time()
+        self.started_time = None
+        self.finished_time = None
+        # 使用的编码配置名
+        self.profile = None
+        self._callbacks = []
+        self._done = asyncio.Event()
+
+    # 状态查询接口返回的内容
+    def info(self):
+        return {"id": self.id, "room": self.room, "status": self.status.name, "record_status": self.file.status.name,
+                "profile": self.profile, "error": self.error, "output": self.file.output,
+                "progress": self.file.progress.snapshot(),
+                "created": self.created_time, "started": self.started_time, "finished": self.finished_time}
+
+    def add_done_callback(self, fn):
+        self._callbacks.append(fn)
+
+    async def wait(self):
+        await self._done.wait()
+        return self.status
+
+    def _finish(self, status, error=None):
+        self.status = status
+        self.error = error
+        self.finished_time = time.time()
+        metrics.JOBS_TOTAL.inc(status=status.name)
+        self._done.set()
+        for fn in self._callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("Callback of job %s failed", self.id)
+
+
+# 后期处理队列, 由固定数量的 worker 异步执行 RecordFile.process()
+class ProcessingQueue:
+    def __init__(self, workers=2, store=None, uploader=None, profile=profiles.AUTO, deadline=profiles.DEADLINE):
+        self.workers = max(1, int(workers))
+        # 编码配置名, auto 时按队列长度和截止时间选择
+        self.profile = profile
+        self.deadline = deadline
+        # StateStore, 任务状态变化时持久化
+        self.store = store
+        # S3Uploader, 处理完成后在后台上传, 不占用 worker
+        self.uploader = uploader
+        self._queue = None
+        self._tasks = []
+        # {job_id: ProcessingJob}
+        self._jobs = {}
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if len(self._tasks) == 0:
+            loop = asyncio.get_event_loop()
+            self._tasks = [loop.create_task(self._worker(i)) for i in range(self.workers)]
+
+    # 提交任务, 立即返回任务 ID
+    def submit(self, room, file: RecordFile):
+        self._ensure_workers()
+        job = ProcessingJob(room=room, file=file)
+        self._jobs[job.id] = job
+        self._save(job)
+        self._queue.put_nowait(job)
+        log.with_room(logger, room).info("Processing job %s queued", job.id)
+        return job
+
+    def _save(self, job: ProcessingJob):
+        if self.store is not None:
+            self.store.save_job(job)
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def pending(self):
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    def running(self):
+        return len([j for j in self._jobs.values() if j.status == JobStatus.Running])
+
+    def _select_profile(self, job: ProcessingJob, media_seconds):
+        if self.profile != profiles.AUTO:
+            return profiles.PROFILES[self.profile]
+        return profiles.select(media_seconds, time.time() - job.created_time, self.pending(), self.workers,
+                               self.deadline)
+
+    async def _worker(self, index):
+        while True:
+            job: ProcessingJob = await self._queue.get()
+            job.status = JobStatus.Running
+            job.started_time = time.time()
+            self._save(job)
+            job_log = log.with_room(logger, job.room)
+            media_seconds = job.file.media_seconds()
+            profile = self._select_profile(job, media_seconds)
+            job.file.profile = profile
+            job.profile = profile.name
+            job_log.info("Worker %d processing job %s with %s profile, %d jobs waiting", index, job.id, profile.name,
+                         self.pending())
+            try:
+                await job.file.process()
+                if job.file.encoded:
+                    profile.observe(media_seconds, time.time() - job.started_time)
+                job.file.progress.finish()
+                job._finish(JobStatus.Finished)
+                if self.uploader is not None:
+                    self.uploader.submit(job.room, job.file)
+            except asyncio.CancelledError:
+                # 正常关闭时被取消, 保存为等待中, 重启后由 recover 重新处理
+                job.status = JobStatus.Pending
+                job.error = "interrupted"
+                job_log.warning("Job %s interrupted, will be resumed after restart", job.id)
+                raise
+            except Exception as e:
+                job_log.exception("Job %s failed", job.id)
+                job.file.status = RecordStatus.Failed
+                job._finish(JobStatus.Failed, str(e))
+            finally:
+                self._save(job)
+                self._queue.task_done()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.uploader is not None:
+            await self.uploader.close()
@@ -0,0 +1,102 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from pool import transaction_id
+import log
+
+logger = log.get_logger("keepalive")
+
+# Janus session 默认 60 秒超时, 每 30 秒发送一次 keepalive
+KEEPALIVE_INTERVAL = 30
+# 到期时间按该精度对齐, 同一时间段内到期的 session 一次发送
+KEEPALIVE_RESOLUTION = 1
+
+
+# 所有房间共用一个 keepalive 定时器 (最小堆), session 销毁后自动移除
+class KeepaliveScheduler:
+    def __init__(self, interval=KEEPALIVE_INTERVAL, resolution=KEEPALIVE_RESOLUTION):
+        self.interval = interval
+        self.resolution = resolution
+        # [(deadline, seq, key, session_id)]
+        self._heap = []
+        # {key: (JanusConnection, session_id)}
+        self._entries = {}
+        self._seq = itertools.count()
+        self._task = None
+        self._wakeup = None
+        self.sent = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, conn, session_id):
+        self._entries[key] = (conn, session_id)
+        self._push(key, session_id, time.time() + self.interval)
+
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_event_loop().create_task(self._run())
+        self._wakeup.set()
+
+    # 旧的堆节点在到期时被丢弃
+    def remove(self, key):
+        self._entries.pop(key, None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _push(self, key, session_id, deadline):
+        deadline = (int(deadline / self.resolution) + 1) * self.resolution
+        heapq.heappush(self._heap, (deadline, next(self._seq), key, session_id))
+
+    def _pop_due(self, now):
+        # {JanusConnection: [session_id]}
+        batches = {}
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            _, _, key, session_id = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != session_id:
+                continue
+            conn = entry[0]
+            batches.setdefault(conn, []).append(session_id)
+            self._push(key, session_id, now + self.interval)
+        return batches
+
+    async def _run(self):
+        while True:
+            # 清理已经移除的 session
+            while len(self._heap) > 0 and self._heap[0][2] not in self._entries:
+                heapq.heappop(self._heap)
+
+            self._wakeup.clear()
+            if len(self._heap) == 0:
+                await self._wakeup.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+
+            batches = self._pop_due(time.time())
+            await asyncio.gather(*[self._send(conn, ids) for conn, ids in batches.items()])
+
+    async def _send(self, conn, session_ids):
+        for session_id in session_ids:
+            try:
+                await conn.send({
+                    "janus": "keepalive",
+                    "session_id": session_id,
+                    "transaction": transaction_id()
+                })
+                self.sent += 1
+            except Exception as e:
+                logger.warning("Keepalive of session %s on %s failed: %s", session_id, conn.name, e)
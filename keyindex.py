@@ -0,0 +1,171 @@
+import os
+import asyncio
+
+import log
+
+logger = log.get_logger("keyindex")
+
+# 录制时写在 TS 文件旁边的关键帧索引, 每行一个关键帧的 pts (90kHz 时间戳);
+# smart cut 由 ffmpeg 按时间 seek, 不需要字节偏移 (旧格式 "<pts>,<字节偏移>" 仍可读取)
+INDEX_SUFFIX = ".keys"
+CLOCK = 90000
+PACKET_SIZE = 188
+# H.264 / H.265
+VIDEO_STREAM_TYPES = (0x1B, 0x24)
+# 跟随正在写入的文件时的读取间隔 (秒) 和每次读取的大小
+FOLLOW_INTERVAL = 1
+READ_SIZE = 256 * 1024
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+class KeyframeIndex:
+    def __init__(self, path, append=False):
+        self.path = path
+        self.count = 0
+        self._file = open(path, "a" if append else "w")
+
+    # 每条立即写入, 录制进程崩溃时已有的索引仍然可用
+    def add(self, pts):
+        self._file.write("{p}\n".format(p=pts))
+        self._file.flush()
+        self.count += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# 读取索引, 排序后的 [pts]; 没有索引时为 None
+def load(path):
+    try:
+        f = open(index_path(path), "r")
+    except OSError:
+        return None
+    entries = []
+    with f:
+        for line in f:
+            pts = line.strip().partition(",")[0]
+            try:
+                entries.append(int(pts))
+            except ValueError:
+                # 最后一行可能还没有写完
+                continue
+    if len(entries) == 0:
+        return None
+    entries.sort()
+    return entries
+
+
+def _pts(data, pos):
+    return (((data[pos] >> 1) & 0x07) << 30) | (data[pos + 1] << 22) | ((data[pos + 2] >> 1) << 15) | \
+        (data[pos + 3] << 7) | (data[pos + 4] >> 1)
+
+
+# 扫描 TS 包: 视频 PID 上带 random_access_indicator 的 PES 开头即为关键帧, 回调 pts
+class TsScanner:
+    def __init__(self, on_keyframe):
+        self.on_keyframe = on_keyframe
+        self.pmt_pid = None
+        self.video_pid = None
+        self._pending = b""
+
+    def feed(self, data):
+        if self._pending:
+            data = self._pending + data
+        pos = 0
+        end = len(data) - PACKET_SIZE
+        while pos <= end:
+            if data[pos] != 0x47:
+                # 失去同步, 找下一个同步字节
+                pos = data.find(b"\x47", pos + 1)
+                if pos < 0:
+                    pos = len(data)
+                continue
+            if data[pos + 1] & 0x40:
+                self._packet(data, pos)
+            pos += PACKET_SIZE
+        self._pending = bytes(data[pos:])
+
+    # 只需要看 payload_unit_start 的包
+    def _packet(self, data, pos):
+        pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+        control = (data[pos + 3] >> 4) & 0x03
+        payload = pos + 4
+        random_access = False
+        if control & 0x02:
+            length = data[payload]
+            random_access = length > 0 and data[payload + 1] & 0x40 != 0
+            payload += 1 + length
+        if not control & 0x01 or payload >= pos + PACKET_SIZE:
+            return
+
+        if pid == self.video_pid:
+            if random_access and payload + 14 <= pos + PACKET_SIZE and data[payload:payload + 3] == b"\x00\x00\x01" \
+                    and data[payload + 7] & 0x80:
+                self.on_keyframe(_pts(data, payload + 9))
+        elif pid == 0 or pid == self.pmt_pid:
+            self._table(data, pos, pid, payload + 1 + data[payload])
+
+    def _table(self, data, pos, pid, section):
+        if section + 12 > pos + PACKET_SIZE:
+            return
+        # 不含 CRC, 只解析在这个包里的部分
+        section_end = min(section + 3 + (((data[section + 1] & 0x0F) << 8) | data[section + 2]) - 4,
+                          pos + PACKET_SIZE)
+        if pid == 0:
+            # 第一个节目的 PMT
+            for p in range(section + 8, section_end - 3, 4):
+                if (data[p] << 8) | data[p + 1] != 0:
+                    self.pmt_pid = ((data[p + 2] & 0x1F) << 8) | data[p + 3]
+                    break
+        else:
+            p = section + 12 + (((data[section + 10] & 0x0F) << 8) | data[section + 11])
+            while p + 5 <= section_end:
+                if data[p] in VIDEO_STREAM_TYPES:
+                    self.video_pid = ((data[p + 1] & 0x1F) << 8) | data[p + 2]
+                    break
+                p += 5 + (((data[p + 3] & 0x0F) << 8) | data[p + 4])
+
+
+# 跟随录制进程正在写入的文件建立索引, 进程退出后读完剩余的数据再结束
+async def follow(path, running, interval=FOLLOW_INTERVAL, room=None):
+    index = KeyframeIndex(index_path(path))
+    scanner = TsScanner(index.add)
+    loop = asyncio.get_event_loop()
+    f = None
+
+    def scan():
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return
+            scanner.feed(data)
+
+    try:
+        while True:
+            alive = running()
+            if f is None and os.path.isfile(path):
+                f = open(path, "rb")
+            if f is not None:
+                # 读取和扫描在线程池中执行, 不阻塞事件循环
+                await loop.run_in_executor(None, scan)
+            if not alive:
+                break
+            await asyncio.sleep(interval)
+    except (OSError, IndexError) as e:
+        log.with_room(logger, room).warning("Index keyframes of %s failed: %s", path, e)
+    finally:
+        if f is not None:
+            f.close()
+        index.close()
+    log.with_room(logger, room).debug("Indexed %d keyframes of %s", index.count, path)
+    return index.count
@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+
+from pathlib import Path
+
+ROOT = "accrecorder"
+FORMAT = "%(asctime)s %(levelname)s %(name)s [room=%(room)s] %(message)s"
+
+# 高频事件 (media/slowlink 等) 每个 key 每秒最多输出的条数
+RATE = 5
+RATE_PER = 1.0
+
+
+def get_logger(name):
+    return logging.getLogger(ROOT + "." + name)
+
+
+# 带房间上下文的 logger
+def with_room(logger, room):
+    return RoomAdapter(logger, {"room": room})
+
+
+class RoomAdapter(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        extra = kwargs.get("extra")
+        if extra is None:
+            kwargs["extra"] = self.extra
+        else:
+            kwargs["extra"] = dict(self.extra, **extra)
+        return msg, kwargs
+
+
+# 保证所有日志都有 room 字段
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, "room"):
+            record.room = "-"
+        return True
+
+
+# 带 rate_key 的日志按 key 做令牌桶限流, 被丢弃的条数在下一条输出时附带
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=RATE, per=RATE_PER):
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        # {key: [tokens, last, suppressed]}
+        self._buckets = {}
+
+    def filter(self, record):
+        key = getattr(record, "rate_key", None)
+        if key is None or self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.rate, now, 0]
+            self._buckets[key] = bucket
+        else:
+            bucket[0] = min(self.rate, bucket[0] + (now - bucket[1]) * self.rate / self.per)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2] > 0:
+            record.msg = str(record.msg) + " (+{n} similar suppressed)".format(n=bucket[2])
+            bucket[2] = 0
+        return True
+
+
+def setup(level="INFO", rate=RATE, path=None):
+    if path is not None:
+        Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+        handler = logging.FileHandler(path)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(rate=rate))
+
+    logger = logging.getLogger(ROOT)
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+
+# ffmpeg 的输出写入房间目录下的 logs/<name>.log
+def ffmpeg_log_path(folder, name):
+    logs = os.path.join(folder, "logs")
+    Path(logs).mkdir(parents=True, exist_ok=True)
+    return os.path.join(logs, name + ".log")
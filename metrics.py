@@ -0,0 +1,148 @@
+import functools
+import time
+
+from janus import PORT_POOL
+from scheduler import SCHEDULER
+
+# 后期处理各阶段耗时的分桶 (秒)
+STAGE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{k}="{v}"'.format(k=k, v=str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+def _header(name, help, kind):
+    return ["# HELP {n} {h}".format(n=name, h=help), "# TYPE {n} {k}".format(n=name, k=kind)]
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        # {((label, value), ...): count}
+        self._values = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def render(self):
+        lines = _header(self.name, self.help, "counter")
+        for key, value in self._values.items():
+            lines.append("{n}{l} {v}".format(n=self.name, l=_labels(key), v=value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # {labels: [bucket counts..., sum, count]}
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        data = self._values.get(key)
+        if data is None:
+            data = [0] * (len(self.buckets) + 2)
+            self._values[key] = data
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[i] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def render(self):
+        lines = _header(self.name, self.help, "histogram")
+        for key, data in self._values.items():
+            for i, bound in enumerate(self.buckets):
+                lines.append("{n}_bucket{l} {v}".format(n=self.name, l=_labels(key + (("le", bound),)), v=data[i]))
+            lines.append("{n}_bucket{l} {v}".format(n=self.name, l=_labels(key + (("le", "+Inf"),)), v=data[-1]))
+            lines.append("{n}_sum{l} {v}".format(n=self.name, l=_labels(key), v=round(data[-2], 6)))
+            lines.append("{n}_count{l} {v}".format(n=self.name, l=_labels(key), v=data[-1]))
+        return lines
+
+
+STAGE_SECONDS = Histogram("accrecorder_processing_stage_seconds",
+                          "Duration of post-processing stages", STAGE_BUCKETS)
+JOBS_TOTAL = Counter("accrecorder_processing_jobs_total", "Finished post-processing jobs by result")
+UPLOADS_TOTAL = Counter("accrecorder_uploads_total", "Recordings uploaded to the object store")
+UPLOAD_BYTES = Counter("accrecorder_upload_bytes_total", "Bytes sent to the object store")
+
+
+# 统计 RecordFile 某个阶段的耗时
+def timed(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                STAGE_SECONDS.observe(time.monotonic() - start, stage=stage)
+        return wrapper
+    return decorator
+
+
+def _gauge(name, help, samples):
+    lines = _header(name, help, "gauge")
+    for labels, value in samples:
+        lines.append("{n}{l} {v}".format(n=name, l=_labels(tuple(sorted(labels.items()))), v=value))
+    return lines
+
+
+def _counter(name, help, samples):
+    lines = _header(name, help, "counter")
+    for labels, value in samples:
+        lines.append("{n}{l} {v}".format(n=name, l=_labels(tuple(sorted(labels.items()))), v=value))
+    return lines
+
+
+# Prometheus text format
+def render(ws):
+    stats = ws.stats()
+    lines = []
+    lines += _gauge("accrecorder_janus_sessions", "Janus sessions by status",
+                    [({"status": k}, v) for k, v in stats["janus_sessions"].items()])
+    lines += _gauge("accrecorder_record_sessions", "Publisher record sessions by status",
+                    [({"status": k}, v) for k, v in stats["record_sessions"].items()])
+    lines += _gauge("accrecorder_ffmpeg_processes", "Live ffmpeg recorder processes",
+                    [({"kind": "recorder"}, stats["recorders"]), ({"kind": "compositor"}, stats["compositors"])])
+    lines += _gauge("accrecorder_processing_jobs", "Post-processing jobs in the queue",
+                    [({"state": "pending"}, stats["jobs_pending"]), ({"state": "running"}, stats["jobs_running"])])
+    lines += STAGE_SECONDS.render()
+    lines += JOBS_TOTAL.render()
+    lines += UPLOADS_TOTAL.render()
+    lines += UPLOAD_BYTES.render()
+    lines += _gauge("accrecorder_room_bytes", "Bytes written by the active recordings of a room",
+                    [({"room": room}, size) for room, size in stats["room_bytes"].items()])
+    lines += _gauge("accrecorder_rtp_ports", "RTP ports of the pool",
+                    [({"state": "in_use"}, PORT_POOL.in_use), ({"state": "capacity"}, PORT_POOL.capacity)])
+    lines += _gauge("accrecorder_rtp_port_usage_ratio", "Share of the RTP port pool in use", [({}, PORT_POOL.usage())])
+    lines += _gauge("accrecorder_encoder_threads", "Encoder threads of the ffmpeg scheduler",
+                    [({"state": "in_use"}, SCHEDULER.in_use), ({"state": "budget"}, SCHEDULER.budget)])
+    lines += _gauge("accrecorder_encoder_jobs_waiting", "Encoder jobs waiting for threads", [({}, SCHEDULER.queued)])
+    lines += _gauge("accrecorder_ffmpeg_bitrate_kbps", "Output bitrate reported by each live ffmpeg process",
+                    [({"process": p["key"], "room": p["room"]}, p["bitrate"]) for p in stats["ffmpeg"]
+                     if p["bitrate"] is not None])
+    lines += _gauge("accrecorder_ffmpeg_stalled", "Live ffmpeg processes without progress",
+                    [({}, len([p for p in stats["ffmpeg"] if p["stalled"]]))])
+    lines += _counter("accrecorder_ffmpeg_crashes_total", "Live ffmpeg processes that exited unexpectedly",
+                      [({}, stats["ffmpeg_crashes"])])
+    lines += _gauge("accrecorder_keepalive_sessions", "Sessions served by the keepalive scheduler",
+                    [({}, stats["keepalives"])])
+
+    shards = stats["shards"]
+    lines += _gauge("accrecorder_janus_shard_rooms", "Rooms placed on each Janus connection",
+                    [({"server": s["server"], "socket": s["socket"]}, s["rooms"]) for s in shards])
+    lines += _counter("accrecorder_janus_messages_total", "Websocket messages per Janus connection",
+                      [({"server": s["server"], "socket": s["socket"], "direction": "sent"}, s["sent"])
+                       for s in shards] +
+                      [({"server": s["server"], "socket": s["socket"], "direction": "received"}, s["received"])
+                       for s in shards])
+    return "\n".join(lines) + "\n"
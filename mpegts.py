@@ -0,0 +1,182 @@
+import struct
+
+# MPEG-TS 封装, 只支持一路 H.264 视频和一路 Opus 音频
+PACKET_SIZE = 188
+PAYLOAD_SIZE = 184
+PMT_PID = 0x1000
+VIDEO_PID = 0x100
+AUDIO_PID = 0x101
+STREAM_TYPE_H264 = 0x1B
+STREAM_TYPE_PRIVATE = 0x06
+# PTS 比 PCR 提前的时间 (90kHz), 给播放器留出缓冲
+PTS_DELAY = 63000
+# 每个视频访问单元前的 Access Unit Delimiter
+AUD = b"\x00\x00\x00\x01\x09\xf0"
+# Opus: registration descriptor "Opus" + extension descriptor (channel_config_code)
+OPUS_DESCRIPTORS = b"\x05\x04Opus\x7f\x02\x80"
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def crc32(data):
+    crc = 0xFFFFFFFF
+    for b in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[((crc >> 24) ^ b) & 0xFF]
+    return crc
+
+
+def _timestamp(value, prefix=0x2):
+    value &= 0x1FFFFFFFF
+    return bytes([
+        (prefix << 4) | ((value >> 29) & 0x0E) | 1,
+        (value >> 22) & 0xFF,
+        ((value >> 14) & 0xFE) | 1,
+        (value >> 7) & 0xFF,
+        ((value << 1) & 0xFE) | 1,
+    ])
+
+
+def _pcr(base):
+    base &= 0x1FFFFFFFF
+    return bytes([(base >> 25) & 0xFF, (base >> 17) & 0xFF, (base >> 9) & 0xFF, (base >> 1) & 0xFF,
+                  ((base & 1) << 7) | 0x7E, 0x00])
+
+
+def _section(table_id, table_ext, body):
+    length = 5 + len(body) + 4
+    section = bytes([table_id, 0xB0 | (length >> 8), length & 0xFF, table_ext >> 8, table_ext & 0xFF,
+                     0xC1, 0x00, 0x00]) + body
+    return section + struct.pack(">I", crc32(section))
+
+
+# 按到达顺序写入访问单元, 文件可以在写入过程中被读取
+class TsWriter:
+    # index: 关键帧索引 (keyindex.KeyframeIndex), 为 None 时不记录
+    def __init__(self, path, video=True, audio=False, channels=2, index=None):
+        assert video or audio
+        self.path = path
+        self.index = index
+        self.video = video
+        self.audio = audio
+        self.pcr_pid = VIDEO_PID if video else AUDIO_PID
+        self.size = 0
+        self._file = open(path, "wb")
+        self._cc = {0: 0, PMT_PID: 0, VIDEO_PID: 0, AUDIO_PID: 0}
+        # 所有 TS 包先写入这个缓冲, 每个访问单元一次 write
+        self._out = bytearray()
+
+        streams = b""
+        if video:
+            streams += bytes([STREAM_TYPE_H264, 0xE0 | (VIDEO_PID >> 8), VIDEO_PID & 0xFF, 0xF0, 0x00])
+        if audio:
+            descriptors = OPUS_DESCRIPTORS + bytes([channels])
+            streams += bytes([STREAM_TYPE_PRIVATE, 0xE0 | (AUDIO_PID >> 8), AUDIO_PID & 0xFF,
+                              0xF0, len(descriptors)]) + descriptors
+        self._pat = _section(0x00, 1, bytes([0x00, 0x01, 0xE0 | (PMT_PID >> 8), PMT_PID & 0xFF]))
+        self._pmt = _section(0x02, 1, bytes([0xE0 | (self.pcr_pid >> 8), self.pcr_pid & 0xFF, 0xF0, 0x00]) + streams)
+        self._tables_written = False
+
+    def _next_cc(self, pid):
+        cc = self._cc[pid]
+        self._cc[pid] = (cc + 1) & 0x0F
+        return cc
+
+    def _write_table(self, pid, section):
+        out = self._out
+        out += bytes([0x47, 0x40 | (pid >> 8), pid & 0xFF, 0x10 | self._next_cc(pid), 0x00])
+        out += section
+        out += b"\xff" * (PAYLOAD_SIZE - 1 - len(section))
+
+    def _write_tables(self):
+        self._write_table(0, self._pat)
+        self._write_table(PMT_PID, self._pmt)
+        self._tables_written = True
+
+    # 把一个 PES 切成 TS 包, 最后一个包用 adaptation field 填充
+    def _write_pes(self, pid, pes, pcr=None, random_access=False):
+        out = self._out
+        view = memoryview(pes)
+        total = len(pes)
+        pos = 0
+        first = True
+        while pos < total:
+            af = b""
+            if first and (pcr is not None or random_access):
+                af = bytes([(0x40 if random_access else 0) | (0x10 if pcr is not None else 0)])
+                if pcr is not None:
+                    af += _pcr(pcr)
+            af_total = 1 + len(af) if af else 0
+            space = PAYLOAD_SIZE - af_total
+            remaining = total - pos
+            if remaining < space:
+                stuffing = space - remaining
+                if af_total == 0 and stuffing > 1:
+                    af = b"\x00" + b"\xff" * (stuffing - 2)
+                elif af_total > 0:
+                    af += b"\xff" * stuffing
+                af_total += stuffing
+                space = remaining
+
+            out += bytes([0x47, (0x40 if first else 0) | (pid >> 8), pid & 0xFF,
+                          (0x30 if af_total else 0x10) | self._next_cc(pid)])
+            if af_total:
+                out.append(af_total - 1)
+                out += af
+            out += view[pos:pos + space]
+            pos += space
+            first = False
+
+    def _flush(self):
+        self._file.write(self._out)
+        self.size += len(self._out)
+        self._out.clear()
+
+    # pts 为 90kHz 时间戳, data 为 Annex-B 格式的一帧
+    def write_video(self, pts, data, key=False):
+        # 关键帧前写 PAT/PMT, 从这里开始读取的数据可以独立解码
+        if key and self.index is not None:
+            self.index.add((pts + PTS_DELAY) & 0x1FFFFFFFF)
+        if key or not self._tables_written:
+            self._write_tables()
+        header = b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05" + _timestamp(pts + PTS_DELAY)
+        pes = bytearray(header)
+        pes += AUD
+        pes += data
+        self._write_pes(VIDEO_PID, pes, pcr=pts if self.pcr_pid == VIDEO_PID else None, random_access=key)
+        self._flush()
+
+    # 一个 Opus 包, 前面加上 opus_control_header
+    def write_audio(self, pts, data):
+        if not self._tables_written:
+            self._write_tables()
+        size = len(data)
+        control = bytearray(b"\x7f\xe0")
+        while size >= 255:
+            control.append(0xFF)
+            size -= 255
+        control.append(size)
+        length = 3 + 5 + len(control) + len(data)
+        pes = bytearray(b"\x00\x00\x01\xbd" + struct.pack(">H", length) + b"\x84\x80\x05" + _timestamp(pts + PTS_DELAY))
+        pes += control
+        pes += data
+        self._write_pes(AUDIO_PID, pes, pcr=pts if self.pcr_pid == AUDIO_PID else None, random_access=True)
+        self._flush()
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._flush()
+            self._file.close()
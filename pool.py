@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import bisect
+import hashlib
+import random
+import string
+
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+import events
+import log
+from janus import JanusError, JanusTimeout
+
+logger = log.get_logger("pool")
+
+# 等待 Janus 响应的超时时间 (秒)
+REQUEST_TIMEOUT = 10
+# 一致性哈希每个连接的虚拟节点数
+REPLICAS = 64
+
+
+# Random Transaction ID
+def transaction_id():
+    return "".join(random.choice(string.ascii_letters) for x in range(12))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+# 到某个 Janus 网关的一条 websocket 连接
+class JanusConnection:
+    def __init__(self, server, index, on_message):
+        self.server = server
+        self.index = index
+        self.conn = None
+        self.rooms = set()
+        self.sent = 0
+        self.received = 0
+        # {transaction: (Future, ack 是否为最终响应)}
+        self._pending = {}
+        self._on_message = on_message
+
+    @property
+    def name(self):
+        return "{s}#{i}".format(s=self.server, i=self.index)
+
+    async def connect(self):
+        self.conn = await websockets.connect(self.server, subprotocols=['janus-protocol'])
+
+    async def close(self):
+        if self.conn is not None:
+            await self.conn.close()
+
+    async def send(self, message):
+        self.sent += 1
+        await self.conn.send(events.dumps(message))
+
+    # 发送请求并等待同一个 transaction 的响应
+    async def request(self, message, ack=False, timeout=REQUEST_TIMEOUT):
+        transaction = transaction_id()
+        message["transaction"] = transaction
+        future = asyncio.get_event_loop().create_future()
+        self._pending[transaction] = (future, ack)
+        try:
+            await self.send(message)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise JanusTimeout("{j} request {t} to {n} timed out".format(j=message["janus"], t=transaction, n=self.name))
+        finally:
+            self._pending.pop(transaction, None)
+
+    # 处理等待中的请求, 返回 True 表示该消息已经被请求方接收
+    def _resolve(self, raw):
+        transaction = raw.get("transaction")
+        if transaction is None or transaction not in self._pending:
+            return False
+        future, ack = self._pending[transaction]
+        janus = raw["janus"]
+        # 异步请求先返回 ack, 之后的 event 才是结果
+        if janus == "ack" and not ack:
+            return True
+        if future.done():
+            return True
+        if janus == "error":
+            error = raw.get("error", {})
+            future.set_exception(JanusError(error.get("code"), error.get("reason")))
+        else:
+            future.set_result(raw)
+        return True
+
+    def fail_pending(self, e):
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(JanusError(None, str(e)))
+        self._pending.clear()
+
+    async def run(self):
+        while True:
+            try:
+                raw = events.loads(await self.conn.recv())
+            except ConnectionClosed as e:
+                logger.warning("Connection %s closed: %s", self.name, e)
+                self.fail_pending(e)
+                return
+            self.received += 1
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received from %s: %s", self.name, raw)
+            if not self._resolve(raw):
+                await self._on_message(self, raw)
+
+
+# 多个 Janus 网关, 每个网关多条连接, 房间按一致性哈希分配到连接上
+class ConnectionPool:
+    def __init__(self, servers, on_message, sockets=1, replicas=REPLICAS):
+        self.connections = [JanusConnection(server, i, on_message) for server in servers for i in range(sockets)]
+        self._ring = []
+        for conn in self.connections:
+            for r in range(replicas):
+                self._ring.append((_hash("{n}-{r}".format(n=conn.name, r=r)), conn))
+        self._ring.sort(key=lambda x: x[0])
+        self._keys = [h for h, _ in self._ring]
+        # {room: JanusConnection}, 房间的 Janus session 只在创建它的网关上有效
+        self._rooms = {}
+
+    async def connect(self):
+        await asyncio.gather(*[conn.connect() for conn in self.connections])
+
+    async def close(self):
+        await asyncio.gather(*[conn.close() for conn in self.connections], return_exceptions=True)
+
+    async def run(self):
+        await asyncio.gather(*[conn.run() for conn in self.connections])
+
+    def connection(self, room) -> JanusConnection:
+        conn = self._rooms.get(room)
+        if conn is None:
+            index = bisect.bisect(self._keys, _hash(str(room))) % len(self._ring)
+            conn = self._ring[index][1]
+            self._rooms[room] = conn
+            conn.rooms.add(room)
+        return conn
+
+    def release(self, room):
+        conn = self._rooms.pop(room, None)
+        if conn is not None:
+            conn.rooms.discard(room)
+
+    def load(self):
+        return [{
+            "server": conn.server,
+            "socket": conn.index,
+            "rooms": len(conn.rooms),
+            "pending": len(conn._pending),
+            "sent": conn.sent,
+            "received": conn.received,
+        } for conn in self.connections]
@@ -0,0 +1,119 @@
+import os
+import socket
+import time
+
+from collections import deque
+import log
+
+logger = log.get_logger("ports")
+
+
+class PortExhausted(Exception):
+    pass
+
+
+# 端口租约, pid 为使用该端口的录制进程, 进程退出后端口可以回收
+class PortLease:
+    def __init__(self, port, owner=None, ttl=None):
+        self.port = port
+        self.owner = owner
+        self.pid = None
+        self.expires = time.time() + ttl if ttl else None
+
+    def expired(self, now):
+        if self.expires is not None and now > self.expires:
+            return True
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                return False
+        return False
+
+
+# RTP 端口池: 偶数端口给 RTP, 紧跟的奇数端口留给 RTCP
+class PortPool:
+    def __init__(self, start=20002, end=50000, host="0.0.0.0", probe=True):
+        self.host = host
+        self.probe = probe
+        self._leases = {}
+        self._free = deque()
+        self.configure(start, end)
+
+    def configure(self, start, end):
+        assert len(self._leases) == 0, "port pool is in use"
+        start = start + start % 2
+        assert 0 < start < end <= 65535
+        self.start = start
+        self.end = end
+        self._free = deque(range(start, end - 1, 2))
+
+    @property
+    def capacity(self):
+        return len(self._free) + len(self._leases)
+
+    @property
+    def in_use(self):
+        return len(self._leases)
+
+    def usage(self):
+        if self.capacity == 0:
+            return 1.0
+        return self.in_use / self.capacity
+
+    def leases(self):
+        return list(self._leases.values())
+
+    # 分配一对 RTP/RTCP 端口, 返回 RTP 端口
+    def acquire(self, owner=None, ttl=None):
+        if len(self._free) == 0:
+            self.reclaim()
+
+        # 被其他进程占用的端口放到队尾, 之后再试
+        for _ in range(len(self._free)):
+            port = self._free.popleft()
+            if self.probe and not self._bindable(port):
+                self._free.append(port)
+                continue
+            self._leases[port] = PortLease(port, owner=owner, ttl=ttl)
+            return port
+
+        raise PortExhausted("no free RTP port in {s}-{e}".format(s=self.start, e=self.end))
+
+    def release(self, port):
+        lease = self._leases.pop(port, None)
+        if lease is not None:
+            self._free.append(port)
+        return lease is not None
+
+    def bind(self, port, pid):
+        lease = self._leases.get(port)
+        if lease is not None:
+            lease.pid = pid
+
+    def renew(self, port, ttl):
+        lease = self._leases.get(port)
+        if lease is not None:
+            lease.expires = time.time() + ttl
+
+    # 回收过期或者录制进程已经退出的端口
+    def reclaim(self):
+        now = time.time()
+        dead = [port for port, lease in self._leases.items() if lease.expired(now)]
+        for port in dead:
+            logger.warning("Reclaim RTP port %d of %s", port, self._leases[port].owner)
+            self.release(port)
+        return len(dead)
+
+    def _bindable(self, port):
+        for p in (port, port + 1):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                s.bind((self.host, p))
+            except OSError:
+                return False
+            finally:
+                s.close()
+        return True
@@ -0,0 +1,195 @@
+import asyncio
+import bisect
+import collections
+import json
+import os
+
+import keyindex
+import log
+
+logger = log.get_logger("probe")
+
+# 探测结果写在媒体文件旁边, 文件大小或者修改时间变化后失效
+CACHE_SUFFIX = ".probe.json"
+CACHE_VERSION = 2
+# 内存中最多缓存的文件数
+CACHE_SIZE = 256
+
+STREAM_ENTRIES = "index,codec_type,codec_name,profile,level,pix_fmt,width,height,r_frame_rate,sample_rate,channels," \
+                 "start_time"
+
+
+class ProbeError(Exception):
+    pass
+
+
+async def run_ffprobe(args):
+    cmd = ['ffprobe', '-v', 'error'] + list(args)
+    proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE)
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise ProbeError("ffprobe exited with code {c}: {a}".format(c=proc.returncode, a=" ".join(cmd)))
+    return out.decode()
+
+
+def _float(value, default=None):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# 一个媒体文件的探测结果
+class MediaInfo:
+    def __init__(self, path, size, mtime, duration=None, start_time=0.0, streams=None, keyframes=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        # 时长和第一个 PTS (秒)
+        self.duration = duration
+        self.start_time = start_time
+        # [{"codec_type", "codec_name", "width", ...}]
+        self.streams = streams or []
+        # 视频关键帧时间, 相对 start_time (秒), 升序; None 为还没有读取
+        self.keyframes = keyframes
+
+    def matches(self, stat):
+        return self.size == stat.st_size and self.mtime == stat.st_mtime
+
+    def video(self):
+        return next(filter(lambda s: s.get("codec_type") == "video", self.streams), None)
+
+    def audio(self):
+        return next(filter(lambda s: s.get("codec_type") == "audio", self.streams), None)
+
+    # 不晚于 t 的最后一个关键帧, 没有时为 None
+    def keyframe_before(self, t):
+        index = bisect.bisect_right(self.keyframes, t) - 1
+        return self.keyframes[index] if index >= 0 else None
+
+    # 不早于 t 的第一个关键帧, 没有时为 None
+    def keyframe_after(self, t):
+        index = bisect.bisect_left(self.keyframes, t)
+        return self.keyframes[index] if index < len(self.keyframes) else None
+
+    def to_dict(self):
+        return {"version": CACHE_VERSION, "size": self.size, "mtime": self.mtime, "duration": self.duration,
+                "start_time": self.start_time, "streams": self.streams, "keyframes": self.keyframes}
+
+    @classmethod
+    def from_dict(cls, path, data):
+        if data.get("version") != CACHE_VERSION:
+            return None
+        return cls(path, data["size"], data["mtime"], data["duration"], data["start_time"], data["streams"],
+                   data["keyframes"])
+
+
+# {path: MediaInfo}, 最近使用的在最后
+_cache = collections.OrderedDict()
+
+
+def _remember(info: MediaInfo):
+    _cache[info.path] = info
+    _cache.move_to_end(info.path)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _load(path, stat):
+    info = _cache.get(path)
+    if info is not None and info.matches(stat):
+        _cache.move_to_end(path)
+        return info
+    try:
+        with open(path + CACHE_SUFFIX, "r") as f:
+            info = MediaInfo.from_dict(path, json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+    if info is None or not info.matches(stat):
+        return None
+    _remember(info)
+    return info
+
+
+def _save(info: MediaInfo):
+    _remember(info)
+    tmp = info.path + CACHE_SUFFIX + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(info.to_dict(), f)
+        os.replace(tmp, info.path + CACHE_SUFFIX)
+    except OSError as e:
+        logger.warning("Write probe cache of %s failed: %s", info.path, e)
+
+
+async def _probe_format(path, stat):
+    out = await run_ffprobe(['-show_entries', 'format=duration,start_time:stream=' + STREAM_ENTRIES,
+                             '-of', 'json', path])
+    try:
+        data = json.loads(out)
+    except ValueError:
+        raise ProbeError("ffprobe returned invalid json for {p}".format(p=path))
+    fmt = data.get("format", {})
+    streams = [{k: v for k, v in s.items() if k != "disposition" and k != "tags"} for s in data.get("streams", [])]
+    return MediaInfo(path, stat.st_size, stat.st_mtime, duration=_float(fmt.get("duration")),
+                     start_time=_float(fmt.get("start_time"), 0.0), streams=streams)
+
+
+# 只读取 packet 不解码, 需要读完整个文件
+async def _probe_keyframes(path, base):
+    out = await run_ffprobe(['-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+                             '-of', 'csv=p=0', path])
+    frames = []
+    for line in out.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" not in flags:
+            continue
+        try:
+            frames.append(round(float(pts) - base, 6))
+        except ValueError:
+            continue
+    frames.sort()
+    return frames
+
+
+# 文件的探测结果, 优先使用缓存; with_keyframes 时同时读取关键帧索引
+async def info(path, with_keyframes=False):
+    stat = os.stat(path)
+    media = _load(path, stat)
+    if media is None:
+        media = await _probe_format(path, stat)
+        if not with_keyframes:
+            _save(media)
+    if with_keyframes and media.keyframes is None:
+        # 录制时写的关键帧索引, 不需要扫描整个文件
+        entries = keyindex.load(path)
+        if entries is not None:
+            media.keyframes = [round(pts / keyindex.CLOCK - media.start_time, 6) for pts in entries]
+        else:
+            media.keyframes = await _probe_keyframes(path, media.start_time)
+        _save(media)
+    return media
+
+
+# 已知文件的关键帧 (例如由拼接前的文件换算) 时直接写入缓存
+async def store_keyframes(path, keyframes):
+    media = await info(path)
+    media.keyframes = sorted(keyframes)
+    _save(media)
+    return media
+
+
+# 文件的起始时间 (秒)
+async def start_time(path):
+    return (await info(path)).start_time
+
+
+# 文件时长 (秒), 读取不到时为 None
+async def duration(path):
+    return (await info(path)).duration
+
+
+# 视频关键帧时间列表, 相对文件起始时间 (秒)
+async def keyframes(path):
+    return (await info(path, with_keyframes=True)).keyframes
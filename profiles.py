@@ -0,0 +1,55 @@
+# x264 编码配置, 后期处理根据队列长度和任务截止时间自动选择
+
+# 任务从停止录制到处理完成的默认期限 (秒)
+DEADLINE = 3600
+# 排队任务数达到 worker 数的这个倍数时, 不再使用更慢的配置
+BALANCED_QUEUE = 1
+THROUGHPUT_QUEUE = 3
+# 预估耗时的平滑系数
+RATE_SMOOTHING = 0.3
+
+
+class EncoderProfile:
+    def __init__(self, name, preset, crf, gop, threads=None, rate=1.0):
+        self.name = name
+        self.preset = preset
+        self.crf = crf
+        # 关键帧间隔 (帧)
+        self.gop = gop
+        # 每个 ffmpeg 的线程数, None 时使用调度器的默认值
+        self.threads = threads
+        # 处理每秒媒体需要的时间 (秒), 初始为估计值, 之后按实际任务更新
+        self.rate = rate
+
+    def x264(self):
+        return ['-codec:v', 'libx264', '-crf', str(self.crf), '-preset', self.preset, '-g', str(self.gop)]
+
+    def observe(self, media_seconds, elapsed):
+        if media_seconds <= 0:
+            return
+        self.rate += RATE_SMOOTHING * (elapsed / media_seconds - self.rate)
+
+
+QUALITY = EncoderProfile("quality", "slow", 16, 250, rate=0.8)
+BALANCED = EncoderProfile("balanced", "fast", 17, 250, rate=0.3)
+# 积压时每个任务少用线程, 多个任务并行的总吞吐更高; 关键帧更少, 编码更快
+THROUGHPUT = EncoderProfile("throughput", "veryfast", 21, 500, threads=2, rate=0.12)
+
+PROFILES = {p.name: p for p in (QUALITY, BALANCED, THROUGHPUT)}
+AUTO = "auto"
+
+
+# 在截止时间内能完成的最高质量配置
+# waited: 任务已经等待的时间, backlog: 还在排队的任务数, workers: 并行的 worker 数
+def select(media_seconds, waited, backlog, workers, deadline=DEADLINE):
+    workers = max(1, workers)
+    if backlog >= workers * THROUGHPUT_QUEUE:
+        return THROUGHPUT
+    candidates = [BALANCED, THROUGHPUT] if backlog >= workers * BALANCED_QUEUE else [QUALITY, BALANCED, THROUGHPUT]
+
+    for profile in candidates:
+        cost = media_seconds * profile.rate
+        # 任务自己的期限, 以及排队的任务按同样的配置估计的完成时间
+        if cost <= deadline - waited and (backlog / workers + 1) * cost <= deadline:
+            return profile
+    return THROUGHPUT
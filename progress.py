@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+# 只拷贝不编码的阶段相对编码的耗时权重
+COPY_WEIGHT = 0.05
+
+
+# 读取 ffmpeg -progress 的输出, 每个进度块结束时回调已输出的媒体时长 (秒)
+async def read_ffmpeg_progress(stream, callback):
+    out_time = None
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        key, _, value = line.decode(errors="ignore").strip().partition("=")
+        # 老版本的 out_time_ms 实际上也是微秒
+        if key in ("out_time_us", "out_time_ms"):
+            try:
+                out_time = int(value) / 1000000
+            except ValueError:
+                pass
+        elif key == "progress" and out_time is not None:
+            callback(out_time)
+
+
+# 一个 RecordFile 后期处理的进度: 每个阶段的媒体时长和已完成的时长, 按权重计算整体进度
+class ProcessingProgress:
+    def __init__(self):
+        # {stage: [done, total, weight]}, 按执行顺序
+        self.stages = {}
+        self.stage = None
+        self.started = None
+        self.finished = False
+        self._listeners = set()
+
+    # stages: [(stage, 媒体时长, 权重)]
+    def plan(self, stages):
+        self.stages = {name: [0.0, float(total), weight] for name, total, weight in stages}
+        if self.started is None:
+            self.started = time.monotonic()
+        self._notify()
+
+    # 返回一个 ffmpeg 的进度回调, 同一阶段可以有多个 ffmpeg 并行
+    def tracker(self, stage):
+        last = [0.0]
+
+        def update(out_time):
+            delta = out_time - last[0]
+            if delta <= 0:
+                return
+            last[0] = out_time
+            entry = self.stages.setdefault(stage, [0.0, 0.0, 1.0])
+            entry[0] += delta
+            if entry[1] > 0:
+                entry[0] = min(entry[0], entry[1])
+            self.stage = stage
+            self._notify()
+        return update
+
+    def complete(self, stage):
+        entry = self.stages.get(stage)
+        if entry is not None:
+            entry[0] = entry[1]
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        for entry in self.stages.values():
+            entry[0] = entry[1]
+        self._notify()
+
+    def fraction(self):
+        total = sum(t * w for _, t, w in self.stages.values())
+        if total <= 0:
+            return 1.0 if self.finished else 0.0
+        return min(1.0, sum(d * w for d, _, w in self.stages.values()) / total)
+
+    # 按目前的平均速度估计剩余时间 (秒)
+    def eta(self):
+        fraction = self.fraction()
+        if self.started is None or fraction <= 0:
+            return None
+        if fraction >= 1:
+            return 0
+        elapsed = time.monotonic() - self.started
+        return round(elapsed * (1 - fraction) / fraction, 1)
+
+    def snapshot(self):
+        return {
+            "stage": self.stage,
+            "percent": round(self.fraction() * 100, 1),
+            "eta": self.eta(),
+            "stages": {name: round(d / t * 100, 1) if t > 0 else 0.0 for name, (d, t, _) in self.stages.items()},
+        }
+
+    # 订阅进度变化, 队列中只保留最新的一次
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=1)
+        self._listeners.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._listeners.discard(queue)
+
+    def _notify(self):
+        if len(self._listeners) == 0:
+            return
+        snapshot = self.snapshot()
+        for queue in self._listeners:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(snapshot)
@@ -1,14 +1,116 @@
 import os
+import asyncio
 from posixpath import join
-import subprocess
 import signal
 
 from enum import Enum
 from typing import Iterator
-from janus import FILE_ROOT_PATH, SCREEN
+from janus import SCREEN
+import janus
+from scheduler import SCHEDULER
+import probe
+import keyindex
+import profiles
+from progress import ProcessingProgress, read_ffmpeg_progress, COPY_WEIGHT
+import timeline
+import log
+import metrics
 from pathlib import Path
 
 TIME_THRESHOLD = 3
+# 短于该值 (毫秒) 的渲染区间并入相邻区间, 避免切出过短的分段
+MIN_SPAN_MS = TIME_THRESHOLD * 1000
+
+logger = log.get_logger("recorder")
+
+# 后期处理模式: 先裁剪再合并 / 单次 filter_complex 编码
+PIPELINE_CUTS = "cuts"
+PIPELINE_SINGLE_PASS = "single_pass"
+PIPELINES = [PIPELINE_CUTS, PIPELINE_SINGLE_PASS]
+
+# 单次编码模式下所有分段统一的输出分辨率
+OUTPUT_WIDTH = 1920
+OUTPUT_HEIGHT = 1080
+FIT_OUTPUT = "scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2,setsar=1".format(
+    w=OUTPUT_WIDTH, h=OUTPUT_HEIGHT)
+PIP_OVERLAY = "overlay=main_w-overlay_w-10:main_h-overlay_h-10"
+
+# 实时画中画的编码速度与读取超时 (秒)
+LIVE_PIP_PRESET = "veryfast"
+LIVE_PIP_READ_TIMEOUT = 10
+
+# 分段录制时合并分段的读写缓冲大小
+CHUNK_COPY_SIZE = 1024 * 1024
+
+# 摄像头文件直接拷贝拼接时需要一致的流参数
+CONCAT_STREAM_KEYS = ("codec_type", "codec_name", "width", "height", "sample_rate", "channels")
+
+# smart cut: 关键帧间隔小于该值时整段重新编码
+SMART_CUT_MIN_COPY = 2
+# 与关键帧的距离小于该值时不再单独编码首尾
+SMART_CUT_EPSILON = 0.05
+# ffprobe 的 H.264 profile 对应的 x264 profile, WebRTC 一般为 Constrained Baseline
+X264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high"}
+
+
+class FFmpegError(Exception):
+    def __init__(self, args, code):
+        super().__init__("ffmpeg exited with code {c}: {a}".format(c=code, a=" ".join(args)))
+        self.args_list = args
+        self.code = code
+
+
+# 异步执行 ffmpeg, 不阻塞事件循环, ffmpeg 的输出写入 log_path
+# progress 不为 None 时从 stdout 读取 -progress 的输出, 回调已输出的媒体时长 (秒)
+async def _exec_ffmpeg(args, log_path=None, progress=None):
+    cmd = ['ffmpeg', '-nostdin', '-y'] + list(args)
+    stdout = asyncio.subprocess.DEVNULL
+    if progress is not None:
+        cmd = ['ffmpeg', '-nostdin', '-y', '-progress', 'pipe:1', '-nostats'] + list(args)
+        stdout = asyncio.subprocess.PIPE
+    stderr = open(log_path, "ab") if log_path is not None else asyncio.subprocess.DEVNULL
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.DEVNULL, stdout=stdout,
+                                                    stderr=stderr)
+        try:
+            if progress is not None:
+                await read_ffmpeg_progress(proc.stdout, progress)
+            code = await proc.wait()
+        except asyncio.CancelledError:
+            # 任务被取消时不留下孤儿进程
+            proc.kill()
+            await proc.wait()
+            raise
+    finally:
+        if log_path is not None:
+            stderr.close()
+    if code != 0:
+        raise FFmpegError(cmd, code)
+    return code
+
+
+# encode=True 的任务需要经过全局调度器, -threads 与分配到的线程数一致
+async def run_ffmpeg(args, encode=False, log_path=None, threads=None, progress=None):
+    if not encode:
+        return await _exec_ffmpeg(args, log_path, progress)
+
+    async def run(threads):
+        # -threads 作为输出参数, 放在输出文件之前
+        return await _exec_ffmpeg(list(args[:-1]) + ['-threads', str(threads), args[-1]], log_path, progress)
+
+    return await SCHEDULER.run(run, threads=threads)
+
+
+# 并行执行多个 ffmpeg 任务, 任意一个失败 (或者自身被取消) 时取消其余任务并等待其退出, 再抛出第一个异常
+async def gather_ffmpeg(*coros):
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 class RecordStatus(Enum):
     Defalut = 1
@@ -21,13 +123,24 @@ class RecordStatus(Enum):
     Failed = -1
 
 class MergeFile:
-    def __init__(self, begin, end, merge):
+    def __init__(self, begin, end, merge, screen=None):
+        # 在拼接后的摄像头文件中的位置 (秒), 只有屏幕时为 None
         self.begin = begin
         self.end = end
         self.merge = merge
+        # 这段时间使用的屏幕文件, 以及从屏幕文件中开始的位置 (秒)
+        self.screen: RecordSegment = screen
+        self.screen_offset = 0
+        # 会议时间 (毫秒)
+        self.begin_ms = None
+        self.end_ms = None
         self.name = None
         self.merged_name = None
 
+    @property
+    def duration(self):
+        return (self.end_ms - self.begin_ms) / 1000
+
 class RecordSegment:
     def __init__(self, name, room, publisher, begin_time, end_time=None):
         self.name = name
@@ -35,63 +148,281 @@ class RecordSegment:
         self.publisher = publisher
         self.begin_time = begin_time
         self.end_time = end_time
+        # 第一帧和最后一帧的时间 (毫秒), 由录制进程或者 ffprobe 给出, 没有时使用秒级时间
+        self.begin_ms = None
+        self.end_ms = None
         self.is_screen = int(publisher) == SCREEN
+        # 屏幕分享期间实时合成的画中画文件, 摄像头离开又加入时每次一个
+        self.composites = []
+        # 分段录制: segment muxer 的列表文件, 以及已经合并的分段 [(name, start, end)]
+        self.chunk_list = None
+        self.chunks = []
+        self._chunk_lock = None
+
+    def info(self):
+        return {"name": self.name, "publisher": self.publisher, "begin_time": self.begin_time,
+                "end_time": self.end_time, "begin_ms": self.begin_ms, "end_ms": self.end_ms,
+                "composites": [c.name for c in self.composites]}
+
+    def interval(self):
+        begin = self.begin_ms if self.begin_ms is not None else self.begin_time * 1000
+        end = self.end_ms if self.end_ms is not None else self.end_time * 1000
+        return timeline.Interval(begin, max(begin, end), self)
+
+    # 把已经完成的分段追加到 self.name, TS 文件可以直接按字节拼接
+    def append_chunks(self, folder):
+        if self.chunk_list is None or not os.path.isfile(folder + self.chunk_list):
+            return 0
+
+        f = open(folder + self.chunk_list, "r")
+        # 最后一行可能还没有写完
+        lines = f.read().split("\n")[:-1]
+        f.close()
+
+        count = 0
+        with open(folder + self.name, "ab") as out, \
+                keyindex.KeyframeIndex(keyindex.index_path(folder + self.name), append=True) as index:
+            # 复制的同时建立关键帧索引
+            scanner = keyindex.TsScanner(index.add)
+            for line in lines[len(self.chunks):]:
+                parts = line.strip().split(",")
+                if len(parts) < 3:
+                    continue
+                chunk = folder + parts[0]
+                if os.path.isfile(chunk):
+                    with open(chunk, "rb") as src:
+                        while True:
+                            data = src.read(CHUNK_COPY_SIZE)
+                            if not data:
+                                break
+                            scanner.feed(data)
+                            out.write(data)
+                self.chunks.append((parts[0], float(parts[1]), float(parts[2])))
+                count += 1
+            out.flush()
+            os.fsync(out.fileno())
+
+        # 写入成功之后再删除分段
+        for name, _, _ in self.chunks[len(self.chunks) - count:]:
+            if os.path.isfile(folder + name):
+                os.remove(folder + name)
+        return count
+
+    async def collect_chunks(self, folder):
+        if self.chunk_list is None:
+            return 0
+        if self._chunk_lock is None:
+            self._chunk_lock = asyncio.Lock()
+        # 后台合并和后期处理不能同时写文件
+        async with self._chunk_lock:
+            return await asyncio.get_event_loop().run_in_executor(None, self.append_chunks, folder)
+
+
+# 实时画中画: 录制过程中读取正在写入的屏幕和摄像头文件进行合成
+class LiveComposite:
+    def __init__(self, room, camera: RecordSegment, screen: RecordSegment, begin_time):
+        self.room = room
+        self.camera = camera
+        self.screen = screen
+        name = "pip_{t}.ts".format(t=begin_time)
+        self.segment = RecordSegment(name=name, room=room, publisher=SCREEN, begin_time=begin_time)
+        self.pid = None
+
+    # 相对各自文件开始的偏移, 从当前直播位置开始合成
+    def command(self, folder, read_timeout=LIVE_PIP_READ_TIMEOUT):
+        now = self.segment.begin_time
+        screen_offset = max(0, now - self.screen.begin_time)
+        cam_offset = max(0, now - self.camera.begin_time)
+        follow = ['-follow', '1', '-rw_timeout', str(read_timeout * 1000000)]
+        return ['ffmpeg', '-nostdin', '-y', '-loglevel', 'info', '-hide_banner',
+                ] + follow + ['-ss', str(screen_offset), '-i', folder + self.screen.name,
+                ] + follow + ['-ss', str(cam_offset), '-i', folder + self.camera.name,
+                '-filter_complex', '[1:v]scale=iw/4:ih/4[pip];[0:v][pip]' + PIP_OVERLAY + ':shortest=1[v]',
+                '-map', '[v]', '-map', '1:a?',
+                '-codec:v', 'libx264', '-crf', '17', '-preset', LIVE_PIP_PRESET, '-tune', 'zerolatency',
+                '-codec:a', 'copy',
+                folder + self.segment.name]
 
 class RecordFile:
-    def __init__(self, room, cam:RecordSegment, screen:RecordSegment=None):
+    def __init__(self, room, cam:RecordSegment, screen:RecordSegment=None, mode=PIPELINE_CUTS,
+                 profile=profiles.BALANCED):
+        assert mode in PIPELINES
         self.room = room
+        self.mode = mode
+        # 重新编码使用的 x264 配置, 以及是否有过重新编码
+        self.profile: profiles.EncoderProfile = profile
+        self.encoded = False
         self.cameras = [cam]
         self.screens = [screen]
         self.status:RecordStatus = RecordStatus.Defalut
 
-        self.folder = FILE_ROOT_PATH + str(self.room)
+        self.folder = janus.FILE_ROOT_PATH + str(self.room)
+        self.log = log.with_room(logger, room)
         self._join_file_path = None
         self._file_cuts = None
         self._cuts_path = None
+        # {id(摄像头分段): ffprobe 读取的媒体时长 (毫秒)}, 即该文件在 concat 拼接后占据的长度
+        self._durations = {}
+        # 处理完成后的文件
+        self.output = None
+        self.progress = ProcessingProgress()
 
         # 屏幕和Cam同时开始/结束
         self.start_simultaneously = False
         self.stop_simultaneously = False
 
-    def process(self):
+    async def process(self):
         self.screens = list(filter(None, self.screens))
         self.cameras = list(filter(None, self.cameras))
 
+        # 分段录制时合并剩余的分段
+        for segment in self.cameras + self.screens:
+            await segment.collect_chunks(self.folder + "/")
+        await self._probe_timing()
+
+        # 录制时已经实时合成了画中画, 只需要裁剪摄像头和拼接
+        live = any(len(screen.composites) > 0 for screen in self.screens)
+
+        if self.mode == PIPELINE_SINGLE_PASS and len(self.screens) > 0 and not live:
+            self._process_time()
+            self.progress.plan([("single_pass", sum(cut.duration for cut in self._file_cuts), 1)])
+            await self._render_single_pass()
+            return
+
+        # 预先处理, 按各阶段要处理的媒体时长计算进度
+        single_segment = False
+        # 只分享了屏幕的房间没有摄像头文件, 只用屏幕文件生成各个分段
+        stages = []
+        if len(self.cameras) > 0:
+            stages.append(("join", sum(c.interval().duration for c in self.cameras) / 1000, COPY_WEIGHT))
+        if len(self.screens) > 0:
+            self._process_time()
+            cuts = self._file_cuts
+            single_segment = len(cuts) == 1 and cuts[0].merge and len(self.cameras) == 1 and not live
+            if single_segment:
+                stages.append(("merge", cuts[0].duration, 1))
+            else:
+                pending = [cut for cut in cuts if self._composite(cut) is None]
+                stages += [("cut", sum(cut.duration for cut in pending), 1),
+                           ("merge", sum(cut.duration for cut in pending if cut.merge), 1),
+                           ("concat", sum(cut.duration for cut in cuts), COPY_WEIGHT)]
+        self.progress.plan(stages)
+
         # 拼接所有的摄像头文件
-        self._join_cameras()
+        if len(self.cameras) > 0:
+            await self._join_cameras()
+        else:
+            self.status = RecordStatus.Processing
         # 裁剪与屏幕对应的文件
         if len(self.screens) > 0:
-            # 预先处理
-            self._process_time()
-            if len(self.screens) == 1 and len(self.cameras) == 1 and self.start_simultaneously and self.stop_simultaneously:
-                self._merge()
-                print("\n\n***********\nDone! file at path: {f}/join_merged.ts".format(self.folder), "\n***********\n\n")
+            if single_segment:
+                await self._merge(single_segment=True)
+                self.output = self.folder + "/join_merged.ts"
+                self.status = RecordStatus.Finished
+                self.log.info("Done! file at path: %s", self.output)
             else:
-                self._separate_files()
+                await self._separate_files()
                 # 合并画中画
-                self._merge()
+                await self._merge()
                 # 拼接
-                self._join_all_files()
+                await self._join_all_files()
         else:
-            print("\n\n***********\nDone! file at path: ", self._join_file_path, "\n***********\n\n")
-    
-    # 判断是否同时开始或者同时结束
-    def _process_time(self):
-        begin = self.cameras[0].begin_time
-        screen_s = self.screens[0].begin_time
-        end = self.cameras[-1].end_time
-        screen_e = self.screens[-1].end_time
+            self.output = self._join_file_path
+            self.status = RecordStatus.Finished
+            self.log.info("Done! file at path: %s", self.output)
+
+    # 会议的媒体时长 (秒), 用于估计处理时间
+    def media_seconds(self):
+        intervals = [s.interval() for s in filter(None, self.cameras + self.screens) if s.end_time is not None]
+        return sum(i.duration for i in timeline.normalize(intervals)) / 1000
+
+    # 按当前的编码配置重新编码, 输出文件放在最后
+    async def _encode(self, args, target, stage):
+        self.encoded = True
+        await run_ffmpeg(list(args) + self.profile.x264() + [target], encode=True, log_path=self._log_path(target),
+                         threads=self.profile.threads, progress=self.progress.tracker(stage))
+
+    # 录制进程没有给出结束时间的分段 (异常退出, 重启恢复), 用 ffprobe 读取时长
+    async def _probe_timing(self):
+        for segment in self.cameras + self.screens:
+            if segment.end_ms is not None:
+                continue
+            try:
+                duration = await probe.duration("{f}/{n}".format(f=self.folder, n=segment.name))
+            except (probe.ProbeError, OSError) as e:
+                self.log.warning("Probe duration of %s failed: %s", segment.name, e)
+                continue
+            if duration is not None:
+                segment.end_ms = segment.interval().begin + int(duration * 1000)
+
+        for camera in self.cameras:
+            try:
+                duration = await probe.duration("{f}/{n}".format(f=self.folder, n=camera.name))
+            except (probe.ProbeError, OSError) as e:
+                self.log.warning("Probe duration of %s failed: %s", camera.name, e)
+                continue
+            if duration is not None:
+                self._durations[id(camera)] = int(round(duration * 1000))
 
-        # 如果开始时间相近, 阈值为3, 认为同时开始
-        if abs(begin - screen_s) <= TIME_THRESHOLD:
-            self.start_simultaneously = True
-        if abs(end - screen_e) <= TIME_THRESHOLD:
-            self.stop_simultaneously = True
+    # 计算时间线, 判断是否同时开始或者同时结束
+    def _process_time(self):
+        self._file_cuts = self._cal_cuts()
+        cuts = self._file_cuts
+        self.start_simultaneously = len(cuts) > 0 and cuts[0].merge
+        self.stop_simultaneously = len(cuts) > 0 and cuts[-1].merge
 
     # 将所有的摄像头文件拼接
-    def _join_cameras(self):
-        print("Starting join all the camera files")
-        
+    @metrics.timed("join")
+    async def _join_cameras(self):
+        self.log.info("Starting join all the camera files")
+
+        cmd_file_path = self._write_join_list()
+        self._join_file_path = self.folder + "/joind.ts"
+        if await self._cameras_compatible():
+            await run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', cmd_file_path, '-c', 'copy', self._join_file_path],
+                             log_path=self._log_path(self._join_file_path), progress=self.progress.tracker("join"))
+            await self._index_join_file()
+        else:
+            self.log.warning("Camera files have different stream parameters, re-encode when joining")
+            await self._encode(['-f', 'concat', '-safe', '0', '-i', cmd_file_path, '-vf', FIT_OUTPUT,
+                                '-c:a', 'libopus'], self._join_file_path, "join")
+        self.progress.complete("join")
+
+        self.status = RecordStatus.Processing
+
+    # 摄像头文件都有录制时写的关键帧索引时, 按 concat 的时间偏移 (之前文件的时长) 换算出拼接后的关键帧,
+    # smart cut 不需要再扫描 joind.ts
+    async def _index_join_file(self):
+        keys = []
+        offset = 0.0
+        try:
+            for segment in self.cameras:
+                path = "{f}/{n}".format(f=self.folder, n=segment.name)
+                if not os.path.isfile(keyindex.index_path(path)):
+                    return
+                media = await probe.info(path, with_keyframes=True)
+                if media.duration is None:
+                    return
+                keys += [round(offset + k, 6) for k in media.keyframes]
+                offset += media.duration
+            await probe.store_keyframes(self._join_file_path, keys)
+        except (probe.ProbeError, OSError) as e:
+            self.log.warning("Index keyframes of joined file failed: %s", e)
+
+    # concat 直接拷贝要求每个文件的流参数一致 (重新推流可能换了分辨率或编码)
+    async def _cameras_compatible(self):
+        params = set()
+        for segment in self.cameras:
+            try:
+                media = await probe.info("{f}/{n}".format(f=self.folder, n=segment.name))
+            except (probe.ProbeError, OSError) as e:
+                self.log.warning("Probe %s failed: %s", segment.name, e)
+                continue
+            params.add(tuple(tuple(stream.get(k) for k in CONCAT_STREAM_KEYS) for stream in media.streams))
+        return len(params) <= 1
+
+    # 生成摄像头文件的 concat 列表
+    def _write_join_list(self):
         file_names = list(map(lambda s: "file " + self.folder + "/" + s.name, self.cameras))
         contents = str.join("\r\n", file_names)
 
@@ -99,115 +430,218 @@ class RecordFile:
 
         # 删除原来有的
         if os.path.isfile(cmd_file_path):
-            print("File exits: ", cmd_file_path, " removing now...")
+            self.log.debug("File exits: %s removing now...", cmd_file_path)
             os.remove(cmd_file_path)
 
         f = open(cmd_file_path, "a+")
         f.write(contents)
         f.close()
 
-        self._join_file_path = self.folder + "/joind.ts"
-        p = subprocess.Popen(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', cmd_file_path, '-c', 'copy', self._join_file_path])
-        p.wait()
-
-        self.status = RecordStatus.Processing
+        return cmd_file_path
     
     # 将合并的摄像头文件根据屏幕文件进行分段
-    def _separate_files(self):
-        cuts = self._cal_cuts()
-        self._file_cuts = cuts
+    @metrics.timed("cut")
+    async def _separate_files(self):
+        if self._file_cuts is None:
+            self._file_cuts = self._cal_cuts()
+        cuts = self._file_cuts
         
-        print("--------CUT [START]--------")
+        self.log.info("Cut camera file into %d parts", len(cuts))
 
         self._cuts_path = self.folder + "/cuts"
         Path(self._cuts_path).mkdir(parents=True, exist_ok=True)
 
+        # 不需要画中画的分段只做 smart cut, 关键帧之间直接拷贝
+        media = None
+        if any(not cut.merge and cut.begin is not None for cut in cuts):
+            try:
+                media = await probe.info(self._join_file_path, with_keyframes=True)
+            except (probe.ProbeError, OSError) as e:
+                self.log.warning("Probe keyframes failed, fallback to re-encode: %s", e)
+
         index = 0
         for cut in cuts:
+            if self._composite(cut) is not None:
+                index += 1
+                continue
             cut.name = "cut_{i}.ts".format(i=index)
-            p = subprocess.run("ffmpeg -i {source} -ss {s} -to {e} -c:v libx264 -crf 17 -c:a copy -preset fast {t}".format(
-                s=cut.begin, 
-                source=self._join_file_path, 
-                e=cut.end, 
-                t=self._cuts_path+"/"+cut.name), shell=True)
+            target = self._cuts_path + "/" + cut.name
+            if cut.begin is None:
+                await self._encode_screen_cut(cut, target)
+            elif not cut.merge and media is not None and media.keyframes:
+                await self._smart_cut(cut, media, target)
+            else:
+                await self._encode_cut(cut.begin, cut.end, target)
             index += 1
+        self.progress.complete("cut")
    
-        print("--------CUT [END]--------")
-
-    # 计算分段
-    def _cal_cuts(self):
-        begin = self.cameras[0].begin_time
-        end = self.cameras[-1].end_time
-
-        def ti(segment:RecordSegment):
-            return MergeFile(begin=segment.begin_time-begin, end=segment.end_time-begin, merge=True)
-        merges = list(map(ti, self.screens))
-
-        first = MergeFile(begin=0, end=merges[0].begin, merge=self.start_simultaneously)
-        cuts = [first]
-
-        for index in range(len(merges)):
-            cur = merges[index]
-            if index == 0 and self.start_simultaneously == False:
-                cuts.append(cur)
+        self.log.info("Cut done")
+
+    # 每个 ffmpeg 任务的输出写到 logs/<输出文件名>.log
+    def _log_path(self, target):
+        return log.ffmpeg_log_path(self.folder, os.path.basename(target))
+
+    # 实时合成的画中画文件, 需要覆盖整个分段才直接使用
+    def _composite(self, cut: MergeFile):
+        if not cut.merge or cut.screen is None:
+            return None
+        for composite in cut.screen.composites:
+            if composite.end_time is None:
                 continue
-            else:
-                pre = merges[index-1]
-                cuts.append(MergeFile(begin=pre.end, end=cur.begin, merge=False))
-                cuts.append(cur)
+            interval = composite.interval()
+            if interval.begin - cut.begin_ms > TIME_THRESHOLD * 1000:
+                continue
+            if cut.end_ms - interval.end > TIME_THRESHOLD * 1000:
+                continue
+            return composite
+        return None
+
+    async def _encode_cut(self, begin, end, target, codec=()):
+        await self._encode(['-ss', str(begin), '-i', self._join_file_path, '-t', str(round(end - begin, 6)),
+                            '-c:a', 'copy'] + list(codec), target, "cut")
+
+    # smart cut 重新编码的首尾要与直接拷贝的部分使用相同的 profile/level/像素格式,
+    # 否则拼接后 SPS 在分界处变化, 部分播放器无法播放; 无法对应时返回 None
+    @staticmethod
+    def _matching_x264(media: probe.MediaInfo):
+        video = media.video()
+        if video is None or video.get("codec_name") != "h264":
+            return None
+        profile = X264_PROFILES.get(video.get("profile"))
+        level = video.get("level")
+        pix_fmt = video.get("pix_fmt")
+        if profile is None or not isinstance(level, int) or level <= 0 or pix_fmt is None:
+            return None
+        return ['-profile:v', profile, '-level:v', "{m}.{n}".format(m=level // 10, n=level % 10), '-pix_fmt', pix_fmt]
+
+    # 摄像头不在的时间只有屏幕画面, 补上静音保证拼接时音轨一致
+    async def _encode_screen_cut(self, cut: MergeFile, target):
+        await self._encode(['-ss', str(cut.screen_offset), '-i', "{f}/{n}".format(f=self.folder, n=cut.screen.name),
+                            '-f', 'lavfi', '-i', 'anullsrc=r=48000:cl=stereo', '-t', str(round(cut.duration, 6)),
+                            '-map', '0:v', '-map', '1:a', '-c:a', 'libopus'], target, "cut")
+
+    # 首尾不足一个 GOP 的部分重新编码, 中间从关键帧开始直接拷贝
+    async def _smart_cut(self, cut: MergeFile, media: probe.MediaInfo, target):
+        k1 = media.keyframe_after(cut.begin)
+        k2 = media.keyframe_before(cut.end)
+        codec = self._matching_x264(media)
+        if k1 is None or k2 is None or k2 - k1 < SMART_CUT_MIN_COPY or codec is None:
+            await self._encode_cut(cut.begin, cut.end, target)
+            return
+
+        parts = []
+        if k1 - cut.begin > SMART_CUT_EPSILON:
+            head = target + ".head.ts"
+            await self._encode_cut(cut.begin, k1, head, codec)
+            parts.append(head)
+
+        body = target + ".copy.ts"
+        await run_ffmpeg(['-ss', str(k1), '-i', self._join_file_path, '-t', str(round(k2 - k1, 6)),
+                          '-c', 'copy', '-avoid_negative_ts', 'make_zero', body], log_path=self._log_path(body),
+                         progress=self.progress.tracker("cut"))
+        parts.append(body)
+
+        if cut.end - k2 > SMART_CUT_EPSILON:
+            tail = target + ".tail.ts"
+            await self._encode_cut(k2, cut.end, tail, codec)
+            parts.append(tail)
+
+        if len(parts) == 1:
+            os.replace(body, target)
+            return
+
+        list_path = target + ".txt"
+        f = open(list_path, "w")
+        f.write(str.join("\r\n", map(lambda p: "file " + p, parts)))
+        f.close()
+        await run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', list_path, '-c', 'copy', target],
+                         log_path=self._log_path(target))
 
-        if self.stop_simultaneously == False:
-            cuts.append(MergeFile(begin=merges[-1].end, end=end-begin, merge=False))
+        for p in parts + [list_path]:
+            os.remove(p)
+
+    # 由时间线计算分段, 摄像头的位置换算为拼接后文件中的偏移
+    def _cal_cuts(self):
+        spans = timeline.plan([c.interval() for c in self.cameras], [s.interval() for s in self.screens],
+                              min_span=MIN_SPAN_MS)
+
+        # 每个摄像头文件在拼接后文件中的起始位置和长度 (毫秒); concat 按媒体时长 (PTS) 依次排列文件,
+        # 与 _index_join_file 一致, 读取失败时按录制时间估计
+        positions = {}
+        cursor = 0
+        for camera in self.cameras:
+            interval = camera.interval()
+            duration = self._durations.get(id(camera), interval.duration)
+            positions[id(camera)] = (cursor, interval.begin, duration)
+            cursor += duration
+
+        cuts = []
+        for span in spans:
+            begin = end = None
+            if span.camera is not None:
+                position, camera_begin, duration = positions[id(span.camera)]
+                offset = position + min(max(0, span.begin - camera_begin), duration)
+                begin = offset / 1000
+                end = (offset + span.duration) / 1000
+            cut = MergeFile(begin=begin, end=end, merge=span.kind == timeline.PIP, screen=span.screen)
+            if span.screen is not None:
+                cut.screen_offset = max(0, span.begin - span.screen.interval().begin) / 1000
+            cut.begin_ms = span.begin
+            cut.end_ms = span.end
+            cuts.append(cut)
 
         return cuts
 
     # [PiP]形式融合屏幕和摄像头画面
-    def _merge(self, single_segment=False):
-        print("Starting merge all the camera & screen files")
+    @metrics.timed("merge")
+    async def _merge(self, single_segment=False):
+        self.log.info("Starting merge all the camera & screen files")
 
         if single_segment:
-            screen_target = "{f}/{n}".format(f=self.folder, n=self.screens[0].name)
+            cut: MergeFile = self._file_cuts[0]
+            screen_target = "{f}/{n}".format(f=self.folder, n=cut.screen.name)
             overlay_target = "{f}/{n}".format(f=self.folder, n=self.cameras[0].name)
             merged_path = "{f}/{n}".format(f=self.folder, n="/join_merged.ts")
-            p = subprocess.Popen(['ffmpeg', 
-                '-i', screen_target,
-                '-i', overlay_target,
-                '-filter_complex', '[1]scale=iw/4:ih/4[pip];[0][pip] overlay=main_w-overlay_w-10:main_h-overlay_h-10', '-codec:v', 'libx264', '-crf', '17', '-preset', 'fast', '-codec:a', 'copy',
-                merged_path])
-
-            p.wait()
+            # 屏幕和摄像头开始时间不同时从各自的偏移开始, 保证画面与声音同步
+            await self._encode([
+                '-ss', str(cut.screen_offset), '-i', screen_target,
+                '-ss', str(cut.begin), '-i', overlay_target,
+                '-t', str(round(cut.duration, 6)),
+                '-filter_complex', '[1]scale=iw/4:ih/4[pip];[0][pip] overlay=main_w-overlay_w-10:main_h-overlay_h-10', '-codec:a', 'copy',
+                ], merged_path, "merge")
         else:
-            filtered = list(filter(lambda x: x.merge, self._file_cuts))
-
-            assert len(filtered) == len(self.screens)
+            filtered = list(filter(lambda x: x.merge and self._composite(x) is None, self._file_cuts))
 
             procs = []
-            for index in range(len(self.screens)):
-                screen_target = "{f}/{n}".format(f=self.folder, n=self.screens[index].name)
+            for index in range(len(filtered)):
                 cut:MergeFile = filtered[index]
+                screen_target = "{f}/{n}".format(f=self.folder, n=cut.screen.name)
                 overlay_target = "{f}/{n}".format(f=self._cuts_path, n=cut.name)
                 cut.merged_name = "merged_{n}.ts".format(n=index)
                 merged_path = "{f}/{n}".format(f=self._cuts_path, n=cut.merged_name)
 
-                p = subprocess.Popen(['ffmpeg', 
-                '-i', screen_target,
+                procs.append(self._encode([
+                '-ss', str(cut.screen_offset), '-i', screen_target,
                 '-i', overlay_target,
-                '-filter_complex', '[1]scale=iw/4:ih/4[pip];[0][pip] overlay=main_w-overlay_w-10:main_h-overlay_h-10', '-codec:v', 'libx264', '-crf', '17', '-preset', 'fast', '-codec:a', 'copy',
-                merged_path])
+                '-t', str(round(cut.duration, 6)),
+                '-filter_complex', '[1]scale=iw/4:ih/4[pip];[0][pip] overlay=main_w-overlay_w-10:main_h-overlay_h-10', '-codec:a', 'copy',
+                ], merged_path, "merge"))
 
-                procs.append(p)
-
-            r = [p.wait() for p in procs]
-            print(r)      
-        print("\n\n***********\nMerge Done!\n***********\n\n")
+            await gather_ffmpeg(*procs)
+        self.progress.complete("merge")
+        self.log.info("Merge done")
 
     # 拼接所有文件
-    def _join_all_files(self):
-        print("Starting join all the files to single mp4 file")
+    @metrics.timed("concat")
+    async def _join_all_files(self):
+        self.log.info("Starting join all the files to single file")
 
         file_path = self._cuts_path
 
         def l(file:MergeFile):
+            composite = self._composite(file)
+            if composite is not None:
+                return "file " + self.folder + "/" + composite.name
             name = file.name
             if file.merge:
                 name = file.merged_name
@@ -220,7 +654,7 @@ class RecordFile:
 
         # 删除原来有的
         if os.path.isfile(cmd_file_path):
-            print("File exits: ", cmd_file_path, " removing now...")
+            self.log.debug("File exits: %s removing now...", cmd_file_path)
             os.remove(cmd_file_path)
 
         f = open(cmd_file_path, "a+")
@@ -228,9 +662,82 @@ class RecordFile:
         f.close()
 
         target = self.folder + "/join_merged.ts"
-        p = subprocess.Popen(['ffmpeg', '-f', 'concat', '-safe', '0', '-i', cmd_file_path, '-c', 'copy', target])
-        p.wait()
+        await run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', cmd_file_path, '-c', 'copy', target],
+                         log_path=self._log_path(target), progress=self.progress.tracker("concat"))
+        self.progress.complete("concat")
 
+        self.output = target
         self.status = RecordStatus.Finished
 
-        print("\n\n***********\nDone! file at path: ", target, "\n***********\n\n")
+        self.log.info("Done! file at path: %s", target)
+
+    # 单次编码: 用一个 filter_complex 完成 裁剪 -> 画中画 -> 拼接, 不产生中间文件
+    @metrics.timed("single_pass")
+    async def _render_single_pass(self):
+        self.log.info("Starting single pass render")
+
+        if self._file_cuts is None:
+            self._file_cuts = self._cal_cuts()
+        cuts = self._file_cuts
+        self.status = RecordStatus.Processing
+
+        # 输入 0 为摄像头文件的 concat 列表 (没有摄像头时省略), 之后依次为每个分段使用的屏幕文件
+        inputs = []
+        if len(self.cameras) > 0:
+            inputs = ['-f', 'concat', '-safe', '0', '-i', self._write_join_list()]
+        graph = self._build_filter_graph(cuts, screen_input=1 if len(self.cameras) > 0 else 0)
+        for cut in filter(lambda x: x.screen is not None, cuts):
+            inputs += ['-ss', str(cut.screen_offset), '-i', "{f}/{n}".format(f=self.folder, n=cut.screen.name)]
+
+        target = self.folder + "/join_merged.ts"
+        await self._encode(inputs + [
+            '-filter_complex', graph,
+            '-map', '[vout]', '-map', '[aout]',
+            '-codec:a', 'aac'], target, "single_pass")
+        self.progress.complete("single_pass")
+
+        self.output = target
+        self.status = RecordStatus.Finished
+        self.log.info("Done! file at path: %s", target)
+
+    # screen_input: 第一个屏幕文件的输入序号
+    @staticmethod
+    def _build_filter_graph(cuts, screen_input=1):
+        fit = FIT_OUTPUT
+        count = len(cuts)
+        cams = len([cut for cut in cuts if cut.begin is not None])
+
+        # 分段按时间先后排列, split 之后不会积压帧
+        chains = []
+        if cams > 0:
+            chains += [
+                "[0:v]setpts=PTS-STARTPTS,split={n}{o}".format(n=cams, o="".join("[cv{i}]".format(i=i) for i in range(cams))),
+                "[0:a]asetpts=PTS-STARTPTS,asplit={n}{o}".format(n=cams, o="".join("[ca{i}]".format(i=i) for i in range(cams))),
+            ]
+        cam_output = 0
+        for i, cut in enumerate(cuts):
+            # 屏幕画面不足时重复最后一帧, 保证与音频时长一致
+            screen = "[{n}:v]setpts=PTS-STARTPTS,tpad=stop=-1:stop_mode=clone,trim=duration={d},setpts=PTS-STARTPTS".format(
+                n=screen_input, d=cut.duration)
+            if cut.begin is None:
+                chains.append("{s},{f}[v{i}]".format(s=screen, f=fit, i=i))
+                chains.append("anullsrc=r=48000:cl=stereo,atrim=duration={d}[a{i}]".format(i=i, d=cut.duration))
+                screen_input += 1
+                continue
+
+            c = cam_output
+            cam_output += 1
+            trim = "trim=start={s}:end={e},setpts=PTS-STARTPTS".format(s=cut.begin, e=cut.end)
+            chains.append("[ca{c}]atrim=start={s}:end={e},asetpts=PTS-STARTPTS[a{i}]".format(
+                c=c, i=i, s=cut.begin, e=cut.end))
+            if cut.merge:
+                chains.append("[cv{c}]{t},scale=iw/4:ih/4[pip{i}]".format(c=c, i=i, t=trim))
+                chains.append("{s}[s{i}]".format(s=screen, i=i))
+                chains.append("[s{i}][pip{i}]{o},{f}[v{i}]".format(i=i, o=PIP_OVERLAY, f=fit))
+                screen_input += 1
+            else:
+                chains.append("[cv{c}]{t},{f}[v{i}]".format(c=c, i=i, t=trim, f=fit))
+
+        chains.append("{s}concat=n={n}:v=1:a=1[vout][aout]".format(
+            s="".join("[v{i}][a{i}]".format(i=i) for i in range(count)), n=count))
+        return ";".join(chains)
@@ -0,0 +1,414 @@
+import asyncio
+import struct
+import time
+
+from mpegts import TsWriter
+from keyindex import KeyframeIndex, index_path
+import log
+
+logger = log.get_logger("rtp")
+
+# 录制引擎: 每个 publisher 一个 ffmpeg 进程 / 进程内接收 RTP 写 TS
+ENGINE_FFMPEG = "ffmpeg"
+ENGINE_PYTHON = "python"
+ENGINES = [ENGINE_FFMPEG, ENGINE_PYTHON]
+
+# 乱序缓冲的槽位数和每个槽位的大小
+JITTER_SLOTS = 512
+MTU = 1500
+# 缺包时最多等待的包数, 之后跳过
+JITTER_LATENCY = 64
+# 码率统计窗口 (秒)
+BITRATE_WINDOW = 2
+
+VIDEO_CLOCK = 90000
+AUDIO_CLOCK = 48000
+
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_STAP_A = 24
+NAL_FU_A = 28
+START_CODE = b"\x00\x00\x00\x01"
+
+
+# RTP 固定头 (RFC 3550), 返回 (payload_type, marker, seq, timestamp, payload), 不是 RTP 包时返回 None
+def parse(packet: memoryview):
+    if len(packet) < 12 or packet[0] >> 6 != 2:
+        return None
+    first, second, seq, timestamp = struct.unpack_from(">BBHI", packet)
+    offset = 12 + (first & 0x0F) * 4
+    if first & 0x10:
+        if len(packet) < offset + 4:
+            return None
+        offset += 4 + struct.unpack_from(">H", packet, offset + 2)[0] * 4
+    end = len(packet)
+    if first & 0x20:
+        end -= packet[end - 1]
+    if offset > end:
+        return None
+    return second & 0x7F, bool(second & 0x80), seq, timestamp, packet[offset:end]
+
+
+# 按序号重排 RTP 包, 包数据复制到预先分配的环形缓冲中
+class JitterBuffer:
+    def __init__(self, slots=JITTER_SLOTS, mtu=MTU, latency=JITTER_LATENCY):
+        self.slots = slots
+        self.mtu = mtu
+        self.latency = min(latency, slots - 1)
+        self._data = bytearray(slots * mtu)
+        self._view = memoryview(self._data)
+        # 每个槽位的长度, 0 为空
+        self._lengths = [0] * slots
+        self._count = 0
+        self._next = None
+        self._highest = None
+        self.lost = 0
+        self.late = 0
+
+    # 返回按序可以处理的包 [(packet, discontinuity)], packet 只在下一次 push 之前有效
+    def push(self, seq, packet: memoryview):
+        if self._next is None:
+            self._next = seq
+            self._highest = seq
+        diff = (seq - self._next) & 0xFFFF
+        if diff >= 0x8000:
+            # 已经跳过或者重复的包
+            self.late += 1
+            return []
+
+        # 按序到达且没有积压, 直接处理不复制
+        if diff == 0 and self._count == 0:
+            self._next = (seq + 1) & 0xFFFF
+            self._highest = seq
+            return [(packet, False)]
+
+        if diff >= self.slots:
+            ready = self._drain()
+            self._next = seq
+            self._highest = seq
+            return ready + self.push(seq, packet)
+
+        if len(packet) > self.mtu:
+            self.late += 1
+            return []
+        slot = seq % self.slots
+        if self._lengths[slot] == 0:
+            start = slot * self.mtu
+            self._view[start:start + len(packet)] = packet
+            self._lengths[slot] = len(packet)
+            self._count += 1
+        if (seq - self._highest) & 0xFFFF < 0x8000:
+            self._highest = seq
+        return self._pop()
+
+    def _take(self, seq):
+        slot = seq % self.slots
+        length = self._lengths[slot]
+        self._lengths[slot] = 0
+        self._count -= 1
+        start = slot * self.mtu
+        return self._view[start:start + length]
+
+    def _pop(self):
+        ready = []
+        discontinuity = False
+        while self._count > 0:
+            if self._lengths[self._next % self.slots] > 0:
+                ready.append((self._take(self._next), discontinuity))
+                discontinuity = False
+                self._next = (self._next + 1) & 0xFFFF
+            elif (self._highest - self._next) & 0xFFFF >= self.latency:
+                # 等待太久, 认为丢包
+                self.lost += 1
+                discontinuity = True
+                self._next = (self._next + 1) & 0xFFFF
+            else:
+                break
+        return ready
+
+    # 取出所有缓冲的包, 跳过缺失的序号
+    def _drain(self):
+        ready = []
+        discontinuity = False
+        while self._count > 0:
+            if self._lengths[self._next % self.slots] > 0:
+                ready.append((self._take(self._next), discontinuity))
+                discontinuity = False
+            else:
+                self.lost += 1
+                discontinuity = True
+            self._next = (self._next + 1) & 0xFFFF
+        return ready
+
+    def flush(self):
+        return self._drain()
+
+
+# H.264 (RFC 6184): 单个 NAL / STAP-A / FU-A 组装成 Annex-B 格式的访问单元
+class H264Depacketizer:
+    def __init__(self):
+        self._au = bytearray()
+        self._timestamp = None
+        self._key = False
+        self._fu = False
+        # 开始和丢包之后等待关键帧
+        self._wait_key = True
+
+    # 返回完成的访问单元 [(timestamp, data, key)]
+    def push(self, payload: memoryview, timestamp, marker, discontinuity=False):
+        done = []
+        if discontinuity:
+            self._au.clear()
+            self._fu = False
+            self._wait_key = True
+        if self._timestamp is not None and timestamp != self._timestamp and len(self._au) > 0:
+            done += self._emit()
+        self._timestamp = timestamp
+        if len(payload) == 0:
+            return done
+
+        nal_type = payload[0] & 0x1F
+        if nal_type == NAL_STAP_A:
+            offset = 1
+            while offset + 2 <= len(payload):
+                size = (payload[offset] << 8) | payload[offset + 1]
+                offset += 2
+                self._add(payload[offset:offset + size])
+                offset += size
+        elif nal_type == NAL_FU_A:
+            if len(payload) < 2:
+                return done
+            header = payload[1]
+            if header & 0x80:
+                self._au += START_CODE
+                self._au.append((payload[0] & 0xE0) | (header & 0x1F))
+                self._key = self._key or (header & 0x1F) in (NAL_IDR, NAL_SPS)
+                self._fu = True
+            elif not self._fu:
+                # 丢失了分片的开始
+                return done
+            self._au += payload[2:]
+            if header & 0x40:
+                self._fu = False
+        elif 0 < nal_type < NAL_STAP_A:
+            self._add(payload)
+
+        if marker:
+            done += self._emit()
+        return done
+
+    def _add(self, nal):
+        if len(nal) == 0:
+            return
+        self._au += START_CODE
+        self._au += nal
+        self._key = self._key or (nal[0] & 0x1F) in (NAL_IDR, NAL_SPS)
+
+    def _emit(self):
+        data = self._au
+        key = self._key
+        self._au = bytearray()
+        self._key = False
+        self._fu = False
+        if len(data) == 0 or (self._wait_key and not key):
+            return []
+        self._wait_key = False
+        return [(self._timestamp, data, key)]
+
+    def flush(self):
+        if len(self._au) == 0:
+            return []
+        return self._emit()
+
+
+# Opus (RFC 7587): 每个 RTP 包就是一个 Opus 包
+class OpusDepacketizer:
+    def push(self, payload: memoryview, timestamp, marker, discontinuity=False):
+        if len(payload) == 0:
+            return []
+        return [(timestamp, payload, True)]
+
+    def flush(self):
+        return []
+
+
+# 一路 RTP 流: 重排 -> 解包 -> 转换为 90kHz 的 PTS
+class RtpStream:
+    def __init__(self, kind, payload_type, clock, depacketizer, on_frame):
+        self.kind = kind
+        self.payload_type = payload_type
+        self.clock = clock
+        self.depacketizer = depacketizer
+        self.jitter = JitterBuffer()
+        self.on_frame = on_frame
+        self.packets = 0
+        self.bytes = 0
+        self._last_ts = None
+        self._elapsed = 0
+        self._first_arrival = None
+
+    def feed(self, data, now):
+        packet = parse(memoryview(data))
+        if packet is None:
+            return
+        payload_type, marker, seq, timestamp, payload = packet
+        if payload_type != self.payload_type:
+            return
+        self.packets += 1
+        self.bytes += len(data)
+        if self._first_arrival is None:
+            self._last_ts = timestamp
+            self._first_arrival = now
+        for raw, discontinuity in self.jitter.push(seq, memoryview(data)):
+            _, marker, _, timestamp, payload = parse(raw)
+            for ts, frame, key in self.depacketizer.push(payload, timestamp, marker, discontinuity):
+                self.on_frame(self, self._pts(ts), frame, key)
+
+    def flush(self):
+        for raw, discontinuity in self.jitter.flush():
+            _, marker, _, timestamp, payload = parse(raw)
+            for ts, frame, key in self.depacketizer.push(payload, timestamp, marker, discontinuity):
+                self.on_frame(self, self._pts(ts), frame, key)
+        for ts, frame, key in self.depacketizer.flush():
+            self.on_frame(self, self._pts(ts), frame, key)
+
+    # 以第一个包的到达时间对齐音视频, 之后按 RTP 时间戳增长, 处理 32 位回绕
+    def _pts(self, timestamp):
+        delta = (timestamp - self._last_ts) & 0xFFFFFFFF
+        if delta >= 0x80000000:
+            delta -= 1 << 32
+        self._last_ts = timestamp
+        self._elapsed += delta
+        return int(self._first_arrival * VIDEO_CLOCK) + self._elapsed * VIDEO_CLOCK // self.clock
+
+
+class _Receiver(asyncio.DatagramProtocol):
+    def __init__(self, recorder, stream):
+        self.recorder = recorder
+        self.stream = stream
+
+    def datagram_received(self, data, addr):
+        self.recorder.receive(self.stream, data)
+
+    def error_received(self, exc):
+        self.recorder.log.warning("RTP socket of %s error: %s", self.recorder.key, exc)
+
+
+# 进程内录制一个 publisher, 接口与 supervisor.FFmpegProcess 一致
+class RtpRecorder:
+    def __init__(self, key, path, video_port, video_pt, audio_port=None, audio_pt=None, host="0.0.0.0", room=None):
+        self.key = key
+        self.path = path
+        self.host = host
+        self.room = room
+        self.log = log.with_room(logger, room)
+        self.pid = None
+        self.returncode = None
+        self.stopping = False
+        self.started = None
+        self.last_progress = None
+        self.size = 0
+        self.time = None
+        self.bitrate = None
+        self.speed = None
+        self.first_frame = None
+        self.last_frame = None
+
+        self._ports = [(video_port, RtpStream("video", video_pt, VIDEO_CLOCK, H264Depacketizer(), self._write))]
+        if audio_port is not None:
+            self._ports.append((audio_port, RtpStream("audio", audio_pt, AUDIO_CLOCK, OpusDepacketizer(), self._write)))
+        self._writer = None
+        self._index = None
+        self._transports = []
+        self._exited = None
+        self._window = (0, 0)
+        self._wall_started = None
+
+    @property
+    def running(self):
+        return self._exited is not None and not self._exited.done()
+
+    def stalled(self, now, timeout):
+        return self.running and now - (self.last_progress or self.started) > timeout
+
+    @property
+    def streams(self):
+        return [stream for _, stream in self._ports]
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        self._exited = loop.create_future()
+        self._index = KeyframeIndex(index_path(self.path))
+        self._writer = TsWriter(self.path, video=True, audio=len(self._ports) > 1, index=self._index)
+        self.started = time.monotonic()
+        self._wall_started = time.time()
+        try:
+            for port, stream in self._ports:
+                transport, _ = await loop.create_datagram_endpoint(lambda s=stream: _Receiver(self, s),
+                                                                   local_addr=(self.host, port))
+                self._transports.append(transport)
+        except OSError:
+            self._close()
+            raise
+        return self
+
+    def receive(self, stream: RtpStream, data):
+        if not self.running:
+            return
+        try:
+            stream.feed(data, time.monotonic() - self.started)
+        except OSError as e:
+            self.log.error("Write %s failed: %s", self.path, e)
+            self._close(1)
+
+    def _write(self, stream: RtpStream, pts, frame, key):
+        if stream.kind == "video":
+            self._writer.write_video(pts, frame, key)
+        else:
+            self._writer.write_audio(pts, frame)
+        self.size = self._writer.size
+        self.time = pts / VIDEO_CLOCK
+        # pts 以录制开始为 0, 换算为帧的到达时间 (估计值, 没有 RTCP SR 时无法得到发送端的时间)
+        frame_time = self._wall_started + self.time
+        if self.first_frame is None:
+            self.first_frame = frame_time
+        self.last_frame = max(self.last_frame or frame_time, frame_time)
+
+        now = time.monotonic()
+        self.last_progress = now
+        start, size = self._window
+        if now - start >= BITRATE_WINDOW:
+            if start > 0:
+                self.bitrate = round((self.size - size) * 8 / 1000 / (now - start), 1)
+            self._window = (now, self.size)
+
+    def _close(self, code=0):
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except OSError as e:
+                self.log.error("Close %s failed: %s", self.path, e)
+                code = code or 1
+        if self._index is not None:
+            self._index.close()
+        if self._exited is not None and not self._exited.done():
+            self.returncode = code
+            self._exited.set_result(code)
+
+    async def wait(self):
+        return await asyncio.shield(self._exited)
+
+    # 写出缓冲中剩余的帧后关闭文件
+    async def stop(self, timeout=None):
+        self.stopping = True
+        if self.running:
+            try:
+                for stream in self.streams:
+                    stream.flush()
+            except OSError as e:
+                self.log.error("Write %s failed: %s", self.path, e)
+            self._close()
+        return await self.wait()
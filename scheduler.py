@@ -0,0 +1,79 @@
+import asyncio
+import os
+
+from collections import deque
+
+
+# 全局的 ffmpeg 编码调度器, 所有房间共享同一个线程预算
+class FFmpegScheduler:
+    def __init__(self, budget=None, threads_per_job=4):
+        self.budget = max(1, int(budget or os.cpu_count() or 1))
+        self.threads_per_job = max(1, min(int(threads_per_job), self.budget))
+        self._available = self.budget
+        # [(threads, future)] 先进先出, 避免大任务被饿死
+        self._waiters = deque()
+
+    def configure(self, budget=None, threads_per_job=None):
+        in_use = self.budget - self._available
+        if budget is not None:
+            self.budget = max(1, int(budget))
+        if threads_per_job is not None:
+            self.threads_per_job = max(1, int(threads_per_job))
+        self.threads_per_job = min(self.threads_per_job, self.budget)
+        self._available = self.budget - in_use
+        self._wakeup()
+
+    @property
+    def in_use(self):
+        return self.budget - self._available
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    # 申请线程, 预算不足时排队, 返回实际分配的线程数
+    async def acquire(self, threads=None):
+        n = min(max(1, int(threads or self.threads_per_job)), self.budget)
+        if len(self._waiters) == 0 and self._available >= n:
+            self._available -= n
+            return n
+
+        fut = asyncio.get_event_loop().create_future()
+        item = (n, fut)
+        self._waiters.append(item)
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if item in self._waiters:
+                self._waiters.remove(item)
+            elif fut.done() and not fut.cancelled():
+                self.release(fut.result())
+            raise
+
+    def release(self, threads):
+        self._available = min(self.budget, self._available + threads)
+        self._wakeup()
+
+    def _wakeup(self):
+        while len(self._waiters) > 0:
+            n, fut = self._waiters[0]
+            if fut.done():
+                self._waiters.popleft()
+                continue
+            n = min(n, self.budget)
+            if self._available < n:
+                break
+            self._waiters.popleft()
+            self._available -= n
+            fut.set_result(n)
+
+    # 在预算内执行 coroutine factory, 参数为分配到的线程数
+    async def run(self, factory, threads=None):
+        n = await self.acquire(threads)
+        try:
+            return await factory(n)
+        finally:
+            self.release(n)
+
+
+SCHEDULER = FFmpegScheduler()
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+
+from janus import JanusSession, RecordSession
+from recorder import RecordSegment
+import log
+
+logger = log.get_logger("store")
+
+# 写操作先在内存中合并, 延迟或者积累到一定数量后在一个事务中提交
+FLUSH_DELAY = 0.5
+FLUSH_BATCH = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS janus_sessions (
+    room INTEGER PRIMARY KEY,
+    pin TEXT,
+    display TEXT,
+    session INTEGER,
+    handle INTEGER,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS record_sessions (
+    room INTEGER NOT NULL,
+    publisher INTEGER NOT NULL,
+    started INTEGER,
+    status TEXT NOT NULL,
+    folder TEXT,
+    recorder_pid INTEGER,
+    segment TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (room, publisher)
+);
+CREATE TABLE IF NOT EXISTS segments (
+    room INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    publisher INTEGER NOT NULL,
+    begin_time INTEGER NOT NULL,
+    end_time INTEGER,
+    begin_ms INTEGER,
+    end_ms INTEGER,
+    chunk_list TEXT,
+    chunks TEXT,
+    composites TEXT,
+    job TEXT,
+    PRIMARY KEY (room, name)
+);
+CREATE INDEX IF NOT EXISTS segments_room_publisher ON segments (room, publisher);
+CREATE INDEX IF NOT EXISTS segments_job ON segments (job);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    room INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created REAL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_room ON jobs (room);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+UPSERT_JANUS_SESSION = """
+INSERT OR REPLACE INTO janus_sessions (room, pin, display, session, handle, status, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+UPSERT_RECORD_SESSION = """
+INSERT OR REPLACE INTO record_sessions (room, publisher, started, status, folder, recorder_pid, segment, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+DELETE_RECORD_SESSION = "DELETE FROM record_sessions WHERE room = ? AND publisher = ?"
+# 不覆盖 job 字段, 分配给任务之后的更新不会把分段重新变成未处理
+UPSERT_SEGMENT = """
+INSERT INTO segments (room, name, publisher, begin_time, end_time, begin_ms, end_ms, chunk_list, chunks, composites)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (room, name) DO UPDATE SET
+    end_time = excluded.end_time, begin_ms = excluded.begin_ms, end_ms = excluded.end_ms, chunk_list = excluded.chunk_list, chunks = excluded.chunks,
+    composites = excluded.composites
+"""
+ASSIGN_SEGMENT = "UPDATE segments SET job = ? WHERE room = ? AND name = ?"
+INTERRUPT_JOB = "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?"
+UPSERT_JOB = """
+INSERT OR REPLACE INTO jobs (id, room, status, error, created, started, finished)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+# 持久化 session / 分段 / 后期处理任务, 重启后可以恢复未完成的录制
+class StateStore:
+    def __init__(self, path, flush_delay=FLUSH_DELAY, flush_batch=FLUSH_BATCH):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.flush_batch = flush_batch
+        # 提交在线程池中执行, 连接只在持有 _db_lock 时使用
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._migrate()
+        self._db_lock = threading.Lock()
+        # [(sql, params)] 按调用顺序; {(table, key): 该行最后一次写入的位置}
+        self._pending = []
+        self._rows = {}
+        self._timer = None
+        self._flushing = None
+        self.commits = 0
+
+    # 旧版本的数据库每个屏幕分段只记录一个实时合成文件
+    def _migrate(self):
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(segments)")]
+        if "composites" in columns:
+            return
+        self._db.execute("ALTER TABLE segments ADD COLUMN composites TEXT")
+        if "composite" in columns:
+            self._db.execute("UPDATE segments SET composites = json_array(json_array(composite, composite_begin, "
+                             "composite_end)) WHERE composite IS NOT NULL")
+        self._db.commit()
+
+    def save_janus_session(self, session: JanusSession):
+        self._write(("janus_sessions", session.room), UPSERT_JANUS_SESSION, (
+            session.room, str(session.pin), session.display, session.session, session.handle,
+            session.status.name, time.time()))
+
+    def save_record_session(self, session: RecordSession):
+        self._write(("record_sessions", session.room, session.publisher), UPSERT_RECORD_SESSION, (
+            session.room, session.publisher, session.startedTime, session.status.name, session.folder,
+            session.recorder_pid, session.segment.name if session.segment is not None else None, time.time()))
+
+    def delete_record_session(self, room, publisher):
+        self._write(("record_sessions", room, publisher), DELETE_RECORD_SESSION, (room, publisher))
+
+    def save_segment(self, segment: RecordSegment):
+        composites = [(c.name, c.begin_time, c.end_time) for c in segment.composites]
+        self._write(("segments", segment.room, segment.name), UPSERT_SEGMENT, (
+            segment.room, segment.name, segment.publisher, segment.begin_time, segment.end_time,
+            segment.begin_ms, segment.end_ms, segment.chunk_list, json.dumps(segment.chunks) if segment.chunks else None,
+            json.dumps(composites) if composites else None))
+
+    # 分段交给后期处理任务
+    def assign_segments(self, job_id, segments):
+        for segment in segments:
+            self.save_segment(segment)
+            self._write(("segments", segment.room, segment.name), ASSIGN_SEGMENT, (job_id, segment.room, segment.name))
+
+    def save_job(self, job):
+        self._write(("jobs", job.id), UPSERT_JOB, (
+            job.id, job.room, job.status.name, job.error, job.created_time, job.started_time, job.finished_time))
+
+    # 进程退出时没有完成的任务
+    def interrupt_job(self, job_id, status, error):
+        self._write(("jobs", job_id), INTERRUPT_JOB, (status, error, time.time(), job_id))
+
+    def _write(self, key, sql, params):
+        # 同一行连续的同一种写入只保留最后一次; 不同的写入 (例如插入之后分配任务) 按调用顺序全部执行
+        index = self._rows.get(key)
+        if index is not None and self._pending[index][0] == sql:
+            self._pending[index] = (sql, params)
+        else:
+            self._rows[key] = len(self._pending)
+            self._pending.append((sql, params))
+
+        if len(self._pending) >= self.flush_batch:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.flush_delay)
+
+    def _schedule(self, delay):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._commit(self._take())
+            return
+        if self._timer is not None:
+            if delay > 0:
+                return
+            self._timer.cancel()
+        self._timer = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    def _take(self):
+        ops = self._pending
+        self._pending = []
+        self._rows = {}
+        return ops
+
+    def _commit(self, ops):
+        if len(ops) == 0:
+            return
+        with self._db_lock:
+            with self._db:
+                for sql, params in ops:
+                    self._db.execute(sql, params)
+        self.commits += 1
+
+    async def flush(self):
+        self._timer = None
+        # 同一时间只有一个提交, 之后的写入等下一次
+        while self._flushing is not None:
+            await asyncio.wait([self._flushing])
+        ops = self._take()
+        if len(ops) == 0:
+            return
+        self._flushing = asyncio.get_event_loop().run_in_executor(None, self._commit, ops)
+        try:
+            await self._flushing
+        except sqlite3.Error:
+            logger.exception("Commit %d state changes failed", len(ops))
+        finally:
+            self._flushing = None
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        await self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    # 以下只在启动恢复时使用, 直接读取
+    def _query(self, sql, params=()):
+        with self._db_lock:
+            cursor = self._db.execute(sql, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def record_sessions(self):
+        return self._query("SELECT * FROM record_sessions")
+
+    def janus_sessions(self, statuses):
+        marks = ",".join("?" * len(statuses))
+        return self._query("SELECT * FROM janus_sessions WHERE status IN ({m})".format(m=marks), tuple(statuses))
+
+    def jobs(self, statuses):
+        marks = ",".join("?" * len(statuses))
+        return self._query("SELECT * FROM jobs WHERE status IN ({m})".format(m=marks), tuple(statuses))
+
+    # 还没有交给后期处理, 或者所属任务没有完成的分段, 按房间分组
+    def unfinished_segments(self, jobs):
+        marks = ",".join("?" * len(jobs))
+        rows = self._query(
+            "SELECT * FROM segments WHERE job IS NULL OR job IN ({m}) ORDER BY room, begin_time".format(m=marks),
+            tuple(jobs))
+        rooms = {}
+        for row in rows:
+            segment = RecordSegment(name=row["name"], room=row["room"], publisher=row["publisher"],
+                                    begin_time=row["begin_time"], end_time=row["end_time"])
+            segment.begin_ms = row["begin_ms"]
+            segment.end_ms = row["end_ms"]
+            segment.chunk_list = row["chunk_list"]
+            segment.chunks = [tuple(c) for c in json.loads(row["chunks"])] if row["chunks"] else []
+            for name, begin, end in json.loads(row["composites"]) if row["composites"] else []:
+                segment.composites.append(RecordSegment(name=name, room=row["room"], publisher=row["publisher"],
+                                                        begin_time=begin, end_time=end))
+            rooms.setdefault(row["room"], []).append(segment)
+        return rooms
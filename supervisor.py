@@ -0,0 +1,236 @@
+import asyncio
+import collections
+import re
+import signal
+import time
+
+import log
+
+logger = log.get_logger("supervisor")
+
+# 停止时等待 ffmpeg 写完文件的时间 (秒), 超时后强制结束
+STOP_TIMEOUT = 10
+# 超过该时间没有进度输出认为进程卡住 (秒)
+STALL_TIMEOUT = 20
+# 异常退出后重启的延迟, 以及时间窗口内最多重启的次数
+RESTART_DELAY = 1
+RESTART_LIMIT = 5
+RESTART_WINDOW = 60
+
+# frame=  250 fps= 25 q=-1.0 size=    1024kB time=00:00:10.00 bitrate= 838.9kbits/s speed=   1x
+PROGRESS = re.compile(rb"size=\s*(\d+)\s*(\w+)\s+time=\s*(\S+)\s+bitrate=\s*(\S+?)(?:kbits/s)?\s+speed=\s*(\S+?)x?\s*$")
+SIZE_UNITS = {b"B": 1, b"kB": 1000, b"KiB": 1024, b"mB": 1000 ** 2, b"MiB": 1024 ** 2}
+
+
+def _seconds(value):
+    sign = -1 if value.startswith(b"-") else 1
+    try:
+        h, m, s = value.lstrip(b"-").split(b":")
+        return sign * (int(h) * 3600 + int(m) * 60 + float(s))
+    except ValueError:
+        return None
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+# 一个 ffmpeg 子进程: stderr 写入日志文件, 同时解析进度用于判断存活和码率
+class FFmpegProcess:
+    def __init__(self, key, cmd, log_path=None, room=None):
+        self.key = key
+        self.cmd = cmd
+        self.log_path = log_path
+        self.room = room
+        self.log = log.with_room(logger, room)
+        self.pid = None
+        self.returncode = None
+        self.stopping = False
+        self.started = None
+        self.last_progress = None
+        # 最近一次进度: 已写入字节数, 媒体时长 (秒), 码率 (kbit/s), 速度
+        self.size = 0
+        self.time = None
+        self.bitrate = None
+        self.speed = None
+        # 写入的第一帧和最后一帧的时间 (time.time()), 由进度行的 time= 倒推, 是估计值
+        self.first_frame = None
+        self.last_frame = None
+        self._proc = None
+        self._exited = None
+
+    @property
+    def running(self):
+        return self._proc is not None and self.returncode is None
+
+    def stalled(self, now, timeout=STALL_TIMEOUT):
+        return self.running and now - (self.last_progress or self.started) > timeout
+
+    async def start(self):
+        self._proc = await asyncio.create_subprocess_exec(*self.cmd, stdin=asyncio.subprocess.DEVNULL,
+                                                          stderr=asyncio.subprocess.PIPE)
+        self.pid = self._proc.pid
+        self.started = time.monotonic()
+        self._exited = asyncio.get_event_loop().create_task(self._run())
+        return self
+
+    async def _run(self):
+        out = open(self.log_path, "ab") if self.log_path is not None else None
+        try:
+            buffer = b""
+            while True:
+                data = await self._proc.stderr.read(4096)
+                if not data:
+                    break
+                if out is not None:
+                    out.write(data)
+                # 进度行以 \r 结尾, 其他日志以 \n 结尾
+                lines = re.split(rb"[\r\n]", buffer + data)
+                buffer = lines.pop()
+                for line in lines:
+                    self._parse(line)
+        finally:
+            if out is not None:
+                out.close()
+        self.returncode = await self._proc.wait()
+        return self.returncode
+
+    def _parse(self, line):
+        match = PROGRESS.search(line)
+        if match is None:
+            return
+        size, unit, t, bitrate, speed = match.groups()
+        self.size = int(size) * SIZE_UNITS.get(unit, 1)
+        self.time = _seconds(t)
+        self.bitrate = _float(bitrate)
+        self.speed = _float(speed)
+        self.last_progress = time.monotonic()
+        # 输出延迟只会让估计偏晚, 取最早的一次
+        if self.time is not None and self.time >= 0:
+            now = time.time()
+            if self.first_frame is None or now - self.time < self.first_frame:
+                self.first_frame = now - self.time
+            self.last_frame = self.first_frame + self.time
+
+    # 等待进程退出, 并且 stderr 已经读完
+    async def wait(self):
+        return await asyncio.shield(self._exited)
+
+    # 发送 SIGINT 让 ffmpeg 写完文件尾, 超时后 SIGKILL
+    async def stop(self, timeout=STOP_TIMEOUT):
+        if self._proc is None:
+            return None
+        self.stopping = True
+        if self.returncode is None:
+            try:
+                self._proc.send_signal(signal.SIGINT)
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(self.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.log.warning("ffmpeg %s did not exit in %ss, killing it", self.key, timeout)
+                try:
+                    self._proc.kill()
+                except ProcessLookupError:
+                    pass
+        return await self.wait()
+
+
+# 管理所有录制/合成进程, 异常退出时回调 on_crash 重启
+class RecorderSupervisor:
+    def __init__(self, stop_timeout=STOP_TIMEOUT, stall_timeout=STALL_TIMEOUT, restart_delay=RESTART_DELAY,
+                 restart_limit=RESTART_LIMIT, restart_window=RESTART_WINDOW):
+        self.stop_timeout = stop_timeout
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        self.restart_limit = restart_limit
+        self.restart_window = restart_window
+        # {key: FFmpegProcess}
+        self._processes = {}
+        # {key: deque(重启时间)}
+        self._restarts = {}
+        self._watchdog = None
+        self.crashes = 0
+
+    def __len__(self):
+        return len(self._processes)
+
+    def get(self, key) -> FFmpegProcess:
+        return self._processes.get(key)
+
+    def processes(self):
+        return list(self._processes.values())
+
+    def restarts(self, key):
+        return len(self._restarts.get(key, ()))
+
+    async def spawn(self, key, cmd, log_path=None, room=None, on_crash=None):
+        return await self.add(FFmpegProcess(key, cmd, log_path=log_path, room=room), on_crash=on_crash)
+
+    # 启动并管理一个录制进程 (FFmpegProcess 或者接口相同的进程内录制)
+    # on_crash(process, restart) 在进程异常退出后调用, 可以是协程; restart 为 False 时已经超过重启次数
+    async def add(self, process, on_crash=None):
+        await process.start()
+        key = process.key
+        self._processes[key] = process
+        asyncio.get_event_loop().create_task(self._watch(process, on_crash))
+        if self._watchdog is None:
+            self._watchdog = asyncio.get_event_loop().create_task(self._check_stalled())
+        return process
+
+    async def stop(self, key):
+        process = self._processes.pop(key, None)
+        if process is None:
+            return None
+        return await process.stop(self.stop_timeout)
+
+    async def close(self):
+        await asyncio.gather(*[self.stop(key) for key in list(self._processes)])
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            await asyncio.gather(self._watchdog, return_exceptions=True)
+            self._watchdog = None
+
+    async def _watch(self, process: FFmpegProcess, on_crash):
+        code = await process.wait()
+        if process.stopping:
+            return
+        if self._processes.get(process.key) is process:
+            self._processes.pop(process.key)
+        self.crashes += 1
+        process.log.error("Recorder %s exited unexpectedly with code %s", process.key, code)
+        if on_crash is None:
+            return
+
+        now = time.monotonic()
+        history = self._restarts.setdefault(process.key, collections.deque())
+        while len(history) > 0 and now - history[0] > self.restart_window:
+            history.popleft()
+        restart = len(history) < self.restart_limit
+        if restart:
+            history.append(now)
+            await asyncio.sleep(self.restart_delay)
+        else:
+            process.log.error("Recorder %s crashed %d times in %ss, giving up", process.key, len(history),
+                              self.restart_window)
+
+        try:
+            result = on_crash(process, restart)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            process.log.exception("Restart of %s failed", process.key)
+
+    async def _check_stalled(self):
+        while True:
+            await asyncio.sleep(self.stall_timeout / 2)
+            now = time.monotonic()
+            for process in self.processes():
+                if process.stalled(now, self.stall_timeout):
+                    process.log.warning("Recorder %s made no progress for %.0fs", process.key,
+                                        now - (process.last_progress or process.started),
+                                        extra={"rate_key": ("stalled", process.key)})
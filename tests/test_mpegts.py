@@ -0,0 +1,122 @@
+import asyncio
+import os
+import random
+
+import keyindex
+import mpegts
+from mpegts import TsWriter, PACKET_SIZE, PTS_DELAY, VIDEO_PID, AUDIO_PID
+
+
+# 每个 PES 开头的包: [(pid, pts, random_access)]
+def _pes_starts(data):
+    out = []
+    for pos in range(0, len(data), PACKET_SIZE):
+        assert data[pos] == 0x47
+        if not data[pos + 1] & 0x40:
+            continue
+        pid = ((data[pos + 1] & 0x1F) << 8) | data[pos + 2]
+        if pid not in (VIDEO_PID, AUDIO_PID):
+            continue
+        payload = pos + 4
+        random_access = False
+        if data[pos + 3] & 0x20:
+            random_access = data[payload] > 0 and data[payload + 1] & 0x40 != 0
+            payload += 1 + data[payload]
+        assert data[payload:payload + 3] == b"\x00\x00\x01"
+        out.append((pid, keyindex._pts(data, payload + 9), random_access))
+    return out
+
+
+def _write(path, frames, index=None):
+    writer = TsWriter(path, video=True, audio=True, index=index)
+    for kind, pts, data, key in frames:
+        if kind == "video":
+            writer.write_video(pts, data, key)
+        else:
+            writer.write_audio(pts, data)
+    writer.close()
+    return writer
+
+
+def _frames(rng, count, start=0):
+    frames = []
+    for n in range(count):
+        pts = start + n * 3000
+        frames.append(("video", pts, os.urandom(rng.choice([1, 100, 183, 184, 185, 5000, 30000])), n % 25 == 0))
+        frames.append(("audio", pts, os.urandom(rng.randrange(1, 400)), True))
+    return frames
+
+
+def test_writer_round_trip(tmp_path):
+    rng = random.Random(1)
+    frames = _frames(rng, 200)
+    path = str(tmp_path / "a.ts")
+    writer = _write(path, frames)
+    data = open(path, "rb").read()
+    assert len(data) % PACKET_SIZE == 0
+    assert writer.size == len(data)
+
+    starts = _pes_starts(data)
+    video = [(pts, ra) for pid, pts, ra in starts if pid == VIDEO_PID]
+    audio = [pts for pid, pts, _ in starts if pid == AUDIO_PID]
+    assert video == [(pts + PTS_DELAY, key) for kind, pts, _, key in frames if kind == "video"]
+    assert audio == [pts + PTS_DELAY for kind, pts, _, _ in frames if kind == "audio"]
+
+
+def test_scanner_finds_writer_keyframes(tmp_path):
+    rng = random.Random(2)
+    # 起始 pts 接近 33 位上限
+    frames = _frames(rng, 300, start=(1 << 33) - PTS_DELAY - 200 * 3000)
+    frames = [(k, p & 0x1FFFFFFFF, d, key) for k, p, d, key in frames]
+    path = str(tmp_path / "a.ts")
+    index = keyindex.KeyframeIndex(keyindex.index_path(path))
+    _write(path, frames, index=index)
+    index.close()
+
+    found = []
+    scanner = keyindex.TsScanner(found.append)
+    data = open(path, "rb").read()
+    # 任意大小的输入块
+    pos = 0
+    while pos < len(data):
+        size = rng.randrange(1, 5000)
+        scanner.feed(data[pos:pos + size])
+        pos += size
+
+    keys = [(pts + PTS_DELAY) & 0x1FFFFFFFF for kind, pts, _, key in frames if kind == "video" and key]
+    assert found == keys
+    # 写入时的索引与扫描得到的一致, 读取时按 pts 排序
+    written = [int(line) for line in open(keyindex.index_path(path)).read().split()]
+    assert written == keys
+    assert keyindex.load(path) == sorted(keys)
+
+
+def test_scanner_resyncs_after_garbage(tmp_path):
+    rng = random.Random(3)
+    path = str(tmp_path / "a.ts")
+    _write(path, _frames(rng, 100))
+    data = open(path, "rb").read()
+    found = []
+    scanner = keyindex.TsScanner(found.append)
+    scanner.feed(b"\x01\x02\x03" + data)
+    assert found == [pts + PTS_DELAY for pts in range(0, 100 * 3000, 25 * 3000)]
+
+
+def test_load_reads_old_index_format(tmp_path):
+    path = str(tmp_path / "a.ts")
+    with open(keyindex.index_path(path), "w") as f:
+        f.write("270000,376\n90000,0\n360000")
+    assert keyindex.load(path) == [90000, 270000, 360000]
+
+
+def test_crc32():
+    # MPEG-2 CRC32 的标准校验值
+    assert mpegts.crc32(b"123456789") == 0x0376E6E7
+
+
+def test_follow_indexes_finished_file(tmp_path):
+    rng = random.Random(4)
+    path = str(tmp_path / "a.ts")
+    _write(path, _frames(rng, 60))
+    assert asyncio.run(keyindex.follow(path, lambda: False, interval=0)) == 3
+    assert keyindex.load(path) == [PTS_DELAY, PTS_DELAY + 75000, PTS_DELAY + 150000]
@@ -0,0 +1,68 @@
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from ports import PortPool, PortExhausted
+
+
+def test_acquire_even_ports_until_exhausted():
+    pool = PortPool(start=30001, end=30010, probe=False)
+    ports = [pool.acquire(owner="r") for _ in range(pool.capacity)]
+    assert ports == [30002, 30004, 30006, 30008]
+    assert pool.in_use == 4 and pool.usage() == 1.0
+    with pytest.raises(PortExhausted):
+        pool.acquire()
+
+
+def test_release_returns_port_to_the_end():
+    pool = PortPool(start=30000, end=30008, probe=False)
+    first = pool.acquire()
+    pool.acquire()
+    assert pool.release(first)
+    assert not pool.release(first)
+    assert [pool.acquire(), pool.acquire(), pool.acquire()] == [30004, 30006, first]
+
+
+def test_reclaim_expired_lease():
+    pool = PortPool(start=30000, end=30002, probe=False)
+    port = pool.acquire(ttl=0.01)
+    with pytest.raises(PortExhausted):
+        pool.acquire()
+    time.sleep(0.02)
+    # 没有空闲端口时先回收过期的租约
+    assert pool.acquire() == port
+
+
+def test_reclaim_port_of_exited_process():
+    pool = PortPool(start=30000, end=30002, probe=False)
+    port = pool.acquire()
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    pool.bind(port, proc.pid)
+    proc.wait()
+    assert pool.reclaim() == 1
+    assert pool.in_use == 0
+
+
+def test_skips_ports_in_use_by_other_processes():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    busy = s.getsockname()[1]
+    try:
+        start = busy - busy % 2
+        pool = PortPool(start=start, end=start + 4, host="127.0.0.1")
+        # RTP 或者 RTCP 端口被占用的一对都跳过
+        assert pool.acquire() == start + 2
+        with pytest.raises(PortExhausted):
+            pool.acquire()
+    finally:
+        s.close()
+
+
+def test_configure_refuses_while_in_use():
+    pool = PortPool(start=30000, end=30004, probe=False)
+    pool.acquire()
+    with pytest.raises(AssertionError):
+        pool.configure(40000, 40010)
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from janus import SCREEN
+from recorder import gather_ffmpeg, RecordFile, RecordSegment
+
+
+def test_gather_cancels_siblings_on_failure():
+    async def main():
+        cancelled = []
+
+        async def slow(name):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(name)
+                raise
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await gather_ffmpeg(slow("a"), fail(), slow("b"))
+        # 返回前其余任务已经结束
+        assert sorted(cancelled) == ["a", "b"]
+        assert await gather_ffmpeg(asyncio.sleep(0, 1), asyncio.sleep(0, 2)) == [1, 2]
+    asyncio.run(main())
+
+
+def test_gather_cancelled_from_outside():
+    async def main():
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        outer = asyncio.ensure_future(gather_ffmpeg(slow(), slow()))
+        await asyncio.sleep(0.01)
+        outer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await outer
+        assert cancelled == [True, True]
+    asyncio.run(main())
+
+
+def _segment(name, publisher, begin_ms, end_ms):
+    segment = RecordSegment(name=name, room=5, publisher=publisher, begin_time=begin_ms // 1000,
+                            end_time=end_ms // 1000)
+    segment.begin_ms = begin_ms
+    segment.end_ms = end_ms
+    return segment
+
+
+def test_cuts_use_media_duration_of_camera_files():
+    cam1 = _segment("1_0.ts", 1, 0, 10000)
+    cam2 = _segment("1_20.ts", 1, 20000, 30000)
+    screen = _segment("9_5.ts", SCREEN, 5000, 25000)
+    file = RecordFile(room=5, cam=cam1, screen=screen)
+    file.cameras = [cam1, cam2]
+    # 第一个文件的媒体时长比录制时间短, 第二个文件在拼接后从 9.5 秒开始
+    file._durations = {id(cam1): 9500, id(cam2): 10200}
+
+    cuts = [(c.begin, c.end, c.merge, c.screen_offset) for c in file._cal_cuts()]
+    assert cuts == [(0.0, 5.0, False, 0), (5.0, 10.0, True, 0.0), (None, None, False, 5.0),
+                    (9.5, 14.5, True, 15.0), (14.5, 19.5, False, 0)]
+
+    # 读取不到媒体时长时按录制时间估计
+    file._durations = {id(cam2): 10200}
+    assert [c.begin for c in file._cal_cuts()] == [0.0, 5.0, None, 10.0, 15.0]
+
+
+def test_cut_offset_stays_inside_camera_file():
+    cam1 = _segment("1_0.ts", 1, 0, 10000)
+    cam2 = _segment("1_12.ts", 1, 12000, 20000)
+    screen = _segment("9_0.ts", SCREEN, 0, 20000)
+    file = RecordFile(room=5, cam=cam1, screen=screen)
+    file.cameras = [cam1, cam2]
+    # 录制时间比文件长时, 后面的分段不会越过文件末尾读到下一个文件的内容
+    file._durations = {id(cam1): 8000, id(cam2): 8000}
+    for cut in file._cal_cuts():
+        if cut.begin is not None:
+            assert cut.begin <= (8.0 if cut.begin_ms < 12000 else 16.0)
+
+
+def test_cuts_match_any_finished_composite():
+    cam1 = _segment("1_0.ts", 1, 0, 10000)
+    cam2 = _segment("1_20.ts", 1, 20000, 30000)
+    screen = _segment("9_0.ts", SCREEN, 0, 30000)
+    # 摄像头离开又加入, 屏幕分段有两个实时合成的文件; 第二次合成的进程还没有结束
+    screen.composites = [_segment("pip_0.ts", SCREEN, 0, 10000), _segment("pip_20.ts", SCREEN, 20000, 30000)]
+    screen.composites[1].end_time = None
+    file = RecordFile(room=5, cam=cam1, screen=screen)
+    file.cameras = [cam1, cam2]
+    cuts = file._cal_cuts()
+    assert [(c.begin_ms, c.merge) for c in cuts] == [(0, True), (10000, False), (20000, True)]
+    assert [getattr(file._composite(c), "name", None) for c in cuts] == ["pip_0.ts", None, None]
+
+    screen.composites[1].end_time = 30
+    assert [getattr(file._composite(c), "name", None) for c in cuts] == ["pip_0.ts", None, "pip_20.ts"]
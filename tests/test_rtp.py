@@ -0,0 +1,157 @@
+import random
+import struct
+
+import pytest
+
+from rtp import JitterBuffer, H264Depacketizer, OpusDepacketizer, parse, START_CODE, NAL_FU_A, NAL_STAP_A
+
+
+def _rtp(seq, timestamp=0, payload=b"", marker=False, pt=96):
+    return struct.pack(">BBHII", 0x80, (0x80 if marker else 0) | pt, seq & 0xFFFF, timestamp, 1234) + payload
+
+
+def _push(jitter, seqs, drop=()):
+    out = []
+    for seq in seqs:
+        if seq in drop:
+            continue
+        # 包数据只在下一次 push 之前有效
+        out += [(parse(memoryview(p))[2], d) for p, d in jitter.push(seq & 0xFFFF, memoryview(_rtp(seq)))]
+    return out
+
+
+def test_parse_header():
+    pt, marker, seq, timestamp, payload = parse(memoryview(_rtp(7, 90000, b"abc", marker=True, pt=102)))
+    assert (pt, marker, seq, timestamp, bytes(payload)) == (102, True, 7, 90000, b"abc")
+    assert parse(memoryview(b"\x00" * 12)) is None
+    assert parse(memoryview(b"\x80")) is None
+
+
+def test_jitter_in_order_across_wraparound():
+    jitter = JitterBuffer()
+    seqs = [s & 0xFFFF for s in range(65530, 65540)]
+    assert [s for s, _ in _push(jitter, seqs)] == seqs
+    assert jitter.lost == 0 and jitter.late == 0
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_jitter_reorders_across_wraparound(seed):
+    rng = random.Random(seed)
+    seqs = list(range(65400, 65400 + 300))
+    # 每个包最多偏移 8 个位置
+    shuffled = sorted(seqs, key=lambda s: s + rng.uniform(0, 8))
+    jitter = JitterBuffer(slots=64, latency=32)
+    shuffled = [seqs[0]] + [s for s in shuffled if s != seqs[0]]
+    out = _push(jitter, shuffled) + [(parse(p)[2], d) for p, d in jitter.flush()]
+    assert [s for s, _ in out] == [s & 0xFFFF for s in seqs]
+    assert not any(d for _, d in out)
+    assert jitter.lost == 0
+
+
+def test_jitter_skips_lost_packet_after_latency():
+    jitter = JitterBuffer(slots=16, latency=4)
+    seqs = [s & 0xFFFF for s in range(65533, 65545)]
+    lost = seqs[4]
+    out = _push(jitter, seqs, drop=(lost,))
+    assert [s for s, _ in out] == [s for s in seqs if s != lost][:len(out)]
+    # 缺包之后的第一个包带 discontinuity
+    flags = {s: d for s, d in out}
+    assert flags[seqs[5]] is True
+    assert not any(d for s, d in out if s != seqs[5])
+    assert jitter.lost == 1
+    out += [(parse(p)[2], d) for p, d in jitter.flush()]
+    assert [s for s, _ in out] == [s for s in seqs if s != lost]
+
+
+def test_jitter_drops_late_and_duplicate_packets():
+    jitter = JitterBuffer(slots=16, latency=2)
+    out = _push(jitter, [10, 11, 13, 14, 15])
+    assert [s for s, _ in out] == [10, 11, 13, 14, 15]
+    assert _push(jitter, [12, 14]) == []
+    assert jitter.late == 2
+
+
+def test_jitter_resets_on_large_gap():
+    jitter = JitterBuffer(slots=16, latency=8)
+    out = _push(jitter, [100, 102, 5000, 5001])
+    assert [s for s, _ in out] == [100, 102, 5000, 5001]
+    assert jitter.lost == 1
+
+
+SPS = b"\x67\x42\xe0\x1f\xaa"
+PPS = b"\x68\xce\x3c\x80"
+IDR = b"\x65" + bytes(range(200))
+SLICE = b"\x41" + bytes(range(50))
+
+
+def _stap_a(*nals):
+    return bytes([NAL_STAP_A]) + b"".join(struct.pack(">H", len(n)) + n for n in nals)
+
+
+def _fu_a(nal, size):
+    indicator = (nal[0] & 0xE0) | NAL_FU_A
+    body = nal[1:]
+    chunks = [body[i:i + size] for i in range(0, len(body), size)]
+    out = []
+    for n, chunk in enumerate(chunks):
+        header = (0x80 if n == 0 else 0) | (0x40 if n == len(chunks) - 1 else 0) | (nal[0] & 0x1F)
+        out.append(bytes([indicator, header]) + chunk)
+    return out
+
+
+def _annexb(*nals):
+    return b"".join(START_CODE + n for n in nals)
+
+
+def test_h264_stap_a_and_fu_a_reassembly():
+    depacketizer = H264Depacketizer()
+    out = depacketizer.push(memoryview(_stap_a(SPS, PPS)), 3000, False)
+    fragments = _fu_a(IDR, 60)
+    for n, fragment in enumerate(fragments):
+        out += depacketizer.push(memoryview(fragment), 3000, n == len(fragments) - 1)
+    assert len(out) == 1
+    timestamp, data, key = out[0]
+    assert (timestamp, bytes(data), key) == (3000, _annexb(SPS, PPS, IDR), True)
+
+    out = depacketizer.push(memoryview(SLICE), 6000, True)
+    assert [(t, bytes(d), k) for t, d, k in out] == [(6000, _annexb(SLICE), False)]
+
+
+def test_h264_waits_for_keyframe():
+    depacketizer = H264Depacketizer()
+    assert depacketizer.push(memoryview(SLICE), 0, True) == []
+    assert len(depacketizer.push(memoryview(_stap_a(SPS, PPS, IDR)), 3000, True)) == 1
+    assert len(depacketizer.push(memoryview(SLICE), 6000, True)) == 1
+    # 丢包之后直到下一个关键帧都不输出
+    assert depacketizer.push(memoryview(SLICE), 9000, True, discontinuity=True) == []
+    assert depacketizer.push(memoryview(SLICE), 12000, True) == []
+    out = depacketizer.push(memoryview(IDR), 15000, True)
+    assert [(t, k) for t, _, k in out] == [(15000, True)]
+
+
+def test_h264_drops_fu_a_without_start():
+    depacketizer = H264Depacketizer()
+    depacketizer.push(memoryview(IDR), 0, True)
+    fragments = _fu_a(SLICE, 20)
+    out = []
+    for n, fragment in enumerate(fragments[1:]):
+        out += depacketizer.push(memoryview(fragment), 3000, n == len(fragments) - 2)
+    assert out == []
+    # 下一帧正常
+    out = depacketizer.push(memoryview(SLICE), 6000, True)
+    assert [bytes(d) for _, d, _ in out] == [_annexb(SLICE)]
+
+
+def test_h264_emits_frame_on_timestamp_change_without_marker():
+    depacketizer = H264Depacketizer()
+    assert depacketizer.push(memoryview(IDR), 0, False) == []
+    out = depacketizer.push(memoryview(SLICE), 3000, False)
+    assert [(t, bytes(d)) for t, d, _ in out] == [(0, _annexb(IDR))]
+    assert [(t, bytes(d)) for t, d, _ in depacketizer.flush()] == [(3000, _annexb(SLICE))]
+
+
+def test_opus_passes_packets_through():
+    depacketizer = OpusDepacketizer()
+    assert [(t, bytes(d), k) for t, d, k in depacketizer.push(memoryview(b"\xfc\x01"), 960, True)] == \
+        [(960, b"\xfc\x01", True)]
+    assert depacketizer.push(memoryview(b""), 1920, True) == []
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from scheduler import FFmpegScheduler
+
+
+def test_acquire_within_budget():
+    async def main():
+        scheduler = FFmpegScheduler(budget=8, threads_per_job=4)
+        assert await scheduler.acquire() == 4
+        assert await scheduler.acquire(2) == 2
+        # 超过预算的请求按预算分配
+        scheduler.release(6)
+        assert await scheduler.acquire(100) == 8
+        assert scheduler.in_use == 8
+    asyncio.run(main())
+
+
+def test_waiters_are_served_in_order():
+    async def main():
+        scheduler = FFmpegScheduler(budget=4, threads_per_job=4)
+        order = []
+        await scheduler.acquire(3)
+
+        async def job(name, threads):
+            n = await scheduler.acquire(threads)
+            order.append(name)
+            await asyncio.sleep(0)
+            scheduler.release(n)
+
+        tasks = [asyncio.ensure_future(job("big", 4)), asyncio.ensure_future(job("small", 1))]
+        await asyncio.sleep(0.01)
+        # 剩余 1 个线程, 但排在后面的小任务不能越过大任务
+        assert order == [] and scheduler.queued == 2
+        scheduler.release(3)
+        await asyncio.gather(*tasks)
+        assert order == ["big", "small"]
+        assert scheduler.in_use == 0
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_threads_back():
+    async def main():
+        scheduler = FFmpegScheduler(budget=2, threads_per_job=2)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert scheduler.queued == 0
+        scheduler.release(2)
+        assert scheduler.in_use == 0
+        assert await scheduler.acquire() == 2
+    asyncio.run(main())
+
+
+def test_run_releases_on_error():
+    async def main():
+        scheduler = FFmpegScheduler(budget=2, threads_per_job=2)
+
+        async def fail(threads):
+            assert threads == 2
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await scheduler.run(fail)
+        assert scheduler.in_use == 0
+    asyncio.run(main())
+
+
+def test_configure_keeps_threads_in_use():
+    async def main():
+        scheduler = FFmpegScheduler(budget=4, threads_per_job=4)
+        await scheduler.acquire(3)
+        waiter = asyncio.ensure_future(scheduler.acquire(2))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        # 增加预算后唤醒等待的任务
+        scheduler.configure(budget=8)
+        assert await waiter == 2
+        assert scheduler.in_use == 5
+    asyncio.run(main())
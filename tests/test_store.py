@@ -0,0 +1,116 @@
+import asyncio
+import sqlite3
+
+from janus import JanusSession, JanusSessionStatus, RecordSession, RecordSessionStatus
+from jobs import ProcessingJob, JobStatus
+from recorder import RecordFile, RecordSegment
+from store import StateStore
+
+
+def _segment(name, begin, end=None, publisher=1):
+    segment = RecordSegment(name=name, room=5, publisher=publisher, begin_time=begin, end_time=end)
+    segment.begin_ms = begin * 1000 + 120
+    return segment
+
+
+def test_segments_round_trip_and_job_assignment(tmp_path):
+    path = str(tmp_path / "state.db")
+
+    async def write():
+        store = StateStore(path)
+        done = _segment("1_100.ts", 100, 200)
+        done.chunk_list = "1_100.csv"
+        done.chunks = [("1_100_00000.ts", 0.0, 10.0)]
+        running = _segment("9_150.ts", 150, publisher=9)
+        running.composites = [_segment("pip_150.ts", 151, 160, publisher=9), _segment("pip_170.ts", 171, publisher=9)]
+        pending = _segment("2_300.ts", 300, 400)
+        for segment in (done, running, pending):
+            store.save_segment(segment)
+
+        finished = ProcessingJob(room=5, file=RecordFile(room=5, cam=None))
+        finished.status = JobStatus.Finished
+        interrupted = ProcessingJob(room=5, file=RecordFile(room=5, cam=None))
+        interrupted.status = JobStatus.Running
+        store.save_job(finished)
+        store.save_job(interrupted)
+        store.assign_segments(finished.id, [done])
+        store.assign_segments(interrupted.id, [running])
+        # 分配之后的更新不会清除任务
+        done.end_ms = 200500
+        store.save_segment(done)
+        await store.close()
+        return interrupted.id
+
+    interrupted = asyncio.run(write())
+    store = StateStore(path)
+    jobs = store.jobs([JobStatus.Pending.name, JobStatus.Running.name])
+    assert [row["id"] for row in jobs] == [interrupted]
+
+    rooms = store.unfinished_segments([interrupted])
+    segments = {s.name: s for s in rooms[5]}
+    assert sorted(segments) == ["2_300.ts", "9_150.ts"]
+    running = segments["9_150.ts"]
+    assert running.end_time is None and running.begin_ms == 150120 and running.is_screen
+    assert [(c.name, c.begin_time, c.end_time) for c in running.composites] == \
+        [("pip_150.ts", 151, 160), ("pip_170.ts", 171, None)]
+
+    # 已经完成的任务的分段不会再处理
+    assert "1_100.ts" not in segments
+    asyncio.run(store.close())
+
+
+def test_writes_are_coalesced(tmp_path):
+    async def main():
+        store = StateStore(str(tmp_path / "state.db"), flush_delay=0.01)
+        session = JanusSession(room=7, pin="1234", display="record_7")
+        for status in (JanusSessionStatus.Starting, JanusSessionStatus.Forwarding, JanusSessionStatus.Recording):
+            session.status = status
+            store.save_janus_session(session)
+        record = RecordSession(room=7, publisher=1, startedTime=10)
+        record.status = RecordSessionStatus.Recording
+        record.recorder_pid = 4242
+        store.save_record_session(record)
+        await asyncio.sleep(0.05)
+        # 一次事务, 同一行只写最后的状态
+        assert store.commits == 1
+        rows = store.janus_sessions([JanusSessionStatus.Recording.name])
+        assert [(r["room"], r["pin"]) for r in rows] == [(7, "1234")]
+        assert [r["recorder_pid"] for r in store.record_sessions()] == [4242]
+
+        store.delete_record_session(7, 1)
+        await store.flush()
+        assert store.record_sessions() == []
+        await store.close()
+    asyncio.run(main())
+
+
+def test_interrupt_job(tmp_path):
+    async def main():
+        store = StateStore(str(tmp_path / "state.db"))
+        job = ProcessingJob(room=3, file=RecordFile(room=3, cam=None))
+        store.save_job(job)
+        store.interrupt_job(job.id, JobStatus.Failed.name, "interrupted by restart")
+        await store.flush()
+        rows = store.jobs([JobStatus.Failed.name])
+        assert [(r["id"], r["error"]) for r in rows] == [(job.id, "interrupted by restart")]
+        assert rows[0]["finished"] is not None
+        await store.close()
+    asyncio.run(main())
+
+
+def test_migrates_single_composite_columns(tmp_path):
+    path = str(tmp_path / "state.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE segments (room INTEGER NOT NULL, name TEXT NOT NULL, publisher INTEGER NOT NULL, "
+               "begin_time INTEGER NOT NULL, end_time INTEGER, begin_ms INTEGER, end_ms INTEGER, chunk_list TEXT, "
+               "chunks TEXT, composite TEXT, composite_begin INTEGER, composite_end INTEGER, job TEXT, "
+               "PRIMARY KEY (room, name))")
+    db.execute("INSERT INTO segments (room, name, publisher, begin_time, composite, composite_begin, composite_end) "
+               "VALUES (5, '9_150.ts', 9, 150, 'pip_151.ts', 151, 180)")
+    db.commit()
+    db.close()
+
+    store = StateStore(path)
+    segment = store.unfinished_segments([])[5][0]
+    assert [(c.name, c.begin_time, c.end_time) for c in segment.composites] == [("pip_151.ts", 151, 180)]
+    asyncio.run(store.close())
@@ -0,0 +1,145 @@
+import random
+
+import pytest
+
+import timeline
+from timeline import Interval
+from recorder import MIN_SPAN_MS
+
+# 随机用例: 在小范围内生成区间, 按整数点集合与暴力算法比较
+SEEDS = range(200)
+RANGE = 200
+
+
+def _random_intervals(rng, count, length=RANGE, max_len=60):
+    out = []
+    for _ in range(count):
+        begin = rng.randrange(length)
+        out.append(Interval(begin, begin + rng.randrange(max_len)))
+    return out
+
+
+def _points(intervals):
+    return {t for i in intervals for t in range(i.begin, i.end)}
+
+
+def _assert_normalized(intervals):
+    for i in intervals:
+        assert i.begin < i.end
+    for a, b in zip(intervals, intervals[1:]):
+        # 有序, 不重叠也不相邻
+        assert a.end < b.begin
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_normalize_matches_set_union(seed):
+    rng = random.Random(seed)
+    intervals = _random_intervals(rng, rng.randrange(12))
+    out = timeline.normalize(intervals)
+    _assert_normalized(out)
+    assert _points(out) == _points(intervals)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_set_operations(seed):
+    rng = random.Random(seed)
+    a = timeline.normalize(_random_intervals(rng, rng.randrange(10)))
+    b = timeline.normalize(_random_intervals(rng, rng.randrange(10)))
+
+    union = timeline.union(a, b)
+    _assert_normalized(union)
+    assert _points(union) == _points(a) | _points(b)
+
+    both = timeline.intersect(a, b)
+    assert _points(both) == _points(a) & _points(b)
+    assert sum(i.duration for i in both) == len(_points(a) & _points(b))
+
+    rest = timeline.subtract(a, b)
+    assert _points(rest) == _points(a) - _points(b)
+    assert sum(i.duration for i in rest) == len(_points(a) - _points(b))
+
+
+def _segments(rng, kind, count):
+    out = []
+    for n, interval in enumerate(_random_intervals(rng, count, max_len=80)):
+        interval.source = "{k}{n}".format(k=kind, n=n)
+        out.append(interval)
+    return out
+
+
+# 每个时刻: 最先开始的摄像头, 最后开始的屏幕
+def _expected(cameras, screens, t):
+    cams = [c for c in cameras if c.begin <= t < c.end]
+    shares = [s for s in screens if s.begin <= t < s.end]
+    cam = min(cams, key=lambda i: (i.begin, -i.end)).source if cams else None
+    screen = min(shares, key=lambda i: (-i.begin, -i.end)).source if shares else None
+    return cam, screen
+
+
+def _assert_spans(spans, cameras, screens):
+    for span in spans:
+        assert span.begin < span.end
+        assert span.camera is not None or span.screen is not None
+    for a, b in zip(spans, spans[1:]):
+        assert a.end <= b.begin
+    # 覆盖所有录制的时间, 不多也不少
+    assert _points(spans) == _points(cameras) | _points(screens)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_plan_picks_segments(seed):
+    rng = random.Random(seed)
+    cameras = _segments(rng, "c", rng.randrange(6))
+    screens = _segments(rng, "s", rng.randrange(6))
+    spans = timeline.plan(cameras, screens)
+    _assert_spans(spans, cameras, screens)
+
+    sources = {i.source: i for i in cameras + screens}
+    for span in spans:
+        # 分段在自己的录制区间内
+        for source in filter(None, (span.camera, span.screen)):
+            assert sources[source].begin <= span.begin and span.end <= sources[source].end
+        for t in range(span.begin, span.end):
+            assert (span.camera, span.screen) == _expected(cameras, screens, t)
+    # 相邻的区间使用的分段不同
+    for a, b in zip(spans, spans[1:]):
+        assert a.end < b.begin or (a.camera, a.screen) != (b.camera, b.screen)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_plan_absorbs_short_spans(seed):
+    rng = random.Random(seed)
+    # 按秒生成, 与录制时使用的 MIN_SPAN_MS 同一量级
+    scale = MIN_SPAN_MS // 3
+    cameras = _segments(rng, "c", rng.randrange(6))
+    screens = _segments(rng, "s", rng.randrange(6))
+    for i in cameras + screens:
+        i.begin *= scale
+        i.end *= scale
+    spans = timeline.plan(cameras, screens, min_span=MIN_SPAN_MS)
+
+    for span in spans:
+        assert span.begin < span.end
+        assert span.camera is not None or span.screen is not None
+    for a, b in zip(spans, spans[1:]):
+        assert a.end <= b.begin
+    # 并入相邻区间后总的覆盖不变
+    covered = timeline.normalize([Interval(s.begin, s.end) for s in spans])
+    recorded = timeline.normalize(cameras + screens)
+    assert [(i.begin, i.end) for i in covered] == [(i.begin, i.end) for i in recorded]
+    # 短区间只有在前后都没有相邻区间时保留
+    for n, span in enumerate(spans):
+        if span.duration < MIN_SPAN_MS:
+            assert n == 0 or spans[n - 1].end < span.begin
+            assert n == len(spans) - 1 or span.end < spans[n + 1].begin
+
+
+def test_plan_large_input_is_ordered():
+    rng = random.Random(1)
+    cameras = _segments(rng, "c", 2000)
+    screens = _segments(rng, "s", 2000)
+    for i in cameras + screens:
+        i.begin *= 1000
+        i.end *= 1000
+    spans = timeline.plan(cameras, screens, min_span=MIN_SPAN_MS)
+    assert all(a.end <= b.begin for a, b in zip(spans, spans[1:]))
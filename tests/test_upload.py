@@ -0,0 +1,134 @@
+import asyncio
+import os
+import random
+import socket
+
+import pytest
+
+import upload
+from upload import S3Uploader, UploadState, UploadError, MIN_PART_SIZE
+from bench.fake_s3 import FakeS3
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _run(tmp_path, test, fail_rate=0.0):
+    async def main():
+        s3 = FakeS3(str(tmp_path / "s3"), port=_free_port(), fail_rate=fail_rate)
+        await s3.start()
+        uploader = S3Uploader(s3.url, "records", "AKID", "secret", part_size=MIN_PART_SIZE, concurrency=3)
+        try:
+            await test(s3, uploader)
+        finally:
+            await uploader.close()
+            await s3.close()
+    asyncio.run(main())
+
+
+def _recording(tmp_path, size):
+    path = str(tmp_path / "join_merged.ts")
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(upload, "RETRY_DELAY", 0)
+
+
+def test_multipart_upload(tmp_path):
+    path = _recording(tmp_path, 2 * MIN_PART_SIZE + 12345)
+
+    async def test(s3, uploader):
+        await uploader.upload(path, "7/100_join_merged.ts")
+        # 3 个分片 + 开始 + 完成
+        assert s3.requests == 5
+        with open(str(tmp_path / "s3" / "records" / "7" / "100_join_merged.ts"), "rb") as f:
+            assert f.read() == open(path, "rb").read()
+        assert UploadState.load(path) is None
+        assert s3.uploads == {}
+
+    _run(tmp_path, test)
+
+
+def test_failed_parts_are_retried(tmp_path):
+    path = _recording(tmp_path, 3 * MIN_PART_SIZE)
+
+    async def test(s3, uploader):
+        random.seed(4)
+        await uploader.upload(path, "k.ts")
+        assert s3.failures > 0
+        with open(str(tmp_path / "s3" / "records" / "k.ts"), "rb") as f:
+            assert f.read() == open(path, "rb").read()
+
+    _run(tmp_path, test, fail_rate=0.4)
+
+
+def test_resume_uploads_only_missing_parts(tmp_path):
+    path = _recording(tmp_path, 3 * MIN_PART_SIZE)
+
+    async def test(s3, uploader):
+        # 第一次上传只完成了第 1 个分片
+        state = UploadState(path, "k.ts", os.path.getsize(path), os.path.getmtime(path), MIN_PART_SIZE)
+        state.upload_id = await uploader._initiate("k.ts")
+        state.parts[1] = await uploader._upload_part(state, 1, 0, MIN_PART_SIZE)
+        state.save()
+        before = s3.requests
+
+        await uploader.upload(path, "k.ts")
+        # 剩余 2 个分片 + 完成
+        assert s3.requests - before == 3
+        with open(str(tmp_path / "s3" / "records" / "k.ts"), "rb") as f:
+            assert f.read() == open(path, "rb").read()
+
+    _run(tmp_path, test)
+
+
+def test_restarts_when_upload_is_gone(tmp_path):
+    path = _recording(tmp_path, MIN_PART_SIZE + 1)
+
+    async def test(s3, uploader):
+        state = UploadState(path, "k.ts", os.path.getsize(path), os.path.getmtime(path), MIN_PART_SIZE,
+                            upload_id="expired", parts={1: "etag"})
+        state.save()
+        await uploader.upload(path, "k.ts")
+        with open(str(tmp_path / "s3" / "records" / "k.ts"), "rb") as f:
+            assert f.read() == open(path, "rb").read()
+
+    _run(tmp_path, test)
+
+
+def test_client_errors_are_not_retried(tmp_path):
+    path = _recording(tmp_path, 100)
+
+    async def test(s3, uploader):
+        # 没有签名的请求被拒绝
+        uploader._sign = lambda *args: {}
+        with pytest.raises(UploadError) as error:
+            await uploader.upload(path, "k.ts")
+        assert error.value.status == 403
+        assert s3.requests == 1
+
+    _run(tmp_path, test)
+
+
+def test_resume_finds_state_files(tmp_path):
+    room = tmp_path / "7"
+    room.mkdir()
+    path = _recording(room, 1000)
+
+    async def test(s3, uploader):
+        UploadState(path, "7/k.ts", os.path.getsize(path), os.path.getmtime(path), MIN_PART_SIZE).save()
+        assert await uploader.resume(str(tmp_path)) == 1
+        await asyncio.gather(*uploader._tasks)
+        assert os.path.isfile(str(tmp_path / "s3" / "records" / "7" / "k.ts"))
+        assert UploadState.load(path) is None
+
+    _run(tmp_path, test)
@@ -0,0 +1,114 @@
+import asyncio
+
+from janus import JanusError, JanusSession, JanusSessionStatus, SCREEN
+from recorder import LiveComposite, RecordSegment
+from wsclient import WebSocketClient
+
+
+def test_stop_room_that_is_not_recording():
+    async def main():
+        client = WebSocketClient("ws://127.0.0.1:1")
+        client._sessions = {}
+        left = []
+
+        async def leave(room):
+            left.append(room)
+        client._stop_all_sessions = leave
+        client._processing_file = lambda room: None
+
+        session = JanusSession(room=7, pin="1234", display="record_7")
+        session.status = JanusSessionStatus.Forwarding
+        client._sessions[7] = session
+        stopped = JanusSession(room=8, pin="1234", display="record_8")
+        stopped.status = JanusSessionStatus.Processing
+        client._sessions[8] = stopped
+        starting = JanusSession(room=10, pin="1234", display="record_10")
+        starting.status = JanusSessionStatus.Starting
+        client._sessions[10] = starting
+
+        # 重复的停止请求, 已经停止的和还在加入的房间都不会 destroy
+        results = await client.stop_many([7, 7, 8, 9, 10])
+        assert results == [(True, None), (False, None), (False, None), (False, None), (False, None)]
+        assert starting.status == JanusSessionStatus.Starting
+        assert left == [7]
+        assert await client.stop_recording(7) == (False, None)
+        await client.close()
+    asyncio.run(main())
+
+
+class _Connection:
+    def __init__(self, fail):
+        self.fail = fail
+        self.requests = []
+
+    async def request(self, message, ack=False, timeout=None):
+        kind = message["janus"] if message["janus"] != "message" else message["body"]["request"]
+        self.requests.append(kind)
+        if kind == self.fail:
+            raise self.error
+        return {"data": {"id": len(self.requests)}}
+
+
+class _Pool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.released = []
+
+    def connection(self, room):
+        return self.conn
+
+    def release(self, room):
+        self.released.append(room)
+
+
+def _failed_start(fail, error):
+    async def main():
+        client = WebSocketClient("ws://127.0.0.1:1")
+        client._sessions = {}
+        client._handles = {}
+        conn = _Connection(fail)
+        conn.error = error
+        client._pool = _Pool(conn)
+        try:
+            result = await client.start_recording(7, "1234")
+        except Exception as e:
+            result = e
+        session = client._sessions[7]
+        return result, session, conn, client
+    return asyncio.run(main())
+
+
+def test_failed_join_destroys_session_and_releases_connection():
+    result, session, conn, client = _failed_start("join", JanusError("join", "room not found"))
+    assert result is False
+    assert conn.requests == ["create", "attach", "join", "destroy"]
+    assert session.status == JanusSessionStatus.Failed
+    assert client._pool.released == [7] and client._handles == {}
+
+
+def test_unexpected_error_during_start_cleans_up():
+    result, session, conn, client = _failed_start("attach", KeyError("data"))
+    assert isinstance(result, KeyError)
+    assert conn.requests == ["create", "attach", "destroy"]
+    assert session.status == JanusSessionStatus.Failed
+    assert client._pool.released == [7]
+
+
+def test_crashed_compositor_ends_its_composite():
+    async def main():
+        client = WebSocketClient("ws://127.0.0.1:1")
+        client._compositors = {}
+        camera = RecordSegment(name="1_100.ts", room=7, publisher=1, begin_time=100)
+        screen = RecordSegment(name="9_100.ts", room=7, publisher=SCREEN, begin_time=100)
+        composite = LiveComposite(room=7, camera=camera, screen=screen, begin_time=110)
+        screen.composites.append(composite.segment)
+        client._compositors[7] = composite
+
+        class Process:
+            first_frame = None
+        # 超过重启次数时不再合成, 已有的文件仍然可以使用
+        await client._restart_compositor(7, composite, Process(), False)
+        assert 7 not in client._compositors
+        assert composite.segment.end_time is not None and composite.pid is None
+        await client.close()
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+import heapq
+
+# 时间线: 毫秒时间戳的区间运算, 由摄像头和屏幕分段计算渲染区间
+# 所有区间为左闭右开 [begin, end)
+
+# 渲染区间的类型
+CAMERA = "camera"
+SCREEN = "screen"
+PIP = "pip"
+
+
+class Interval:
+    __slots__ = ("begin", "end", "source")
+
+    def __init__(self, begin, end, source=None):
+        self.begin = begin
+        self.end = end
+        # 区间对应的录制分段
+        self.source = source
+
+    @property
+    def duration(self):
+        return self.end - self.begin
+
+    def __repr__(self):
+        return "Interval({b}, {e})".format(b=self.begin, e=self.end)
+
+
+# 一个渲染区间, camera / screen 为这段时间使用的分段 (可能为 None)
+class Span:
+    __slots__ = ("begin", "end", "camera", "screen")
+
+    def __init__(self, begin, end, camera=None, screen=None):
+        self.begin = begin
+        self.end = end
+        self.camera = camera
+        self.screen = screen
+
+    @property
+    def duration(self):
+        return self.end - self.begin
+
+    @property
+    def kind(self):
+        if self.camera is None:
+            return SCREEN
+        return PIP if self.screen is not None else CAMERA
+
+    def __repr__(self):
+        return "Span({b}, {e}, {k})".format(b=self.begin, e=self.end, k=self.kind)
+
+
+# 排序并合并重叠或相邻的区间, 结果不带 source
+def normalize(intervals):
+    out = []
+    for interval in sorted(intervals, key=lambda i: i.begin):
+        if interval.end <= interval.begin:
+            continue
+        if out and interval.begin <= out[-1].end:
+            out[-1].end = max(out[-1].end, interval.end)
+        else:
+            out.append(Interval(interval.begin, interval.end))
+    return out
+
+
+def union(a, b):
+    return normalize(list(a) + list(b))
+
+
+# 以下两个运算的输入为 normalize 之后的列表
+def intersect(a, b):
+    out = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        begin = max(a[i].begin, b[j].begin)
+        end = min(a[i].end, b[j].end)
+        if begin < end:
+            out.append(Interval(begin, end))
+        if a[i].end < b[j].end:
+            i += 1
+        else:
+            j += 1
+    return out
+
+
+def subtract(a, b):
+    out = []
+    j = 0
+    for interval in a:
+        begin = interval.begin
+        while j < len(b) and b[j].end <= begin:
+            j += 1
+        k = j
+        while k < len(b) and b[k].begin < interval.end:
+            if b[k].begin > begin:
+                out.append(Interval(begin, b[k].begin))
+            begin = max(begin, b[k].end)
+            k += 1
+        if begin < interval.end:
+            out.append(Interval(begin, interval.end))
+    return out
+
+
+# 扫描线: 每个时刻在所有覆盖它的区间中选 key 最小的一个, 返回互不重叠的区间, source 为选中的分段
+def cover(intervals, key):
+    starts = sorted(filter(lambda i: i.end > i.begin, intervals), key=lambda i: i.begin)
+    points = sorted(set(i.begin for i in starts) | set(i.end for i in starts))
+    heap = []
+    out = []
+    index = 0
+    for t, next_t in zip(points, points[1:]):
+        while index < len(starts) and starts[index].begin <= t:
+            heapq.heappush(heap, (key(starts[index]), index, starts[index]))
+            index += 1
+        # 已经结束的区间在到达堆顶时才删除
+        while heap and heap[0][2].end <= t:
+            heapq.heappop(heap)
+        if not heap:
+            continue
+        source = heap[0][2].source
+        if out and out[-1].end == t and out[-1].source is source:
+            out[-1].end = next_t
+        else:
+            out.append(Interval(t, next_t, source))
+    return out
+
+
+# 合并相邻并且分段相同的渲染区间
+def _coalesce(spans):
+    out = []
+    for span in spans:
+        if out and out[-1].end == span.begin and out[-1].camera is span.camera and out[-1].screen is span.screen:
+            out[-1].end = span.end
+        else:
+            out.append(span)
+    return out
+
+
+# 短于 min_span 的区间并入相邻的区间, 前面没有相邻区间时并入后一个
+def _absorb(spans, min_span):
+    out = []
+    carry = None
+    for span in spans:
+        if carry is not None:
+            if carry.end == span.begin:
+                span.begin = carry.begin
+            else:
+                out.append(carry)
+            carry = None
+        if span.duration < min_span:
+            if out and out[-1].end == span.begin:
+                out[-1].end = span.end
+            else:
+                carry = span
+            continue
+        out.append(span)
+    if carry is not None:
+        out.append(carry)
+    return _coalesce(out)
+
+
+# 计算渲染区间: 多个摄像头重叠时使用最先开始的一个, 多个屏幕重叠时使用最后开始的一个
+# 摄像头和屏幕都没有的时间不输出, 复杂度 O(n log n)
+def plan(cameras, screens, min_span=0):
+    cams = cover(cameras, key=lambda i: (i.begin, -i.end))
+    shares = cover(screens, key=lambda i: (-i.begin, -i.end))
+
+    spans = []
+    i = j = 0
+    t = None
+    while i < len(cams) or j < len(shares):
+        cam = cams[i] if i < len(cams) else None
+        screen = shares[j] if j < len(shares) else None
+        if t is None:
+            t = min(x.begin for x in (cam, screen) if x is not None)
+        # 当前时刻 t 所在的摄像头/屏幕区间, 以及下一个边界
+        active_cam = cam if cam is not None and cam.begin <= t < cam.end else None
+        active_screen = screen if screen is not None and screen.begin <= t < screen.end else None
+        bounds = [x.end for x in (active_cam, active_screen) if x is not None]
+        bounds += [x.begin for x in (cam, screen) if x is not None and x.begin > t]
+        end = min(bounds)
+        if active_cam is not None or active_screen is not None:
+            spans.append(Span(t, end, camera=active_cam.source if active_cam is not None else None,
+                              screen=active_screen.source if active_screen is not None else None))
+        t = end
+        if cam is not None and t >= cam.end:
+            i += 1
+        if screen is not None and t >= screen.end:
+            j += 1
+
+    spans = _coalesce(spans)
+    if min_span > 0:
+        spans = _absorb(spans, min_span)
+    return spans
@@ -0,0 +1,354 @@
+import asyncio
+import datetime
+import glob
+import hashlib
+import hmac
+import json
+import os
+import time
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+import aiohttp
+from yarl import URL
+
+from recorder import RecordFile, RecordStatus
+import log
+import metrics
+
+logger = log.get_logger("upload")
+
+# 分片大小, S3 要求除最后一片外不小于 5 MiB, 最多 10000 片
+PART_SIZE = 16 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# 同时上传的分片数, 以及同时上传的文件数
+PART_CONCURRENCY = 4
+FILE_CONCURRENCY = 1
+# 每次从文件读取的大小, 整个分片不会读入内存
+READ_SIZE = 256 * 1024
+# 分片失败后的重试次数, 重试间隔按 2 的幂增长 (秒)
+PART_RETRIES = 3
+RETRY_DELAY = 1
+# 上传状态写在文件旁边, 重启后从已完成的分片继续
+STATE_SUFFIX = ".upload.json"
+
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=None, code=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+# 令牌桶限速, 所有分片共享, rate 为 0 时不限速 (字节/秒)
+class RateLimiter:
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+
+    async def consume(self, n):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        # 先预留, 令牌不足时等待补足
+        self._tokens -= n
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+def _quote(value, safe="-_.~"):
+    return quote(str(value), safe=safe)
+
+
+# 响应可能带也可能不带 S3 的命名空间
+def _find(root, tag):
+    value = root.findtext(S3_NS + tag)
+    return value if value is not None else root.findtext(tag)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+# 上传状态: 每完成一个分片写一次, 先写临时文件再替换
+class UploadState:
+    def __init__(self, path, key, size, mtime, part_size, upload_id=None, parts=None):
+        self.path = path
+        self.key = key
+        self.size = size
+        self.mtime = mtime
+        self.part_size = part_size
+        self.upload_id = upload_id
+        # {分片序号: ETag}
+        self.parts = parts or {}
+
+    @property
+    def state_path(self):
+        return self.path + STATE_SUFFIX
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path + STATE_SUFFIX, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cls(path, data["key"], data["size"], data["mtime"], data["part_size"], data["upload_id"],
+                   {int(k): v for k, v in data["parts"].items()})
+
+    def save(self):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"key": self.key, "size": self.size, "mtime": self.mtime, "part_size": self.part_size,
+                       "upload_id": self.upload_id, "parts": self.parts}, f)
+        os.replace(tmp, self.state_path)
+
+    def remove(self):
+        if os.path.isfile(self.state_path):
+            os.remove(self.state_path)
+
+
+# 把处理完成的录像分片上传到 S3 兼容的对象存储 (path-style, SigV4)
+class S3Uploader:
+    def __init__(self, endpoint, bucket, access_key, secret_key, region="us-east-1", prefix="",
+                 part_size=PART_SIZE, concurrency=PART_CONCURRENCY, files=FILE_CONCURRENCY, bandwidth=0):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.part_size = max(MIN_PART_SIZE, int(part_size))
+        self.concurrency = max(1, int(concurrency))
+        self.limiter = RateLimiter(bandwidth)
+        self._host = urlsplit(self.endpoint).netloc
+        self._files = asyncio.Semaphore(max(1, int(files)))
+        self._session = None
+        self._tasks = set()
+
+    def _client(self):
+        if self._session is None or self._session.closed:
+            # 同一个连接池, 每个分片一个连接
+            connector = aiohttp.TCPConnector(limit=self.concurrency * 2)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=None, sock_read=60))
+        return self._session
+
+    def object_key(self, room, file: RecordFile):
+        begin = file.cameras[0].begin_time if len(file.cameras) > 0 else int(time.time())
+        return "{p}{r}/{t}_{n}".format(p=self.prefix, r=room, t=begin, n=os.path.basename(file.output))
+
+    # 后台上传处理完成的文件, 上传期间状态为 Uploading
+    def submit(self, room, file: RecordFile):
+        if file.output is None or not os.path.isfile(file.output):
+            return None
+        task = asyncio.get_event_loop().create_task(self._upload_file(room, file))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _upload_file(self, room, file: RecordFile):
+        file_log = log.with_room(logger, room)
+        file.status = RecordStatus.Uploading
+        try:
+            key = self.object_key(room, file)
+            await self.upload(file.output, key)
+            file.status = RecordStatus.Uploaded
+            file_log.info("Uploaded %s to %s/%s", file.output, self.bucket, key)
+        except asyncio.CancelledError:
+            file.status = RecordStatus.Finished
+            raise
+        except Exception as e:
+            # 上传状态还在, 下次启动时继续
+            file.status = RecordStatus.Finished
+            file_log.error("Upload %s failed: %s", file.output, e)
+
+    # 重启后继续上传所有留有状态文件的录像
+    async def resume(self, root):
+        paths = [p[:-len(STATE_SUFFIX)] for p in glob.glob(os.path.join(root, "*", "*" + STATE_SUFFIX))]
+        for path in paths:
+            state = UploadState.load(path)
+            if state is None or not os.path.isfile(path):
+                continue
+            logger.warning("Resuming upload of %s, %d parts done", path, len(state.parts))
+            task = asyncio.get_event_loop().create_task(self._resume(path, state.key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return len(paths)
+
+    async def _resume(self, path, key):
+        try:
+            await self.upload(path, key)
+            logger.info("Uploaded %s to %s/%s", path, self.bucket, key)
+        except Exception as e:
+            logger.error("Upload %s failed: %s", path, e)
+
+    async def upload(self, path, key):
+        async with self._files:
+            try:
+                return await self._upload(path, key)
+            except UploadError as e:
+                # 服务端已经没有这次上传 (过期或者被清理), 重新开始
+                if e.code != "NoSuchUpload":
+                    raise
+                state = UploadState.load(path)
+                if state is not None:
+                    state.remove()
+                return await self._upload(path, key)
+
+    async def _upload(self, path, key):
+        stat = os.stat(path)
+        state = UploadState.load(path)
+        if state is None or state.key != key or state.size != stat.st_size or state.mtime != stat.st_mtime:
+            part_size = max(self.part_size, -(-stat.st_size // MAX_PARTS))
+            state = UploadState(path, key, stat.st_size, stat.st_mtime, part_size)
+        if state.upload_id is None:
+            state.upload_id = await self._initiate(key)
+            state.save()
+
+        count = max(1, -(-state.size // state.part_size))
+        todo = [n for n in range(1, count + 1) if n not in state.parts]
+        queue = asyncio.Queue()
+        for n in todo:
+            queue.put_nowait(n)
+
+        async def worker():
+            while not queue.empty():
+                n = queue.get_nowait()
+                offset = (n - 1) * state.part_size
+                state.parts[n] = await self._upload_part(state, n, offset, min(state.part_size, state.size - offset))
+                state.save()
+
+        workers = [asyncio.get_event_loop().create_task(worker()) for _ in range(min(self.concurrency, len(todo)))]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            raise
+
+        etag = await self._complete(key, state)
+        state.remove()
+        metrics.UPLOADS_TOTAL.inc()
+        return etag
+
+    async def _initiate(self, key):
+        body = await self._request("POST", key, {"uploads": ""})
+        upload_id = _find(ElementTree.fromstring(body), "UploadId")
+        if not upload_id:
+            raise UploadError("No UploadId in response of {k}".format(k=key))
+        return upload_id
+
+    async def _upload_part(self, state: UploadState, number, offset, length):
+        query = {"partNumber": str(number), "uploadId": state.upload_id}
+        for attempt in range(PART_RETRIES + 1):
+            try:
+                headers = await self._request("PUT", state.key, query, body=self._read(state.path, offset, length),
+                                              length=length, want_headers=True)
+                return headers.get("ETag", "").strip('"')
+            except (aiohttp.ClientError, asyncio.TimeoutError, UploadError) as e:
+                if isinstance(e, UploadError) and (e.status is None or e.status < 500):
+                    raise
+                if attempt == PART_RETRIES:
+                    raise UploadError("Part {n} of {k} failed: {e}".format(n=number, k=state.key, e=e))
+                logger.warning("Part %d of %s failed, retrying: %s", number, state.key, e,
+                               extra={"rate_key": ("upload", state.key)})
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+    async def _complete(self, key, state: UploadState):
+        parts = "".join("<Part><PartNumber>{n}</PartNumber><ETag>\"{e}\"</ETag></Part>".format(n=n, e=state.parts[n])
+                        for n in sorted(state.parts))
+        body = await self._request("POST", key, {"uploadId": state.upload_id},
+                                   body=("<CompleteMultipartUpload>" + parts + "</CompleteMultipartUpload>").encode())
+        # 完成请求出错时也可能返回 200
+        root = ElementTree.fromstring(body)
+        if root.tag.endswith("Error"):
+            raise UploadError("Complete {k} failed: {m}".format(k=key, m=_find(root, "Message")),
+                              code=_find(root, "Code"))
+        return (_find(root, "ETag") or "").strip('"')
+
+    async def _read(self, path, offset, length):
+        loop = asyncio.get_event_loop()
+        f = open(path, "rb")
+        try:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = await loop.run_in_executor(None, f.read, min(READ_SIZE, remaining))
+                if not data:
+                    raise UploadError("{p} is shorter than expected".format(p=path))
+                await self.limiter.consume(len(data))
+                remaining -= len(data)
+                metrics.UPLOAD_BYTES.inc(len(data))
+                yield data
+        finally:
+            f.close()
+
+    async def _request(self, method, key, query, body=b"", length=None, want_headers=False):
+        path = "/{b}/{k}".format(b=self.bucket, k=key)
+        if isinstance(body, bytes):
+            payload_hash = hashlib.sha256(body).hexdigest() if body else EMPTY_SHA256
+            length = len(body)
+        else:
+            payload_hash = UNSIGNED_PAYLOAD
+        headers = self._sign(method, path, query, payload_hash)
+        headers["Content-Length"] = str(length)
+
+        url = self.endpoint + _quote(path, safe="/-_.~") + "?" + self._query(query)
+        async with self._client().request(method, URL(url, encoded=True), headers=headers, data=body) as resp:
+            data = await resp.read()
+            if resp.status >= 300:
+                code = None
+                message = data[:200].decode(errors="replace")
+                try:
+                    root = ElementTree.fromstring(data)
+                    code = _find(root, "Code")
+                    message = _find(root, "Message") or message
+                except ElementTree.ParseError:
+                    pass
+                raise UploadError("{m} {p} returned {s}: {c} {e}".format(m=method, p=path, s=resp.status, c=code,
+                                                                         e=message), status=resp.status, code=code)
+            return resp.headers if want_headers else data
+
+    @staticmethod
+    def _query(query):
+        return "&".join("{k}={v}".format(k=_quote(k), v=_quote(v)) for k, v in sorted(query.items()))
+
+    # AWS Signature Version 4
+    def _sign(self, method, path, query, payload_hash):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = "{d}/{r}/s3/aws4_request".format(d=amz_date[:8], r=self.region)
+        headers = {"host": self._host, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date}
+
+        signed = ";".join(sorted(headers))
+        canonical = "\n".join([
+            method, _quote(path, safe="/-_.~"), self._query(query),
+            "".join("{k}:{v}\n".format(k=k, v=headers[k]) for k in sorted(headers)),
+            signed, payload_hash])
+        to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()])
+
+        key = _hmac(("AWS4" + self.secret_key).encode(), amz_date[:8])
+        for part in (self.region, "s3", "aws4_request"):
+            key = _hmac(key, part)
+        signature = hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers["Authorization"] = "AWS4-HMAC-SHA256 Credential={a}/{s}, SignedHeaders={h}, Signature={g}".format(
+            a=self.access_key, s=scope, h=signed, g=signature)
+        return headers
+
+    async def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
@@ -1,25 +1,30 @@
 from math import pi
 from typing import AnyStr, Set
-import websockets
 import attr
 import asyncio
-import json
-import random
-import string
 import time
-import subprocess
 import signal
 import os
-
-from janus import JanusSession, JanusSessionStatus, PluginData, Media, RecordSessionStatus, WebrtcUp, SlowLink, HangUp, \
-    Ack, RecordSession
-from recorder import RecordFile, RecordSegment
-from websockets.exceptions import ConnectionClosed
-
-
-# Random Transaction ID
-def transaction_id():
-    return "".join(random.choice(string.ascii_letters) for x in range(12))
+import logging
+from collections import Counter
+
+from janus import JanusSession, JanusSessionStatus, RecordSessionStatus, RecordSession, JanusError
+from events import PluginData, Media, WebrtcUp, SlowLink, HangUp, Ack
+from recorder import RecordFile, RecordSegment, LiveComposite, PIPELINE_CUTS
+from ports import PortExhausted
+from jobs import ProcessingQueue, ProcessingJob, JobStatus
+from pool import ConnectionPool, REQUEST_TIMEOUT
+from keepalive import KeepaliveScheduler
+from store import StateStore
+from supervisor import RecorderSupervisor, STOP_TIMEOUT
+from rtp import RtpRecorder, ENGINE_FFMPEG, ENGINE_PYTHON
+from janus import PORT_POOL
+import janus
+import events
+import keyindex
+import log
+
+logger = log.get_logger("wsclient")
 
 
 # static publisher IDs
@@ -29,12 +34,70 @@ SCREEN = 9
 RECORDER = 911
 
 STOP_RECORDING = -99
+# 等待录制文件生成的最长时间 (秒)
+LIVE_PIP_WAIT = 10
+
+
+# pid 仍然是上次启动的录制进程 (pid 可能已经被其他进程复用)
+def _is_recorder(pid, folder):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with open("/proc/{p}/cmdline".format(p=pid), "rb") as f:
+            cmdline = f.read().decode(errors="ignore")
+    except OSError:
+        return True
+    return "ffmpeg" in cmdline and (folder is None or folder in cmdline)
+
+
+# 等待不是自己子进程的录制进程退出, 超时后 SIGKILL
+async def _wait_exit(pid, timeout=STOP_TIMEOUT, interval=0.2):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        await asyncio.sleep(interval)
+    logger.warning("Orphaned recorder %d did not exit in %ds, killing it", pid, timeout)
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    return False
+
+
+def _servers(server):
+    if isinstance(server, str):
+        return [server]
+    return list(server)
 
 
 @attr.s
 class WebSocketClient:
-    server = attr.ib(validator=attr.validators.instance_of(str))
-    _messages = attr.ib(factory=set)
+    # 一个或多个 Janus 网关地址
+    server = attr.ib(converter=_servers)
+    # 后期处理队列
+    _jobs: ProcessingQueue = attr.ib(factory=ProcessingQueue)
+    # 后期处理模式
+    pipeline = attr.ib(default=PIPELINE_CUTS)
+    # 录制时实时合成画中画
+    live_pip = attr.ib(default=False)
+    # 分段录制的分段时长 (秒), 0 为不分段
+    segment_time = attr.ib(default=0)
+    # 每个网关的 websocket 连接数
+    sockets = attr.ib(default=1)
+    # 录制引擎: 每个 publisher 一个 ffmpeg 进程, 或者在本进程内接收 RTP
+    engine = attr.ib(default=ENGINE_FFMPEG)
+    _pool: ConnectionPool = attr.ib(default=None)
+    # 所有 Janus session 共用的 keepalive 定时器
+    _keepalives: KeepaliveScheduler = attr.ib(factory=KeepaliveScheduler)
+    # 持久化 session / 分段 / 任务状态, 为 None 时只保存在内存中
+    store: StateStore = attr.ib(default=None)
+    # 录制和实时合成的 ffmpeg 进程
+    _recorders: RecorderSupervisor = attr.ib(factory=RecorderSupervisor)
     _joined = False
     # {room: JanusSession}
     _sessions = {}
@@ -42,12 +105,123 @@ class WebSocketClient:
     _record_sessions = {}
     # {room: RecordFile}
     _files = {}
+    # {room: LiveComposite}
+    _compositors = {}
+    # {handle: room}, 用于给 Janus 事件加上房间信息
+    _handles = {}
+    # {room: job_id}, 每个房间最近一次的后期处理任务
+    _room_jobs = {}
 
     async def connect(self):
-        self.conn = await websockets.connect(self.server, subprotocols=['janus-protocol'])
+        self._pool = ConnectionPool(self.server, on_message=self._on_message, sockets=self.sockets)
+        await self._pool.connect()
 
     async def close(self):
-        await self.conn.close()
+        await self._keepalives.close()
+        await self._recorders.close()
+        await self._jobs.close()
+        if self._pool is not None:
+            await self._pool.close()
+        if self.store is not None:
+            await self.store.close()
+
+    def _persist(self, method, *args):
+        if self.store is not None:
+            getattr(self.store, method)(*args)
+
+    # 启动时恢复上次异常退出时没有完成的录制, 返回重新提交的后期处理任务数
+    async def recover(self):
+        if self.store is None:
+            return 0
+
+        # 上次的录制进程已经没有 Janus 转发, 结束它们使文件正常关闭
+        orphans = []
+        for row in self.store.record_sessions():
+            pid = row["recorder_pid"]
+            if pid is not None and _is_recorder(pid, row["folder"]):
+                log.with_room(logger, row["room"]).warning("Stopping orphaned recorder %d of publisher %s",
+                                                           pid, row["publisher"])
+                os.kill(pid, signal.SIGINT)
+                orphans.append(pid)
+            self.store.delete_record_session(row["room"], row["publisher"])
+        # 文件写完之后才能处理
+        await asyncio.gather(*[_wait_exit(pid) for pid in orphans])
+
+        active = [s.name for s in JanusSessionStatus
+                  if s not in (JanusSessionStatus.Stopped, JanusSessionStatus.Finished, JanusSessionStatus.Failed)]
+        for row in self.store.janus_sessions(active):
+            session = JanusSession(room=row["room"], pin=row["pin"], display=row["display"])
+            session.session = row["session"]
+            session.handle = row["handle"]
+            session.status = JanusSessionStatus.Failed
+            self.store.save_janus_session(session)
+
+        interrupted = [row["id"] for row in self.store.jobs([JobStatus.Pending.name, JobStatus.Running.name])]
+        for job_id in interrupted:
+            self.store.interrupt_job(job_id, JobStatus.Failed.name, "interrupted by restart")
+
+        rooms = self.store.unfinished_segments(interrupted)
+        for room, segments in rooms.items():
+            folder = janus.FILE_ROOT_PATH + str(room) + "/"
+            for segment in segments:
+                # 没有结束时间的分段以文件最后写入的时间为准
+                for s in [segment] + segment.composites:
+                    if s.end_time is None:
+                        try:
+                            s.end_time = int(os.path.getmtime(folder + s.name))
+                        except OSError:
+                            s.end_time = s.begin_time
+
+            file = RecordFile(room=room, cam=None, mode=self.pipeline)
+            file.cameras += [s for s in segments if not s.is_screen]
+            file.screens += [s for s in segments if s.is_screen]
+            job = self._jobs.submit(room, file)
+            self._room_jobs[room] = job.id
+            self.store.assign_segments(job.id, segments)
+            log.with_room(logger, room).warning("Recovered %d recording segments, processing job %s",
+                                                len(segments), job.id)
+
+        await self.store.flush()
+        return len(rooms)
+
+    # 当前状态的统计, 用于 /metrics
+    def stats(self):
+        room_bytes = {}
+        for session in self._record_sessions.values():
+            if session.segment is None or session.folder is None:
+                continue
+            try:
+                size = os.path.getsize(session.folder + session.segment.name)
+            except OSError:
+                continue
+            room_bytes[session.room] = room_bytes.get(session.room, 0) + size
+
+        now = time.monotonic()
+        return {
+            "janus_sessions": Counter(s.status.name for s in self._sessions.values()),
+            "record_sessions": Counter(s.status.name for s in self._record_sessions.values()),
+            "recorders": len([s for s in self._record_sessions.values() if s.status == RecordSessionStatus.Recording]),
+            "compositors": len([c for c in self._compositors.values() if c.pid is not None]),
+            "jobs_pending": self._jobs.pending(),
+            "jobs_running": self._jobs.running(),
+            "room_bytes": room_bytes,
+            "shards": self.shard_load(),
+            "keepalives": len(self._keepalives),
+            "ffmpeg": [{
+                "key": p.key,
+                "room": p.room,
+                "bitrate": p.bitrate,
+                "size": p.size,
+                "stalled": p.stalled(now, self._recorders.stall_timeout),
+            } for p in self._recorders.processes()],
+            "ffmpeg_crashes": self._recorders.crashes,
+        }
+
+    # 每个 Janus 连接上的房间数和消息数
+    def shard_load(self):
+        if self._pool is None:
+            return []
+        return self._pool.load()
 
     def _cur_session(self, room):
         r = int(room)
@@ -61,126 +235,64 @@ class WebSocketClient:
             return self._sessions[r].handle
         return None
 
+    # 发送请求并等待同一个 transaction 的响应
+    async def _request(self, message, room, ack=False, timeout=REQUEST_TIMEOUT):
+        return await self._pool.connection(room).request(message, ack=ack, timeout=timeout)
+
     async def _create(self, room):
-        transaction = "Create_{r}".format(r=room)
-        await self.conn.send(json.dumps({
+        raw = await self._request({
             "janus": "create",
             "room": room,
-            "transaction": transaction
-        }))
+        }, room=room)
+        return raw["data"]["id"]
 
     async def _attach(self, room):
-        transaction = "Attach_{r}".format(r=room)
-        await self.conn.send(json.dumps({
+        raw = await self._request({
             "janus": "attach",
             "session_id": self._cur_session(room),
             "plugin": "janus.plugin.videoroom",
-            "transaction": transaction
-        }))
+        }, room=room)
+        return raw["data"]["id"]
 
     async def _sendmessage(self, body, room, jsep=None):
-        print("send message, body", body)
+        if logger.isEnabledFor(logging.DEBUG):
+            log.with_room(logger, room).debug("Send message, body: %s", body)
 
-        transaction = transaction_id()
         janus_message = {
             "janus": "message",
             "session_id": self._cur_session(room),
             "handle_id": self._cur_handle(room),
-            "transaction": transaction,
             "body": body
         }
         if jsep is not None:
             janus_message["jsep"] = jsep
-        await self.conn.send(json.dumps(janus_message))
-
-    async def _keepalive(self, room):
-        session = self._cur_session(room)
-        handle = self._cur_handle(room)
-        if session is None or handle is None:
-            return
-
-        while True:
-            try:
-                await asyncio.sleep(30)
-                transaction = transaction_id()
-                await self.conn.send(json.dumps({
-                    "janus": "keepalive",
-                    "session_id": self._cur_session(room),
-                    "handle_id": self._cur_handle(room),
-                    "transaction": transaction
-                }))
-            except KeyboardInterrupt:
-                return
-
-    async def _handle_pre_join(self, room, transaction, raw):
-        session: JanusSession = self._sessions[int(room)]
-        if transaction == "Create":
-            session.session = raw["data"]["id"]
-            await self._attach(int(room))
-        elif transaction == "Attach":
-            session.handle = raw["data"]["id"]
-            # join the room
-            joinmessage = {"request": "join", "ptype": "publisher", "room": int(room), "pin": str(session.pin),
-                           "display": session.display, "id": RECORDER}
-            await self._sendmessage(joinmessage, room=room)
-
-    async def _recv(self):
-        if len(self._messages) > 0:
-            return self._messages.pop()
-        else:
-            return await self._recv_and_parse()
-
-    async def _recv_and_parse(self):
-        raw = json.loads(await self.conn.recv())
-        print("Received: ", raw)
-        janus = raw["janus"]
-
-        if janus == "event" or janus == "success":
-            if janus == "success" and "transaction" in raw:
-                transaction = str(raw["transaction"])
-                r, _, room = transaction.partition("_")
-                if len(r) > 0 and len(room) > 0:
-                    await self._handle_pre_join(room=room, transaction=r, raw=raw)
-            if "plugindata" in raw:
-                return PluginData(
-                    sender=raw["sender"],
-                    plugin=raw["plugindata"]["plugin"],
-                    data=raw["plugindata"]["data"],
-                    jsep=raw["jsep"] if "jsep" in raw else None
-                )
-        elif janus == "webrtcup":
-            return WebrtcUp(
-                sender=raw["sender"]
-            )
-        elif janus == "media":
-            return Media(
-                sender=raw["sender"],
-                receiving=raw["receiving"],
-                kind=raw["type"]
-            )
-        elif janus == "slowlink":
-            return SlowLink(
-                sender=raw["sender"],
-                uplink=raw["uplink"],
-                lost=raw["lost"]
-            )
-        elif janus == "hangup":
-            return HangUp(
-                sender=raw["sender"],
-                reason=raw["reason"]
-            )
-        elif janus == "ack":
-            return Ack(
-                transaction=raw["transaction"]
-            )
-        else:
-            return raw
+        msg = events.decode(await self._request(janus_message, room=room))
+        if isinstance(msg, PluginData) and msg.data is not None and "error_code" in msg.data:
+            raise JanusError(msg.data["error_code"], msg.data.get("error"))
+        return msg
+
+    # 非请求响应的消息: 房间内的事件等
+    async def _on_message(self, conn, raw):
+        msg = events.decode(raw)
+        if isinstance(msg, PluginData):
+            # 处理过程中还要等待其他请求的响应, 不能阻塞接收
+            asyncio.get_event_loop().create_task(self._handle_plugin_data_safely(msg))
+        elif isinstance(msg, (Media, SlowLink)):
+            # 高频事件限流输出
+            self._event_log(msg).info("%s", msg, extra={"rate_key": (type(msg).__name__, msg.sender)})
+        elif isinstance(msg, (WebrtcUp, HangUp)):
+            self._event_log(msg).info("%s", msg)
+        elif not isinstance(msg, Ack):
+            logger.debug("Unhandled message: %s", msg)
+
+    def _event_log(self, msg):
+        return log.with_room(logger, self._handles.get(msg.sender, "-"))
 
     async def _handle_plugin_data(self, data: PluginData):
-        print("handle plugin data: \n", data)
+        logger.debug("Handle plugin data: %s", data)
 
         if data.jsep is not None:
-            print("handle jesp data")
+            logger.debug("Handle jsep data")
         if data.data is not None:
             events_type = data.data["videoroom"]
             if events_type == "joined":
@@ -195,13 +307,13 @@ class WebSocketClient:
         assert room
 
         publishers = data["publishers"]
-        print("new publishes in the room: \n")
+        room_log = log.with_room(logger, room)
 
         for publisher in publishers:
             id = publisher["id"]
             assert id
 
-            print("id: %(id)s, display: %(display)s" % publisher)
+            room_log.info("New publisher in the room, id: %s, display: %s", id, publisher.get("display"))
             await self._start_recording(room=room, publisher=id)
 
     async def _handle_events(self, data):
@@ -216,7 +328,7 @@ class WebSocketClient:
     async def _handle_leave(self, room, publisher):
         session = self._find_recordsession(room, publisher)
         if session is not None:
-            self._stop_forwarding(session)
+            await self._stop_forwarding(session)
 
     async def _handle_rtp_forward(self, data):
         room = int(data["room"])
@@ -232,33 +344,27 @@ class WebSocketClient:
                     session.update_forwarder(a_stream=rtsp_stream["audio_stream_id"])
                 if "video_stream_id" in rtsp_stream:
                     session.update_forwarder(v_stream=rtsp_stream["video_stream_id"])
-                self._launch_recorder(session)
 
-                print("Now publisher {p} in the room {r} is forwarding".format(p=session.publisher, r=session.room))
+                log.with_room(logger, room).info("Now publisher %s is forwarding", session.publisher)
                 session.status = RecordSessionStatus.Forwarding
+                await self._launch_recorder(session)
 
     async def loop(self):
+        await self.recover()
         await self.connect()
 
-        assert self.conn
+        try:
+            await self._pool.run()
+        except KeyboardInterrupt:
+            return
 
-        while True:
-            try:
-                msg = await self._recv()
-                if isinstance(msg, PluginData):
-                    await self._handle_plugin_data(msg)
-                elif isinstance(msg, Media):
-                    print(msg)
-                elif isinstance(msg, WebrtcUp):
-                    print(msg)
-                elif isinstance(msg, SlowLink):
-                    print(msg)
-                elif isinstance(msg, HangUp):
-                    print(msg)
-                elif not isinstance(msg, Ack):
-                    print(msg)
-            except (KeyboardInterrupt, ConnectionClosed):
-                return
+    async def _handle_plugin_data_safely(self, data: PluginData):
+        try:
+            await self._handle_plugin_data(data)
+        except JanusError as e:
+            logger.error("Handle plugin data failed: %s", e)
+        except Exception:
+            logger.exception("Handle plugin data failed")
 
     # 是否已经加入了房间
     def _is_forwarding(self, key):
@@ -272,22 +378,80 @@ class WebSocketClient:
 
         if room in self._sessions:
             session: JanusSession = self._sessions[room]
-            if session.status.value < JanusSessionStatus.Processing.value:
-                print("Current recorder is in the room")
+            if session.status != JanusSessionStatus.Failed and \
+                    session.status.value < JanusSessionStatus.Processing.value:
+                log.with_room(logger, room).info("Current recorder is in the room")
                 return False
 
         session = JanusSession(room=room, pin=pin, display=display)
         session.status = JanusSessionStatus.Starting
         self._sessions[room] = session
 
-        await self._create(room=room)
+        # create -> attach -> join, 每一步都等待 Janus 的响应; 任何失败 (包括被取消) 都销毁已创建的 session 并释放连接
+        joined = False
+        try:
+            session.session = await self._create(room=room)
+            session.handle = await self._attach(room=room)
+            self._handles[session.handle] = room
+            joinmessage = {"request": "join", "ptype": "publisher", "room": int(room), "pin": str(session.pin),
+                           "display": session.display, "id": RECORDER}
+            msg = await self._sendmessage(joinmessage, room=room)
+            joined = True
+        except JanusError as e:
+            log.with_room(logger, room).error("Join room failed: %s", e)
+            return False
+        finally:
+            if not joined:
+                await self._abort_start(session)
+
+        self._keepalives.add(room, self._pool.connection(room), session.session)
+        session.loop = asyncio.get_event_loop()
 
-        loop = asyncio.get_event_loop()
-        loop.create_task(self._keepalive(room=room))
-        session.loop = loop
+        session.status = JanusSessionStatus.Forwarding
+        self._persist("save_janus_session", session)
+        if isinstance(msg, PluginData):
+            await self._handle_plugin_data(msg)
 
         return True
 
+    # 批量开始录制, 各个房间的 Janus 请求并发执行, 返回与 rooms 顺序一致的结果 (bool 或者异常)
+    async def start_many(self, rooms):
+        return await asyncio.gather(*[self.start_recording(room, pin) for room, pin in rooms], return_exceptions=True)
+
+    # 批量结束录制, 返回 [(是否在录制, 任务 ID)] 或者异常
+    async def stop_many(self, rooms):
+        return await asyncio.gather(*[self.stop_recording(room) for room in rooms], return_exceptions=True)
+
+    # 房间当前的状态, 只读取内存中的状态, 不等待 ffmpeg
+    def room_status(self, room):
+        session: JanusSession = self._sessions.get(room)
+        job = self._jobs.get(self._room_jobs.get(room))
+        if session is None and job is None:
+            return None
+
+        publishers = []
+        for publisher in [CAM1, CAM2, SCREEN]:
+            record = self._find_recordsession(room, publisher)
+            if record is None:
+                continue
+            publishers.append({"publisher": publisher, "status": record.status.name,
+                               "segment": record.segment.name if record.segment is not None else None})
+
+        # 录制中的文件, 结束之后是任务的文件
+        file: RecordFile = self._files.get(room)
+        if file is None and job is not None:
+            file = job.file
+        segments = []
+        if file is not None:
+            segments = [s.info() for s in filter(None, file.cameras + file.screens)]
+
+        return {"room": room, "status": session.status.name if session is not None else None,
+                "publishers": publishers, "segments": segments, "job": job.info() if job is not None else None}
+
+    def job_status(self, job_id):
+        job = self._jobs.get(job_id)
+        return job.info() if job is not None else None
+
     # 录制某个 publisher 
     async def _start_recording(self, room, publisher):
         if publisher not in [CAM1, CAM2, SCREEN]:
@@ -302,21 +466,33 @@ class WebSocketClient:
 
             # preparations: 
             self._create_folders(session)
-            self._create_sdp(session)
+            try:
+                self._create_sdp(session)
+            except PortExhausted as e:
+                log.with_room(logger, room).error("Can not record publisher %s: %s", publisher, e)
+                session.status = RecordSessionStatus.Failed
+                self._record_sessions.pop(session_key, None)
+                return
 
             # 开启转发
-            await self._forward_rtp(session)
+            try:
+                await self._forward_rtp(session)
+            except JanusError as e:
+                log.with_room(logger, room).error("Forward publisher %s failed: %s", publisher, e)
+                session.status = RecordSessionStatus.Failed
+                session.clean_ports()
+                self._record_sessions.pop(session_key, None)
         else:
-            print("The publisher {p} in the room {r} is forwarding".format(p=publisher, r=room))
+            log.with_room(logger, room).info("The publisher %s is forwarding", publisher)
 
     @staticmethod
     def _create_folders(session: RecordSession):
-        print("Creating room file folder...")
+        logger.debug("Creating room file folder...")
         session.create_file_folder()
 
     @staticmethod
     def _create_sdp(session: RecordSession):
-        print("Creating SDP file for ffmpeg...")
+        logger.debug("Creating SDP file for ffmpeg...")
         session.create_sdp()
 
     # forwarding_rtp to local server
@@ -324,42 +500,197 @@ class WebSocketClient:
         forwarding_obj = session.forwarding_obj()
         forwardmessage = {"request": "rtp_forward", "secret": "adminpwd"}.copy()
         forwardmessage.update(forwarding_obj)
-        await self._sendmessage(forwardmessage, room=session.room)
+        resp = await self._sendmessage(forwardmessage, room=session.room)
+        if isinstance(resp, PluginData):
+            await self._handle_plugin_data(resp)
 
-    def _launch_recorder(self, session: RecordSession):
+    async def _launch_recorder(self, session: RecordSession):
         folder = session.folder
         begin_time = int(time.time())
         name = str(session.publisher) + "_" + str(begin_time) + ".ts"
         file_path = folder + name
         sdp = folder + session.forwarder.name
 
-        proc = subprocess.Popen(
-            ['ffmpeg', '-loglevel', 'info', '-hide_banner', '-protocol_whitelist', 'file,udp,rtp', '-i', sdp, '-c',
-             'copy', file_path])
-        session.recorder_pid = proc.pid
-
-        print("Now publisher {p} in the room {r} is recording".format(p=session.publisher, r=session.room))
+        output = [file_path]
+        chunk_list = None
+        if self.segment_time > 0 and self.engine == ENGINE_FFMPEG:
+            # 分段录制, 完成的分段在后台追加到 file_path
+            chunk_list = str(session.publisher) + "_" + str(begin_time) + ".csv"
+            output = ['-f', 'segment', '-segment_time', str(self.segment_time), '-segment_format', 'mpegts',
+                      '-segment_list', folder + chunk_list, '-segment_list_type', 'csv',
+                      '-reset_timestamps', '0',
+                      folder + str(session.publisher) + "_" + str(begin_time) + "_%05d.ts"]
+
+        # 异常退出时作为新的分段重新录制
+        key = str(session.room) + "-" + str(session.publisher)
+        on_crash = lambda p, restart: self._restart_recorder(session, restart, p)
+        if self.engine == ENGINE_PYTHON:
+            forwarder = session.forwarder
+            recorder = RtpRecorder(key, file_path, video_port=forwarder.videoport, video_pt=forwarder.videopt,
+                                   audio_port=forwarder.audioport if forwarder.audioport != -1 else None,
+                                   audio_pt=forwarder.audiopt, host=PORT_POOL.host, room=session.room)
+            process = await self._recorders.add(recorder, on_crash=on_crash)
+        else:
+            # ffmpeg 的输出写到房间目录下的 logs/ 中
+            process = await self._recorders.spawn(
+                key, ['ffmpeg', '-loglevel', 'info', '-hide_banner', '-protocol_whitelist', 'file,udp,rtp', '-i', sdp,
+                      '-c', 'copy'] + output,
+                log_path=log.ffmpeg_log_path(folder, name), room=session.room, on_crash=on_crash)
+            session.bind_ports(process.pid)
+            # 边录制边建立关键帧索引, 分段录制时在合并分段的同时建立
+            if chunk_list is None:
+                asyncio.get_event_loop().create_task(
+                    keyindex.follow(file_path, lambda: process.running, room=session.room))
+        session.recorder_pid = process.pid
+
+        log.with_room(logger, session.room).info("Now publisher %s is recording", session.publisher)
         session.status = RecordSessionStatus.Recording
 
         # 保存文件信息
         segment = RecordSegment(name=name, begin_time=begin_time, room=session.room, publisher=session.publisher)
+        session.segment = segment
+        if chunk_list is not None:
+            segment.chunk_list = chunk_list
+            asyncio.get_event_loop().create_task(self._collect_chunks(segment, folder))
         if session.room not in self._files:
-            file = RecordFile(room=session.room, cam=segment)
-            self._files[session.room] = file
+            self._files[session.room] = RecordFile(room=session.room, cam=None, mode=self.pipeline)
+        file: RecordFile = self._files[session.room]
+        if segment.is_screen:
+            file.screens.append(segment)
         else:
-            file: RecordFile = self._files[session.room]
-            if segment.is_screen:
-                file.screens.append(segment)
-            else:
-                file.cameras.append(segment)
+            file.cameras.append(segment)
+        self._persist("save_segment", segment)
+        self._persist("save_record_session", session)
+
+        if self.live_pip:
+            asyncio.get_event_loop().create_task(self._launch_compositor(session.room))
+
+    # 录制进程异常退出: 结束当前分段, 用新的分段继续录制
+    async def _restart_recorder(self, session: RecordSession, restart, process=None):
+        key = str(session.room) + "-" + str(session.publisher)
+        if self._record_sessions.get(key) is not session or session.status != RecordSessionStatus.Recording:
+            return
+
+        # 实时合成读取的是旧的文件
+        await self._stop_compositor(session.room, session.publisher)
+        session.recorder_pid = None
+        if session.segment is not None:
+            session.segment.end_time = int(time.time())
+            self._frame_times(session.segment, process)
+            self._persist("save_segment", session.segment)
+
+        if not restart:
+            session.status = RecordSessionStatus.Failed
+            self._persist("save_record_session", session)
+            return
+        log.with_room(logger, session.room).warning("Restarting recorder of publisher %s as a new segment",
+                                                    session.publisher)
+        await self._launch_recorder(session)
+
+    # 用录制进程记录的第一帧/最后一帧时间作为分段的毫秒时间戳
+    # 这是估计值, 不是 RTP/PTS 时间: RTP 时间戳的起点随机, 又没有 RTCP SR 换算到墙上时间,
+    # 所以用输出进度 (ffmpeg 的 time=, python 引擎的 pts) 倒推第一帧的到达时间, 误差为转发和输出延迟
+    @staticmethod
+    def _frame_times(segment: RecordSegment, process):
+        if process is None or process.first_frame is None:
+            return
+        segment.begin_ms = int(process.first_frame * 1000)
+        segment.end_ms = int(process.last_frame * 1000)
+
+    # 录制过程中定期合并完成的分段, 直到录制结束
+    async def _collect_chunks(self, segment: RecordSegment, folder):
+        while segment.end_time is None:
+            await asyncio.sleep(self.segment_time)
+            try:
+                if await segment.collect_chunks(folder) > 0:
+                    self._persist("save_segment", segment)
+            except OSError as e:
+                log.with_room(logger, segment.room).error("Collect chunks of %s failed: %s", segment.name, e)
+
+    # 摄像头和屏幕同时在录制时, 实时合成画中画
+    async def _launch_compositor(self, room):
+        if room in self._compositors:
+            return
+
+        screen = self._find_recordsession(room, SCREEN)
+        cams = filter(None, [self._find_recordsession(room, p) for p in [CAM1, CAM2]])
+        cam = next(filter(lambda s: s.status == RecordSessionStatus.Recording, cams), None)
+        if screen is None or cam is None or screen.status != RecordSessionStatus.Recording:
+            return
+
+        composite = LiveComposite(room=room, camera=cam.segment, screen=screen.segment, begin_time=int(time.time()))
+        self._compositors[room] = composite
+
+        # 等待两个录制文件都已经生成
+        folder = screen.folder
+        for _ in range(LIVE_PIP_WAIT + self.segment_time):
+            if os.path.isfile(folder + cam.segment.name) and os.path.isfile(folder + screen.segment.name):
+                break
+            await asyncio.sleep(1)
+        else:
+            log.with_room(logger, room).warning("Recording files not ready, skip live PiP")
+            self._compositors.pop(room, None)
+            return
+        if self._compositors.get(room) is not composite:
+            return
+
+        composite.segment.begin_time = int(time.time())
+        process = await self._recorders.spawn(
+            str(room) + "-pip", composite.command(folder, read_timeout=LIVE_PIP_WAIT + self.segment_time),
+            log_path=log.ffmpeg_log_path(folder, composite.segment.name), room=room,
+            on_crash=lambda p, restart: self._restart_compositor(room, composite, p, restart))
+        composite.pid = process.pid
+        screen.segment.composites.append(composite.segment)
+        self._persist("save_segment", screen.segment)
 
-    # 结束当前房间录制
+        log.with_room(logger, room).info("Now compositing PiP of publisher %s live", cam.publisher)
+
+    async def _stop_compositor(self, room, publisher):
+        composite: LiveComposite = self._compositors.get(room)
+        if composite is None:
+            return
+        if publisher != SCREEN and composite.camera.publisher != publisher:
+            return
+
+        self._compositors.pop(room, None)
+        if composite.pid is not None:
+            end_time = int(time.time())
+            process = self._recorders.get(str(room) + "-pip")
+            await self._recorders.stop(str(room) + "-pip")
+            self._end_composite(composite, process, end_time)
+            log.with_room(logger, room).info("Stopped compositing PiP")
+
+    def _end_composite(self, composite: LiveComposite, process, end_time):
+        composite.pid = None
+        composite.segment.end_time = end_time
+        self._frame_times(composite.segment, process)
+        self._persist("save_segment", composite.screen)
+
+    # 合成进程异常退出: 结束当前的画中画文件, 屏幕和摄像头还在录制时作为新的文件重新合成
+    async def _restart_compositor(self, room, composite: LiveComposite, process, restart):
+        if self._compositors.get(room) is not composite:
+            return
+        self._compositors.pop(room, None)
+        self._end_composite(composite, process, int(time.time()))
+        if restart:
+            await self._launch_compositor(room)
+
+    # 结束当前房间录制, 返回后期处理任务 ID (没有录制文件时为 None)
+    # 没有在录制 (还在加入房间, 已经停止, 正在处理, 或者已有另一个停止请求) 的房间返回 False, 不会再次 destroy;
+    # 加入房间的请求还没有完成时不能停止, 否则 start_recording 会在销毁之后继续使用这个 session
     async def stop_recording(self, room):
-        if room not in self._sessions:
-            return False
+        session: JanusSession = self._sessions.get(room)
+        if session is None or session.status not in (JanusSessionStatus.Forwarding, JanusSessionStatus.Recording):
+            log.with_room(logger, room).info("Room is not recording, nothing to stop")
+            return False, None
+        # 先标记为已停止, 同时到达的停止请求不会重复执行
+        session.status = JanusSessionStatus.Stopped
         await self._stop_all_sessions(room)
-        self._processing_file(room)
-        return True
+        job = self._processing_file(room)
+        return True, job.id if job is not None else None
+
+    def job(self, job_id) -> ProcessingJob:
+        return self._jobs.get(job_id)
 
     def _find_recordsession(self, room, publisher):
         session_key = str(room) + "-" + str(publisher)
@@ -379,69 +710,105 @@ class WebSocketClient:
         for session in sessions:
             await self._stop_session(session)
 
-        print("Now leaving room...")
+        log.with_room(logger, room).info("Now leaving room...")
         janus_session: JanusSession = self._sessions[room]
         await self._leave_room(janus_session)
 
         # janus_session.loop.stop()
         # janus_session.loop.close()
 
+    async def _destroy(self, session: JanusSession):
+        try:
+            await self._request({
+                "janus": "destroy",
+                "session_id": session.session,
+            }, room=session.room)
+        except JanusError as e:
+            log.with_room(logger, session.room).error("Destroy session failed: %s", e)
+
+    # 加入房间失败, 清理已经创建的 Janus session 和分配的连接
+    async def _abort_start(self, session: JanusSession):
+        session.status = JanusSessionStatus.Failed
+        self._persist("save_janus_session", session)
+        try:
+            if session.session is not None:
+                await self._destroy(session)
+        finally:
+            self._handles.pop(session.handle, None)
+            self._pool.release(session.room)
+
     async def _leave_room(self, session: JanusSession):
-        transaction = transaction_id()
-        await self.conn.send(json.dumps({
-            "janus": "destroy",
-            "session_id": session.session,
-            "transaction": transaction
-        }))
+        await self._destroy(session)
+        self._keepalives.remove(session.room)
+        self._handles.pop(session.handle, None)
+        self._pool.release(session.room)
         session.status = JanusSessionStatus.Stopped
+        self._persist("save_janus_session", session)
 
     async def _stop_session(self, session: RecordSession):
         async def _stop_stream(stream):
             forwarding_obj = session.stop_forwarding_obj(stream)
             forwardmessage = {"request": "stop_rtp_forward", "secret": "adminpwd"}.copy()
             forwardmessage.update(forwarding_obj)
-            await self._sendmessage(forwardmessage, room=session.room)
+            try:
+                await self._sendmessage(forwardmessage, room=session.room)
+            except JanusError as e:
+                log.with_room(logger, session.room).error("Stop forwarding stream %s failed: %s", stream, e)
 
         if session.forwarder.audio_stream_id is not None:
             await _stop_stream(session.forwarder.audio_stream_id)
         if session.forwarder.video_stream_id is not None:
             await _stop_stream(session.forwarder.video_stream_id)
 
-        self._stop_forwarding(session)
+        await self._stop_forwarding(session)
 
-    def _stop_forwarding(self, session: RecordSession):
+    async def _stop_forwarding(self, session: RecordSession):
         room = session.room
         publisher = session.publisher
+        end_time = int(time.time())
+        session.status = RecordSessionStatus.Stopped
+
+        await self._stop_compositor(room, publisher)
 
-        os.kill(session.recorder_pid, signal.SIGINT)
+        # 等待录制进程写完文件再交给后期处理; 转发的响应还没有返回时 publisher 就离开了, 没有录制进程
+        key = str(session.room) + "-" + str(session.publisher)
+        process = self._recorders.get(key)
+        await self._recorders.stop(key)
         session.recorder_pid = None
 
-        print("Now publisher {p} in the room {r} is Stopped recording".format(p=session.publisher, r=session.room))
-        session.status = RecordSessionStatus.Stopped
+        log.with_room(logger, room).info("Now publisher %s stopped recording", publisher)
         session.clean_ports()
 
-        key = str(session.room) + "-" + str(session.publisher)
         self._record_sessions.pop(key, None)
+        self._persist("delete_record_session", session.room, session.publisher)
 
         # 更新文件信息
-        file: RecordFile = self._files[room]
-        end_time = int(time.time())
-        if file is not None:
-            if int(publisher) == SCREEN:
-                segment: RecordSegment = file.screens[-1]
-                segment.end_time = end_time
-            else:
-                segment: RecordSegment = file.cameras[-1]
-                segment.end_time = end_time
+        if session.segment is not None:
+            session.segment.end_time = end_time
+            self._frame_times(session.segment, process)
+            self._persist("save_segment", session.segment)
 
+    # 提交后期处理任务, 不阻塞事件循环
     def _processing_file(self, room):
-        print("Starting processing all the files from room = ", room)
+        log.with_room(logger, room).info("Starting processing all the files")
 
-        if room in self._files:
-            file: RecordFile = self._files[room]
-            if file is not None:
-                file.process()
+        file: RecordFile = self._files.pop(room, None)
+        if file is None:
+            return None
 
-                print("\n\n\n----------TEST--------\n\n\n")
-                session: JanusSession = self._sessions[room]
-                session.status = JanusSessionStatus.Processing
+        session: JanusSession = self._sessions[room]
+        session.status = JanusSessionStatus.Processing
+        self._persist("save_janus_session", session)
+
+        def done(job: ProcessingJob):
+            if job.status == JobStatus.Finished:
+                session.status = JanusSessionStatus.Finished
+            else:
+                session.status = JanusSessionStatus.Failed
+            self._persist("save_janus_session", session)
+
+        job = self._jobs.submit(room, file)
+        job.add_done_callback(done)
+        self._room_jobs[room] = job.id
+        self._persist("assign_segments", job.id, list(filter(None, file.cameras + file.screens)))
+        return job